@@ -0,0 +1,525 @@
+"""离线性能测试：用模拟的 Telegram 媒体后端驱动两个脚本中真实的处理器
+
+每个场景在独立的子进程和临时下载目录中运行，不会连接 Telegram，也不会动到 /root/video。
+
+    python benchmark.py                              # 两个脚本 × 所有场景
+    python benchmark.py --script video --scenario huge --scale 0.25
+    python benchmark.py --bandwidth 4 --latency 100 --error-rate 0.01 --flood-rate 0.005
+
+报告端到端吞吐量、处理器耗时、事件循环延迟、峰值内存以及发出的消息和编辑次数。
+"""
+import os
+import sys
+import asyncio
+import argparse
+import json
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+MiB = 1024 * 1024
+
+# 场景: 名称 -> (说明, 频道数, 每个频道的文件数, 单个文件大小 MiB)
+SCENARIOS = {
+    'huge': ("单个大文件", 1, 1, 512),
+    'burst': ("大量小文件同时到达", 1, 200, 2),
+    'channels': ("多个频道", 50, 4, 4),
+    'albums': ("相册（每组 10 个视频）", 4, 50, 2),
+}
+# albums 场景中每个相册的视频数
+ALBUM_SIZE = 10
+
+
+class FakeBackend:
+    """模拟的媒体服务器：按配置的延迟和单连接带宽返回合成数据，并按概率注入错误和 FloodWait"""
+
+    def __init__(self, bandwidth, latency, error_rate, flood_rate, flood_seconds, seed=0):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.random = random.Random(seed)
+        self.zeros = bytes(4 * MiB)
+        self.requests = 0
+        self.errors = 0
+        self.flood_waits = 0
+
+    def inject(self):
+        """按概率返回要注入的错误类型：'flood'、'error' 或 None"""
+        roll = self.random.random()
+        if roll < self.flood_rate:
+            self.flood_waits += 1
+            return 'flood'
+        if roll < self.flood_rate + self.error_rate:
+            self.errors += 1
+            return 'error'
+        return None
+
+    def chunk(self, document_id, offset, length):
+        """合成数据，每段开头写入文档 id 和偏移，避免不同文件内容相同被去重"""
+        header = struct.pack('>QQ', document_id, offset)
+        return header + self.zeros[:length - len(header)]
+
+    async def transfer(self, length):
+        self.requests += 1
+        await asyncio.sleep(self.latency + length / self.bandwidth)
+
+
+class Recorder:
+    """收集处理器耗时、事件循环延迟和发出的消息"""
+
+    def __init__(self):
+        self.handler_times = []
+        self.loop_lags = []
+        self.sent = 0
+        self.edits = 0
+
+    async def watch_loop(self, interval=0.01):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lags.append(time.perf_counter() - started - interval)
+
+    async def timed(self, coro):
+        started = time.perf_counter()
+        await coro
+        self.handler_times.append(time.perf_counter() - started)
+
+
+class FakeMessage:
+    """同时兼容 Telethon 和 python-telegram-bot 的消息对象"""
+
+    def __init__(self, recorder, chat_id, message_id):
+        self.recorder = recorder
+        self.chat_id = chat_id
+        self.id = self.message_id = message_id
+
+    async def edit(self, text):
+        self.recorder.edits += 1
+        return self
+
+    async def edit_text(self, text):
+        return await self.edit(text)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def build_posts(scenario, scale):
+    """生成场景中的频道和消息: [(chat_id, username, message_id, document_id, size)]"""
+    _, channels, files, size_mib = SCENARIOS[scenario]
+    size = max(1, int(size_mib * MiB * scale))
+    posts = []
+    for channel in range(channels):
+        chat_id = -1000000000000 - channel
+        for index in range(files):
+            posts.append((chat_id, f"bench{channel}", index + 1, channel * 100000 + index + 1, size))
+    # 多个频道的消息交错到达
+    posts.sort(key=lambda post: post[2])
+    return posts
+
+
+async def run_video(args, backend, recorder, posts):
+    """驱动 telegram_video_downloader.py 中注册的事件处理器和下载 worker"""
+    from telethon import errors, events, types
+    import telegram_video_downloader as bot
+
+    class FakeSender:
+        auth_key = None
+
+        async def send(self, request):
+            injected = backend.inject()
+            if injected == 'flood':
+                raise errors.FloodWaitError(request, capture=backend.flood_seconds)
+            if injected == 'error':
+                raise errors.ServerError(request, 'INJECTED')
+            location = request.location
+            size = documents[location.id].size
+            length = max(0, min(request.limit, size - request.offset))
+            await backend.transfer(length)
+            return types.upload.File(
+                type=types.storage.FileUnknown(),
+                mtime=0,
+                bytes=backend.chunk(location.id, request.offset, length)
+            )
+
+        def is_connected(self):
+            return True
+
+        async def disconnect(self):
+            pass
+
+    class FakeClient:
+        def __init__(self):
+            self.session = SimpleNamespace(dc_id=2, auth_key=None)
+            self._sender = FakeSender()
+            self.handlers = []
+            self.message_ids = 0
+
+        def is_connected(self):
+            return True
+
+        def on(self, builder):
+            def decorator(callback):
+                self.add_event_handler(callback, builder)
+                return callback
+            return decorator
+
+        def add_event_handler(self, callback, builder):
+            self.handlers.append((callback, builder))
+
+        async def dispatch(self, event, album=False):
+            for callback, builder in self.handlers:
+                if isinstance(builder, events.Album) != album:
+                    continue
+                if album:
+                    if event.chat_id in builder.chats:
+                        await recorder.timed(callback(event))
+                    continue
+                if builder.pattern is not None:
+                    if not builder.pattern(event.text or ''):
+                        continue
+                elif builder.chats is not None and event.chat_id not in builder.chats:
+                    continue
+                await recorder.timed(callback(event))
+
+        async def send_message(self, chat_id, text):
+            recorder.sent += 1
+            self.message_ids += 1
+            return FakeMessage(recorder, chat_id, self.message_ids)
+
+        async def get_input_entity(self, peer):
+            return peer
+
+        async def get_entity(self, peer):
+            return SimpleNamespace(id=peer, photo=None)
+
+        async def get_messages(self, chat_id, ids=None):
+            if isinstance(ids, list):
+                return [messages.get((chat_id, message_id)) for message_id in ids]
+            return messages.get((chat_id, ids))
+
+    async def create_media_sender(client, dc_id, auth_key=None):
+        # 建立连接和握手大约需要两个往返
+        await asyncio.sleep(backend.latency * 2)
+        return FakeSender()
+
+    documents = {}
+    messages = {}
+    for chat_id, username, message_id, document_id, size in posts:
+        document = types.Document(
+            id=document_id,
+            access_hash=0,
+            file_reference=b'ref',
+            date=None,
+            mime_type='video/mp4',
+            size=size,
+            dc_id=2,
+            attributes=[types.DocumentAttributeFilename(file_name=f"bench_{document_id}.mp4")]
+        )
+        documents[document_id] = document
+        messages[(chat_id, message_id)] = SimpleNamespace(
+            id=message_id,
+            media=types.MessageMediaDocument(document=document),
+            date=datetime.now(timezone.utc),
+            grouped_id=abs(chat_id) * 1000 + (message_id - 1) // ALBUM_SIZE if args.scenario == 'albums' else None
+        )
+        bot.monitored_channels[chat_id] = {'username': username, 'title': username}
+
+    bot.create_media_sender = create_media_sender
+    client = FakeClient()
+    bot.client_pool.add('main', client, listener=True)
+    bot.register_handlers(client)
+    bot.start_services(client)
+    # 让启动时的补抓先检查完检查点（此时都还没有），避免和后面的消息交错
+    await asyncio.sleep(0)
+
+    started = time.perf_counter()
+    for chat_id, username, message_id, document_id, size in posts:
+        message = messages[(chat_id, message_id)]
+        await client.dispatch(SimpleNamespace(
+            chat_id=chat_id,
+            chat=SimpleNamespace(username=username, title=username),
+            message=message,
+            text='',
+            sender_id=None
+        ))
+        # 相册的最后一条消息到达后，Telethon 会再产生一个包含整组消息的 Album 事件
+        if message.grouped_id and (message_id % ALBUM_SIZE == 0 or (chat_id, message_id + 1) not in messages):
+            first_id = message_id - (message_id - 1) % ALBUM_SIZE
+            await client.dispatch(SimpleNamespace(
+                chat_id=chat_id,
+                grouped_id=message.grouped_id,
+                messages=[messages[(chat_id, i)] for i in range(first_id, message_id + 1)]
+            ), album=True)
+
+    # 等待所有任务结束
+    while True:
+        done, failed = bot.ledger.conn.execute(
+            "SELECT SUM(status = 'completed'), SUM(status = 'failed') FROM downloads"
+        ).fetchone()
+        if (done or 0) + (failed or 0) >= len(posts):
+            break
+        if time.perf_counter() - started > args.timeout:
+            raise TimeoutError(f"超过 {args.timeout} 秒仍未完成")
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    completed_bytes = bot.ledger.conn.execute(
+        "SELECT COALESCE(SUM(size), 0) FROM downloads WHERE status = 'completed'"
+    ).fetchone()[0]
+    return elapsed, done or 0, failed or 0, completed_bytes
+
+
+async def run_bot(args, backend, recorder, posts):
+    """驱动 telegram_bot_downloader.py 的频道消息处理器
+
+    python-telegram-bot 默认逐个处理更新，这里同样按顺序等待处理器返回。
+    文件地址由 httpx 的 MockTransport 按 Range 请求头返回模拟数据，分段下载走真实的代码路径。
+    """
+    import httpx
+    from telegram.error import NetworkError, RetryAfter
+    import telegram_bot_downloader as bot
+
+    class FakeFile:
+        def __init__(self, size, document_id):
+            self.size = size
+            self.file_size = size
+            self.document_id = document_id
+            self.file_path = f"https://files.invalid/{document_id}"
+
+        async def download_to_drive(self, custom_path):
+            with open(custom_path, 'wb') as f:
+                offset = 0
+                while offset < self.size:
+                    length = min(MiB, self.size - offset)
+                    await backend.transfer(length)
+                    f.write(backend.chunk(self.document_id, offset, length))
+                    offset += length
+
+    class FakeBot:
+        def __init__(self):
+            self.message_ids = 0
+
+        async def send_message(self, chat_id, text):
+            recorder.sent += 1
+            self.message_ids += 1
+            return FakeMessage(recorder, chat_id, self.message_ids)
+
+        async def get_file(self, file_id, **kwargs):
+            injected = backend.inject()
+            if injected == 'flood':
+                raise RetryAfter(backend.flood_seconds)
+            if injected == 'error':
+                raise NetworkError('INJECTED')
+            return FakeFile(*files[file_id])
+
+    files = {}
+    for chat_id, username, message_id, document_id, size in posts:
+        files[str(document_id)] = (size, document_id)
+        bot.monitored_channels[chat_id] = {'username': username, 'title': username}
+
+    async def handle_request(request):
+        document_id = int(request.url.path.strip('/'))
+        size = files[str(document_id)][0]
+        start, end = 0, size - 1
+        if 'range' in request.headers:
+            start, end = (int(value) for value in request.headers['range'][6:].split('-'))
+        if backend.inject():
+            raise httpx.ReadError('INJECTED', request=request)
+        length = end - start + 1
+        await backend.transfer(length)
+        content = b''.join(
+            backend.chunk(document_id, offset, min(MiB, end + 1 - offset))
+            for offset in range(start, end + 1, MiB)
+        )
+        return httpx.Response(206, content=content)
+
+    await bot.post_init(SimpleNamespace(bot=FakeBot()))
+    bot.range_downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(handle_request))
+    context = SimpleNamespace(bot=FakeBot())
+
+    started = time.perf_counter()
+    done = failed = completed_bytes = 0
+    for chat_id, username, message_id, document_id, size in posts:
+        update = SimpleNamespace(
+            channel_post=SimpleNamespace(
+                message_id=message_id,
+                date=datetime.now(timezone.utc),
+                video=SimpleNamespace(
+                    file_id=str(document_id),
+                    file_unique_id=str(document_id),
+                    file_name=f"bench_{document_id}.mp4",
+                    file_size=size,
+                    mime_type='video/mp4',
+                    duration=60,
+                    height=720
+                )
+            ),
+            effective_chat=SimpleNamespace(id=chat_id, username=username, title=username)
+        )
+        await recorder.timed(bot.handle_new_message(update, context))
+        path = bot.build_file_path(
+            chat_id, username, message_id, f"bench_{document_id}.mp4", update.channel_post.date
+        )
+        if os.path.exists(path):
+            done += 1
+            completed_bytes += size
+        else:
+            failed += 1
+        if time.perf_counter() - started > args.timeout:
+            raise TimeoutError(f"超过 {args.timeout} 秒仍未完成")
+    return time.perf_counter() - started, done, failed, completed_bytes
+
+
+async def run_scenario(args):
+    backend = FakeBackend(
+        args.bandwidth * MiB, args.latency / 1000, args.error_rate,
+        args.flood_rate, args.flood_seconds, args.seed
+    )
+    recorder = Recorder()
+    posts = build_posts(args.scenario, args.scale)
+    watcher = asyncio.create_task(recorder.watch_loop())
+    runner = run_video if args.script == 'video' else run_bot
+    elapsed, done, failed, completed_bytes = await runner(args, backend, recorder, posts)
+    watcher.cancel()
+    return {
+        'script': args.script,
+        'scenario': args.scenario,
+        'files': len(posts),
+        'completed': done,
+        'failed': failed,
+        'seconds': elapsed,
+        'throughput': completed_bytes / elapsed if elapsed > 0 else 0,
+        'handler_p50_ms': percentile(recorder.handler_times, 0.5) * 1000,
+        'handler_p95_ms': percentile(recorder.handler_times, 0.95) * 1000,
+        'handler_max_ms': max(recorder.handler_times, default=0) * 1000,
+        'loop_lag_p99_ms': percentile(recorder.loop_lags, 0.99) * 1000,
+        'loop_lag_max_ms': max(recorder.loop_lags, default=0) * 1000,
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'sent': recorder.sent,
+        'edits': recorder.edits,
+        'requests': backend.requests,
+        'injected_errors': backend.errors,
+        'injected_floods': backend.flood_waits,
+    }
+
+
+def run_child(args):
+    """子进程入口：DOWNLOAD_PATH 已经指向临时目录，直接导入脚本运行单个场景"""
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    # 被测脚本的后台任务会一直运行，测完直接退出进程，不等待它们取消
+    loop = asyncio.new_event_loop()
+    result = loop.run_until_complete(run_scenario(args))
+    print(json.dumps(result), flush=True)
+    os._exit(0)
+
+
+def spawn(args, script, scenario):
+    """在新的子进程和临时目录中运行一个场景，返回结果字典"""
+    directory = tempfile.mkdtemp(prefix='tvd-bench-')
+    env = dict(os.environ, DOWNLOAD_PATH=directory)
+    env.setdefault('MIN_FREE_SPACE', '0')
+    command = [
+        sys.executable, os.path.abspath(__file__), '--child',
+        '--script', script, '--scenario', scenario,
+        '--scale', str(args.scale),
+        '--bandwidth', str(args.bandwidth),
+        '--latency', str(args.latency),
+        '--error-rate', str(args.error_rate),
+        '--flood-rate', str(args.flood_rate),
+        '--flood-seconds', str(args.flood_seconds),
+        '--seed', str(args.seed),
+        '--timeout', str(args.timeout),
+    ]
+    try:
+        result = subprocess.run(
+            command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=None if args.verbose else subprocess.DEVNULL, text=True
+        )
+        if result.returncode != 0:
+            return {'script': script, 'scenario': scenario, 'error': f"退出码 {result.returncode}"}
+        return json.loads(result.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def print_report(results):
+    columns = [
+        ('script', '脚本', '{}'),
+        ('scenario', '场景', '{}'),
+        ('completed', '完成', '{}'),
+        ('failed', '失败', '{}'),
+        ('seconds', '用时(s)', '{:.1f}'),
+        ('throughput', '吞吐(MiB/s)', None),
+        ('handler_p95_ms', '处理器p95(ms)', '{:.1f}'),
+        ('handler_max_ms', '处理器max(ms)', '{:.1f}'),
+        ('loop_lag_p99_ms', '循环延迟p99(ms)', '{:.1f}'),
+        ('loop_lag_max_ms', '循环延迟max(ms)', '{:.1f}'),
+        ('peak_rss_mib', '峰值内存(MiB)', '{:.0f}'),
+        ('sent', '发送', '{}'),
+        ('edits', '编辑', '{}'),
+    ]
+    rows = []
+    for result in results:
+        if 'error' in result:
+            rows.append([result['script'], result['scenario'], f"失败: {result['error']}"])
+            continue
+        row = []
+        for key, _, fmt in columns:
+            value = result[key]
+            row.append(f"{value / MiB:.1f}" if key == 'throughput' else fmt.format(value))
+        rows.append(row)
+    print("\t".join(title for _, title, _ in columns))
+    for row in rows:
+        print("\t".join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线性能测试")
+    parser.add_argument('--script', choices=['video', 'bot', 'all'], default='all')
+    parser.add_argument('--scenario', choices=list(SCENARIOS) + ['all'], default='all')
+    parser.add_argument('--scale', type=float, default=1.0, help="文件大小的缩放系数")
+    parser.add_argument('--bandwidth', type=float, default=8, help="单个连接的带宽 (MiB/s)")
+    parser.add_argument('--latency', type=float, default=50, help="每个请求的延迟 (毫秒)")
+    parser.add_argument('--error-rate', type=float, default=0, help="请求失败的概率")
+    parser.add_argument('--flood-rate', type=float, default=0, help="请求触发 FloodWait 的概率")
+    parser.add_argument('--flood-seconds', type=int, default=3, help="注入的 FloodWait 秒数")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600, help="单个场景的超时时间（秒）")
+    parser.add_argument('--json', action='store_true', help="以 JSON 输出结果")
+    parser.add_argument('--verbose', action='store_true', help="显示被测脚本的日志")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    scripts = ['video', 'bot'] if args.script == 'all' else [args.script]
+    scenarios = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    results = []
+    for script in scripts:
+        for scenario in scenarios:
+            print(f"运行 {script} / {scenario} ({SCENARIOS[scenario][0]})...", file=sys.stderr)
+            results.append(spawn(args, script, scenario))
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    main()
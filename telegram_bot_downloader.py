@@ -1,53 +1,844 @@
 import os
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import deque
 import logging
+import logging.handlers
+import atexit
+import queue
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.error import TimedOut, NetworkError
+from telegram.error import TimedOut, NetworkError, RetryAfter, BadRequest
 import httpx
 import time
 import json
-import math
+import re
+import fnmatch
+import mimetypes
+import shutil
 import humanize  # 需要安装: pip install humanize
+try:
+    import h2  # noqa: F401  HTTP/2 支持需要安装: pip install httpx[http2]
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
-# 配置日志
+# 视频保存路径
+DOWNLOAD_PATH = os.getenv('DOWNLOAD_PATH', '/root/video')
+os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+
+# 配置日志：事件循环中只把日志放入队列，由单独的线程写入文件和控制台，磁盘慢时不会阻塞下载
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.FileHandler(os.path.join(DOWNLOAD_PATH, 'bot.log')),  # 添加文件日志
+    logging.StreamHandler()  # 保留控制台输出
+)
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO,
-    handlers=[
-        logging.FileHandler('/root/video/bot.log'),  # 添加文件日志
-        logging.StreamHandler()  # 保留控制台输出
-    ]
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Telegram Bot配置
-BOT_TOKEN = '填入机器人的TOKEN'
-ADMIN_USER_ID = 填入你的用户ID
-BASE_URL = "https://api.telegram.org/bot"  # 可以根据需要修改为其他 API 地址
+BOT_TOKEN = os.getenv('BOT_TOKEN', '填入机器人的TOKEN')
+ADMIN_USER_ID = int(os.getenv('ADMIN_USER_ID', '0'))  # 填入你的用户ID
+BASE_URL = os.getenv('BASE_URL', "https://api.telegram.org/bot")  # 可以根据需要修改为其他 API 地址
+BASE_FILE_URL = os.getenv('BASE_FILE_URL', BASE_URL.replace('/bot', '/file/bot'))
 
-# 视频保存路径
-DOWNLOAD_PATH = '/root/video'
-os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+# 自建 Bot API 服务器（telegram-bot-api --local）模式：没有 50MB 限制，
+# 服务器下载好的文件在同一台机器上时直接移动或硬链接到视频目录，不再经 HTTP 复制一遍
+LOCAL_BOT_API = os.getenv('LOCAL_BOT_API', 'off').lower() in ('1', 'on', 'true', 'yes')
+# 接管服务器文件的方式：move 移动（服务器再次需要时会重新下载），link 硬链接（服务器保留自己的副本）
+LOCAL_FILE_ACTION = os.getenv('LOCAL_FILE_ACTION', 'move')
+# 服务器的工作目录在本机上的挂载位置，格式为 "服务器路径=本机路径"，例如 Docker 中运行时
+LOCAL_FILES_MAP = os.getenv('LOCAL_FILES_MAP', '')
+# 本地模式下 get_file 要等服务器下载完整个文件才返回，需要更长的超时（秒）
+LOCAL_GET_FILE_TIMEOUT = float(os.getenv('LOCAL_GET_FILE_TIMEOUT', '3600'))
+# 能下载的最大文件：公共 Bot API 为 50MB，本地服务器为 2000MB
+MAX_FILE_SIZE = (2000 if LOCAL_BOT_API else 50) * 1024 * 1024
+
+# 通过 HTTP 下载文件时每个分段的大小、每个文件同时请求的分段数、连接池上限和分段重试次数
+HTTP_SEGMENT_SIZE = int(os.getenv('HTTP_SEGMENT_SIZE', str(8 * 1024 * 1024)))
+HTTP_CONNECTIONS = int(os.getenv('HTTP_CONNECTIONS', '4'))
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '32'))
+HTTP_SEGMENT_RETRIES = 5
+# 下载连接使用 HTTP/2（需要安装 h2），同一服务器的所有分段复用一条连接
+HTTP2 = os.getenv('HTTP2', 'on').lower() in ('1', 'on', 'true', 'yes') and HTTP2_AVAILABLE
+
+# 下载限速（每秒字节数，如 20MB，0 表示不限制），以及按时间段覆盖全局限速的时间表，
+# 如 09:00-18:00=20MB,18:00-23:00=50MB；频道限速读取 channels.json 中用 /limit 设置的值
+BANDWIDTH_LIMIT = os.getenv('BANDWIDTH_LIMIT', '0')
+BANDWIDTH_SCHEDULE = os.getenv('BANDWIDTH_SCHEDULE', '')
 
-# 存储被监控的频道
-monitored_channels = set()
+# 视频存放目录和分层布局，布局中可以使用 {channel} {year} {month} {day}
+VIDEO_PATH = os.getenv('VIDEO_PATH', os.path.join(DOWNLOAD_PATH, 'videos'))
+os.makedirs(VIDEO_PATH, exist_ok=True)
+STORAGE_LAYOUT = os.getenv('STORAGE_LAYOUT', '{channel}/{year}/{month}')
+
+# /status 中统计最近下载速度的时间窗口（秒）
+THROUGHPUT_WINDOW = 600
+
+# 指标接口：设置端口后在 http://METRICS_HOST:METRICS_PORT/metrics 以 Prometheus 格式输出运行指标，0 表示关闭
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# 磁盘配额（字节，0 表示不限制）和下载时需要保留的最小剩余空间
+DISK_QUOTA = int(os.getenv('DISK_QUOTA', '0'))
+MIN_FREE_SPACE = int(os.getenv('MIN_FREE_SPACE', str(1024 * 1024 * 1024)))
+# 空间不足时的淘汰顺序：oldest 最早下载的优先，lru 最久未访问的优先，off 不自动删除
+EVICTION_POLICY = os.getenv('EVICTION_POLICY', 'oldest')
+# 视频保存天数（0 表示不限制），每小时检查一次
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', '0'))
+RETENTION_INTERVAL = 3600
+
+# 进度面板刷新间隔（秒）
+DASHBOARD_INTERVAL = int(os.getenv('DASHBOARD_INTERVAL', '5'))
+
+# 发送消息限速：全局和单个会话每秒最多发送的消息数，以及积压的进度编辑上限
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '20'))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_MAX_LOW = 50
+
+# 频道配置文件及其格式版本，与 telegram_video_downloader.py 共用
+CHANNELS_PATH = os.path.join(DOWNLOAD_PATH, 'channels.json')
+CHANNELS_VERSION = 2
+
+# 存储被监控的频道: 频道 id -> {'username': ..., 'title': ...}
+monitored_channels = {}
+# 旧版本配置中尚未解析为 id 的频道用户名
+legacy_channels = []
+# 按频道 id 过滤频道消息，增删频道时直接更新
+channel_filter = filters.Chat()
 
 # 添加配置文件保存/加载功能
 def save_channels():
-    with open('/root/video/channels.json', 'w') as f:
-        json.dump(list(monitored_channels), f)
-    logger.info(f"保存频道配置: {monitored_channels}")
+    channels = [{'id': chat_id, **info} for chat_id, info in monitored_channels.items()]
+    tmp_path = CHANNELS_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': CHANNELS_VERSION, 'channels': channels}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, CHANNELS_PATH)
+    logger.info(f"保存频道配置: {len(monitored_channels)} 个频道")
 
 def load_channels():
     try:
-        with open('/root/video/channels.json', 'r') as f:
-            channels = json.load(f)
-            monitored_channels.update(channels)
-            logger.info(f"加载频道配置: {monitored_channels}")
+        with open(CHANNELS_PATH, 'r') as f:
+            data = json.load(f)
     except FileNotFoundError:
         logger.info("没有找到频道配置文件")
+        return
+
+    # 第一版配置只是用户名列表，需要联网解析为 id
+    if isinstance(data, list):
+        legacy_channels.extend(data)
+        return
+
+    for channel in data['channels']:
+        channel = dict(channel)
+        chat_id = channel.pop('id')
+        monitored_channels[chat_id] = channel
+        channel_filter.add_chat_ids(chat_id)
+    logger.info(f"加载频道配置: {len(monitored_channels)} 个频道")
+
+async def migrate_channels(bot):
+    """把旧版本配置中的频道用户名解析为稳定的频道 id"""
+    while legacy_channels:
+        username = legacy_channels.pop()
+        try:
+            chat = await bot.get_chat(f"@{username}")
+        except Exception as e:
+            logger.error(f"无法解析频道 @{username}，已从配置中移除: {str(e)}")
+            continue
+        # 重新添加已监控的频道时保留它的过滤规则
+        monitored_channels.setdefault(chat.id, {}).update(username=chat.username, title=chat.title)
+        channel_filter.add_chat_ids(chat.id)
+    save_channels()
+    logger.info(f"频道配置已升级到版本 {CHANNELS_VERSION}")
+
+def channel_label(chat_id):
+    """频道的显示名称"""
+    info = monitored_channels.get(chat_id, {})
+    if info.get('username'):
+        return f"@{info['username']}"
+    return info.get('title') or str(chat_id)
+
+def find_channel(text):
+    """根据用户名、@用户名或 id 查找已监控的频道"""
+    name = text.strip().lstrip('@').lower()
+    for chat_id, info in monitored_channels.items():
+        if str(chat_id) == name or (info.get('username') or '').lower() == name:
+            return chat_id
+    return None
+
+def parse_size(text):
+    """解析 500MB、1.5G、1024 这样的文件大小，单位按 1024 进位"""
+    match = re.fullmatch(r'([\d.]+)\s*([kmgt]?)i?b?', text.strip().lower())
+    if not match:
+        raise ValueError(f"无法解析文件大小: {text}")
+    unit = match.group(2)
+    return int(float(match.group(1)) * 1024 ** ('kmgt'.index(unit) + 1 if unit else 0))
+
+def parse_duration(text):
+    """解析 90、30s、5m、1.5h 这样的时长，返回秒数"""
+    match = re.fullmatch(r'([\d.]+)\s*([smh]?)', text.strip().lower())
+    if not match:
+        raise ValueError(f"无法解析时长: {text}")
+    return int(float(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match.group(2)])
+
+def parse_switch(text):
+    value = text.strip().lower()
+    if value in ('on', 'yes', 'true', '1'):
+        return True
+    if value in ('off', 'no', 'false', '0'):
+        return False
+    raise ValueError(f"请使用 on 或 off: {text}")
+
+# 频道过滤规则: 名称 -> (说明, 解析函数)
+FILTER_RULES = {
+    'min_size': ("最小文件大小，如 10MB", parse_size),
+    'max_size': ("最大文件大小，如 2GB", parse_size),
+    'min_duration': ("最短时长，如 30s、5m", parse_duration),
+    'max_duration': ("最长时长，如 2h", parse_duration),
+    'min_height': ("最低分辨率（画面高度），如 720", int),
+    'max_height': ("最高分辨率（画面高度），如 1080", int),
+    'include': ("文件名需要匹配的通配符，如 *.mkv", str),
+    'exclude': ("文件名不能匹配的通配符，如 *sample*", str),
+    'skip_round': ("跳过圆形视频消息，on/off", parse_switch),
+    'skip_gif': ("跳过 GIF 类的无声短片，on/off", parse_switch),
+}
+
+def format_rule(name, value):
+    if name.endswith('_size'):
+        return f"{name}={format_size(value)}"
+    if name.endswith('_duration'):
+        return f"{name}={value}s"
+    if isinstance(value, bool):
+        return f"{name}={'on' if value else 'off'}"
+    return f"{name}={value}"
+
+def check_rules(rules, size, file_name, duration=None, height=None, round_message=False, animated=False):
+    """在下载前按频道的过滤规则检查视频，需要跳过时返回原因，否则返回 None
+
+    视频没有对应属性（例如缺少时长）时，相关规则不生效。
+    """
+    if not rules:
+        return None
+    if 'min_size' in rules and size < rules['min_size']:
+        return f"文件小于 {format_size(rules['min_size'])}"
+    if 'max_size' in rules and size > rules['max_size']:
+        return f"文件大于 {format_size(rules['max_size'])}"
+    if duration is not None:
+        if 'min_duration' in rules and duration < rules['min_duration']:
+            return f"时长短于 {rules['min_duration']} 秒"
+        if 'max_duration' in rules and duration > rules['max_duration']:
+            return f"时长超过 {rules['max_duration']} 秒"
+    if height:
+        if 'min_height' in rules and height < rules['min_height']:
+            return f"分辨率低于 {rules['min_height']}p"
+        if 'max_height' in rules and height > rules['max_height']:
+            return f"分辨率高于 {rules['max_height']}p"
+    name = file_name.lower()
+    if 'include' in rules and not fnmatch.fnmatch(name, rules['include'].lower()):
+        return f"文件名不匹配 {rules['include']}"
+    if 'exclude' in rules and fnmatch.fnmatch(name, rules['exclude'].lower()):
+        return f"文件名匹配 {rules['exclude']}"
+    if rules.get('skip_round') and round_message:
+        return "圆形视频消息"
+    if rules.get('skip_gif') and animated:
+        return "GIF 类短片"
+    return None
+
+def update_rules(chat_id, args):
+    """按 name=value 参数修改频道的过滤规则，值为空时删除该规则，clear 清空所有规则"""
+    info = monitored_channels[chat_id]
+    rules = dict(info.get('rules', {}))
+    for arg in args:
+        if arg == 'clear':
+            rules.clear()
+            continue
+        name, _, value = arg.partition('=')
+        if name not in FILTER_RULES:
+            raise ValueError(f"未知的规则: {name}")
+        if value:
+            rules[name] = FILTER_RULES[name][1](value)
+        else:
+            rules.pop(name, None)
+    if rules:
+        info['rules'] = rules
+    else:
+        info.pop('rules', None)
+    save_channels()
+
+def describe_rules(chat_id):
+    rules = monitored_channels[chat_id].get('rules')
+    if not rules:
+        return f"{channel_label(chat_id)} 没有过滤规则，所有视频都会下载"
+    return f"{channel_label(chat_id)} 的过滤规则:\n" + "\n".join(
+        f"- {format_rule(name, value)}" for name, value in rules.items()
+    )
+
+FILTER_HELP = (
+    "用法: /filter <频道> [规则=值 ...]\n"
+    "不带规则时查看当前规则，值为空时删除该规则，clear 清空所有规则\n"
+    + "\n".join(f"- {name}: {description}" for name, (description, _) in FILTER_RULES.items())
+)
+
+class StorageStats:
+    """增量维护的存储统计，/status 直接读取，不再遍历下载目录
+
+    启动时用 os.scandir 完整核对一次，之后随下载完成更新。
+    各频道的文件数和大小只统计本次运行期间的下载。
+    """
+
+    def __init__(self, window=THROUGHPUT_WINDOW):
+        self.window = window
+        self.reconciled = False
+        self.total_files = 0
+        self.total_bytes = 0
+        self.channels = {}  # chat_id -> {'files': ..., 'bytes': ...}
+        self.recent = deque()  # (完成时间, chat_id, 本次传输的字节数)
+
+    @staticmethod
+    def scan(root, skip_dirs):
+        """统计 root 下的视频文件数和占用空间，硬链接只计算一次"""
+        files = 0
+        inodes = {}
+        pending = [root]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in skip_dirs:
+                            pending.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and is_video_file(entry.name):
+                        stat = entry.stat(follow_symlinks=False)
+                        files += 1
+                        inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+        return files, sum(inodes.values())
+
+    def load(self, files, total_bytes, channel_totals):
+        self.total_files = files
+        self.total_bytes = total_bytes
+        self.channels = {
+            chat_id: {'files': count, 'bytes': size} for chat_id, count, size in channel_totals
+        }
+        self.reconciled = True
+
+    def _channel(self, chat_id):
+        return self.channels.setdefault(chat_id, {'files': 0, 'bytes': 0})
+
+    def record_download(self, chat_id, size, transferred, new_bytes):
+        """记录一个新文件，new_bytes 为实际新占用的磁盘空间（重复内容为 0）"""
+        self.total_files += 1
+        self.total_bytes += new_bytes
+        channel = self._channel(chat_id)
+        channel['files'] += 1
+        channel['bytes'] += size
+        self.recent.append((time.time(), chat_id, transferred))
+
+    def record_removal(self, freed_bytes):
+        """记录一个被删除的文件，只更新总数，频道统计只包含本次运行的下载"""
+        self.total_files -= 1
+        self.total_bytes -= freed_bytes
+
+    def throughput(self):
+        """最近 window 秒内的平均下载速度，返回 (总速度, {chat_id: 速度})"""
+        cutoff = time.time() - self.window
+        while self.recent and self.recent[0][0] < cutoff:
+            self.recent.popleft()
+        per_channel = {}
+        for _, chat_id, transferred in self.recent:
+            per_channel[chat_id] = per_channel.get(chat_id, 0) + transferred
+        total = sum(per_channel.values())
+        return total / self.window, {chat_id: size / self.window for chat_id, size in per_channel.items()}
+
+storage_stats = StorageStats()
+
+class Metrics:
+    """进程内的计数器、直方图和即时值，以 Prometheus 文本格式输出
+
+    只在内存中累加，记录一次的开销很小，可以在下载热路径上调用。
+    """
+
+    DURATION_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 14400)
+    SPEED_BUCKETS = tuple(2 ** power for power in range(16, 28, 2))  # 64KiB/s - 128MiB/s
+    LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.kinds = {}  # 指标名 -> (类型, 说明, 直方图分桶)
+        self.values = {}  # (指标名, 标签) -> 计数器的值或直方图 [各桶计数, 总和, 次数]
+        self.gauges = {}  # 指标名 -> 返回当前值的函数
+        self.server = None
+
+    def counter(self, name, help_text):
+        self.kinds[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self.kinds[name] = ('histogram', help_text, buckets)
+
+    def gauge(self, name, help_text, func):
+        self.kinds[name] = ('gauge', help_text, None)
+        self.gauges[name] = func
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.kinds[name][2]
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(buckets), 0.0, 0]
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for key, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        """生成 Prometheus 文本格式的全部指标"""
+        lines = []
+        for name, (kind, help_text, buckets) in self.kinds.items():
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if kind == 'gauge':
+                try:
+                    lines.append(f"{full_name} {self.gauges[name]()}")
+                except Exception as e:
+                    logger.error(f"读取指标 {name} 时出错: {str(e)}")
+                continue
+            for (metric, labels), value in self.values.items():
+                if metric != name:
+                    continue
+                if kind == 'counter':
+                    lines.append(f"{full_name}{self._labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{full_name}_bucket{self._labels(labels, [('le', bound)])} {bucket_count}")
+                lines.append(f"{full_name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{full_name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{full_name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            # 读完请求头，只处理 GET /metrics
+            while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        try:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            logger.error(f"无法启动指标接口: {str(e)}")
+            return
+        logger.info(f"Metrics endpoint: http://{host}:{port}/metrics")
+
+    async def watch_loop_lag(self, interval=1.0):
+        """定时测量事件循环的调度延迟"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.observe('event_loop_lag_seconds', max(0.0, loop.time() - expected))
+
+metrics = Metrics('telegram_downloader')
+metrics.counter('downloaded_bytes_total', '各频道本次运行下载的字节数')
+metrics.counter('downloads_total', '按结果统计的下载任务数')
+metrics.histogram('download_duration_seconds', '单个下载的用时', Metrics.DURATION_BUCKETS)
+metrics.histogram('download_speed_bytes_per_second', '单个下载的平均速度', Metrics.SPEED_BUCKETS)
+metrics.histogram('event_loop_lag_seconds', '事件循环的调度延迟', Metrics.LAG_BUCKETS)
+metrics.counter('flood_waits_total', '触发 FloodWait 的次数')
+metrics.counter('flood_wait_seconds_total', 'FloodWait 要求等待的总秒数')
+metrics.counter('outgoing_messages_total', '发送和编辑的消息数')
+metrics.counter('outgoing_dropped_total', '被丢弃的进度编辑数')
+metrics.gauge('active_downloads', '正在进行的下载数', lambda: len(progress_board.transfers))
+metrics.gauge('disk_free_bytes', '下载目录所在磁盘的剩余空间', lambda: shutil.disk_usage(DOWNLOAD_PATH).free)
+metrics.gauge('stored_bytes', '下载目录中视频占用的空间', lambda: storage_stats.total_bytes)
+
+def allocated_bytes(path):
+    """文件已在磁盘上分配的字节数，文件不存在时为 0"""
+    try:
+        return os.stat(path).st_blocks * 512
+    except FileNotFoundError:
+        return 0
+
+# 视频目录和下载目录相同时，统计和清理都跳过这些目录
+STORAGE_SKIP_DIRS = {os.path.join(DOWNLOAD_PATH, name) for name in ('logs', 'session', 'data', 'objects')}
+
+def evict_videos(needed=None, before=None, keep=()):
+    """按淘汰策略删除视频目录中的旧文件
+
+    needed 不为空时释放够这么多空间就停止，before 不为空时只删除修改时间早于它的文件，
+    keep 中的路径（正在下载的文件）不会被删除。返回每个被删文件实际释放的字节数。
+    """
+    videos = []
+    pending = [VIDEO_PATH]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in STORAGE_SKIP_DIRS:
+                    pending.append(entry.path)
+            elif entry.is_file(follow_symlinks=False) and is_video_file(entry.name) and entry.path not in keep:
+                videos.append((entry.path, entry.stat(follow_symlinks=False)))
+    key = (lambda item: item[1].st_atime) if EVICTION_POLICY == 'lru' else (lambda item: item[1].st_mtime)
+    videos.sort(key=key)
+
+    removed = []
+    for path, stat in videos:
+        if needed is not None and sum(removed) >= needed:
+            break
+        if before is not None and stat.st_mtime >= before:
+            continue
+        os.remove(path)
+        removed.append(stat.st_size if stat.st_nlink == 1 else 0)
+        logger.info(f"删除旧视频: {path}")
+    return removed
+
+class DiskGuard:
+    """下载开始前按文件大小预留磁盘空间，空间不够时按淘汰策略删除旧视频"""
+
+    def __init__(self):
+        self.reservations = {}  # 文件路径 -> 文件大小
+        self.lock = None
+
+    def start(self):
+        # 锁需要在应用的事件循环中创建
+        self.lock = asyncio.Lock()
+        self.reservations.clear()
+
+    def shortfall(self, size, file_path):
+        """再预留 size 字节还差多少空间，空间足够时返回 0 或负数"""
+        pending = sum(
+            max(0, reserved - allocated_bytes(path)) for path, reserved in self.reservations.items()
+        )
+        pending += max(0, size - allocated_bytes(file_path))
+        short = MIN_FREE_SPACE + pending - shutil.disk_usage(DOWNLOAD_PATH).free
+        if DISK_QUOTA:
+            reserved = sum(self.reservations.values()) + size
+            short = max(short, storage_stats.total_bytes + reserved - DISK_QUOTA)
+        return short
+
+    async def reserve(self, file_path, size):
+        async with self.lock:
+            short = self.shortfall(size, file_path)
+            if short > 0 and EVICTION_POLICY != 'off':
+                await remove_videos(needed=short)
+                short = self.shortfall(size, file_path)
+            if short > 0:
+                raise OSError(f"磁盘空间不足，还需要 {format_size(short)}")
+            self.reservations[file_path] = size
+
+    def release(self, file_path):
+        self.reservations.pop(file_path, None)
+
+disk_guard = DiskGuard()
+
+async def remove_videos(needed=None, before=None):
+    """在线程池中删除旧视频并更新存储统计"""
+    removed = await asyncio.get_running_loop().run_in_executor(
+        None, evict_videos, needed, before, set(disk_guard.reservations)
+    )
+    for freed in removed:
+        storage_stats.record_removal(freed)
+
+async def retention_loop():
+    """定期删除超过保存天数的视频"""
+    while True:
+        try:
+            await remove_videos(before=time.time() - RETENTION_DAYS * 86400)
+        except Exception as e:
+            logger.error(f"清理旧视频时出错: {str(e)}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+# 部分系统的 mime.types 中没有 mkv
+mimetypes.add_type('video/x-matroska', '.mkv')
+
+def is_video_file(name):
+    """根据扩展名判断是否为下载的视频文件"""
+    mime_type = mimetypes.guess_type(name)[0]
+    return mime_type is not None and mime_type.startswith('video/')
+
+async def reconcile_storage():
+    """启动时完整扫描一次视频目录，之后的统计都增量更新
+
+    和 evict_videos 扫描同一个目录，计入配额的文件都可以被清理。
+    视频目录外的旧文件（平铺存放的视频）不计入，可以用 /migrate 移入视频目录。
+    """
+    loop = asyncio.get_running_loop()
+    files, total_bytes = await loop.run_in_executor(None, StorageStats.scan, VIDEO_PATH, STORAGE_SKIP_DIRS)
+    storage_stats.load(files, total_bytes, [])
+    logger.info(f"存储统计完成: {files} 个文件, {format_size(total_bytes)}")
+
+def migrate_flat_files():
+    """把旧版本平铺在 DOWNLOAD_PATH 下的视频按修改时间移动到 unsorted 目录
+
+    旧文件名中没有频道和消息 id，无法放回对应频道的目录。返回移动的文件数。
+    """
+    moved = 0
+    with os.scandir(DOWNLOAD_PATH) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False) or not is_video_file(entry.name):
+                continue
+            mtime = datetime.fromtimestamp(entry.stat(follow_symlinks=False).st_mtime)
+            new_path = os.path.join(VIDEO_PATH, 'unsorted', f"{mtime.year:04d}", f"{mtime.month:02d}", entry.name)
+            if os.path.exists(new_path):
+                logger.warning(f"迁移目标已存在，跳过: {new_path}")
+                continue
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.rename(entry.path, new_path)
+            moved += 1
+    return moved
+
+def build_file_path(chat_id, channel_username, message_id, file_name, date=None):
+    """按存储布局生成文件路径
+
+    文件名以消息 id 开头，同一频道内不会重复，因此不需要逐个检查文件是否已存在。
+    布局中不含频道时再加上频道 id。
+    """
+    date = date or datetime.now()
+    directory = os.path.join(VIDEO_PATH, STORAGE_LAYOUT.format(
+        channel=channel_username or str(chat_id),
+        year=f"{date.year:04d}",
+        month=f"{date.month:02d}",
+        day=f"{date.day:02d}"
+    ))
+    prefix = f"{message_id}" if '{channel}' in STORAGE_LAYOUT else f"{abs(chat_id)}_{message_id}"
+    return os.path.join(directory, f"{prefix}_{file_name}")
+
+def local_file_path(server_path):
+    """把 Bot API 服务器返回的文件路径换算成本机路径"""
+    if LOCAL_FILES_MAP and '=' in LOCAL_FILES_MAP:
+        server_root, local_root = LOCAL_FILES_MAP.split('=', 1)
+        if server_path.startswith(server_root.rstrip('/') + '/'):
+            return os.path.join(local_root, server_path[len(server_root.rstrip('/')) + 1:])
+    return server_path
+
+def adopt_local_file(source, file_path):
+    """把服务器已下载的文件移动或硬链接到视频目录，不在同一文件系统时退回复制"""
+    try:
+        if LOCAL_FILE_ACTION == 'link':
+            os.link(source, file_path)
+        else:
+            os.rename(source, file_path)
+        return LOCAL_FILE_ACTION
+    except OSError as e:
+        logger.warning(f"无法直接接管 {source} ({str(e)})，改为复制")
+        shutil.copyfile(source, file_path)
+        return 'copy'
+
+def preallocate_file(fd, size):
+    """为文件预先分配空间，文件系统不支持时退化为 ftruncate"""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+def pwrite_all(fd, bufs, offset):
+    """从 offset 开始把 bufs 依次写入文件，处理部分写入的情况"""
+    data = memoryview(b''.join(bufs)) if len(bufs) > 1 else memoryview(bufs[0])
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+class RangeNotSupported(Exception):
+    """服务器忽略了 Range 请求头，返回了整个文件"""
+
+class RangeDownloader:
+    """通过一个复用的 httpx 客户端按字节范围分段并发下载文件
+
+    客户端在整个运行期间只创建一次，连接保持复用，不必为每个文件重新握手。
+    文件先按大小预分配，各分段直接写入自己的位置；某个分段出错时只从它已收到的位置重试这个分段。
+    """
+
+    def __init__(self):
+        self.client = None
+
+    def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=HTTP2,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                    keepalive_expiry=60
+                ),
+                timeout=httpx.Timeout(30.0),
+                follow_redirects=True
+            )
+
+    async def _write(self, fd, bufs, offset, state):
+        # 分段被取消时线程中的写入仍会完成，记录下来以便关闭文件前等待
+        future = asyncio.get_running_loop().run_in_executor(None, pwrite_all, fd, bufs, offset)
+        state['writes'].add(future)
+        future.add_done_callback(state['writes'].discard)
+        await asyncio.shield(future)
+
+    async def _fetch_segment(self, url, fd, offset, length, state):
+        """下载 [offset, offset + length) 并写入文件，失败时从已收到的位置继续"""
+        end = offset + length
+        for attempt in range(HTTP_SEGMENT_RETRIES + 1):
+            try:
+                headers = {'Range': f"bytes={offset}-{end - 1}"}
+                async with self.client.stream('GET', url, headers=headers) as response:
+                    if response.status_code == 200 and (offset > 0 or end < state['total']):
+                        raise RangeNotSupported()
+                    if response.status_code not in (200, 206):
+                        raise httpx.HTTPStatusError(
+                            f"HTTP {response.status_code}", request=response.request, response=response
+                        )
+                    bufs, buffered = [], 0
+                    async for chunk in response.aiter_bytes():
+                        chunk = chunk[:end - offset - buffered]
+                        await bandwidth_shaper.acquire(state['chat_id'], len(chunk))
+                        bufs.append(chunk)
+                        buffered += len(chunk)
+                        if buffered >= 1024 * 1024:
+                            await self._write(fd, bufs, offset, state)
+                            offset += buffered
+                            state['bytes'] += buffered
+                            bufs, buffered = [], 0
+                    if bufs:
+                        await self._write(fd, bufs, offset, state)
+                        offset += buffered
+                        state['bytes'] += buffered
+                if offset < end:
+                    raise httpx.ReadError("分段提前结束")
+                return
+            except httpx.HTTPError as e:
+                # 异常信息中带有包含 token 的地址，日志中只记录异常类型
+                if attempt == HTTP_SEGMENT_RETRIES:
+                    raise OSError(f"分段下载失败: {type(e).__name__}") from None
+                logger.warning(f"分段 {offset}-{end - 1} 下载出错 ({type(e).__name__})，第 {attempt + 1} 次重试")
+                await asyncio.sleep(2 ** attempt)
+
+    async def _fetch_whole(self, url, fd, size, state):
+        """服务器不支持 Range 时顺序下载整个文件，中途出错后只能清空文件从头下载"""
+        state['total'] = 0
+        for attempt in range(HTTP_SEGMENT_RETRIES + 1):
+            state['bytes'] = 0
+            try:
+                await self._fetch_segment(url, fd, 0, size, state)
+                return
+            except RangeNotSupported:
+                # 出错后从中间重试时服务器又返回了整个文件
+                if attempt == HTTP_SEGMENT_RETRIES:
+                    raise OSError("整个文件下载失败次数过多") from None
+                logger.warning(f"服务器不支持从中间继续下载，清空文件从头下载 (第 {attempt + 1} 次)")
+                await asyncio.get_running_loop().run_in_executor(None, os.ftruncate, fd, 0)
+                await asyncio.get_running_loop().run_in_executor(None, preallocate_file, fd, size)
+
+    async def download(self, url, file_path, size, progress_callback=None, chat_id=None):
+        """把 url 下载到 file_path，size 为文件大小，chat_id 为所在频道，用于频道限速"""
+        self.start()
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        state = {'bytes': 0, 'total': size, 'writes': set(), 'chat_id': chat_id}
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, preallocate_file, fd, size)
+            segments = deque(
+                (offset, min(HTTP_SEGMENT_SIZE, size - offset))
+                for offset in range(0, size, HTTP_SEGMENT_SIZE)
+            )
+
+            async def worker():
+                while segments:
+                    offset, length = segments.popleft()
+                    await self._fetch_segment(url, fd, offset, length, state)
+
+            async def report():
+                while True:
+                    await asyncio.sleep(1)
+                    progress_callback(state['bytes'], size)
+
+            reporter = asyncio.create_task(report()) if progress_callback else None
+            workers = [asyncio.create_task(worker()) for _ in range(min(HTTP_CONNECTIONS, len(segments)))]
+            try:
+                await asyncio.gather(*workers)
+            except RangeNotSupported:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                logger.warning("服务器不支持分段下载，改为整个文件顺序下载")
+                await self._fetch_whole(url, fd, size, state)
+            finally:
+                for task in workers:
+                    task.cancel()
+                if reporter:
+                    reporter.cancel()
+        finally:
+            if state['writes']:
+                await asyncio.wait(list(state['writes']))
+            os.close(fd)
+
+range_downloader = RangeDownloader()
+
+async def fetch_video(bot, video, file_path, chat_id=None):
+    """下载视频到 file_path
+
+    本地模式下 get_file 返回的是服务器磁盘上的路径，在本机能访问到时直接接管该文件，
+    否则（服务器在其他机器上）仍通过 HTTP 下载。
+    只有分段下载受限速约束，download_to_drive 和接管本地文件不限速。
+    """
+    if not LOCAL_BOT_API:
+        file = await bot.get_file(video.file_id)
+        size = file.file_size or video.file_size
+        if not size:
+            await file.download_to_drive(custom_path=file_path)
+            return
+        await range_downloader.download(
+            file.file_path, file_path, size,
+            lambda current, total: progress_board.update(video.file_unique_id, current, total),
+            chat_id
+        )
+        return
+
+    file = await bot.get_file(video.file_id, read_timeout=LOCAL_GET_FILE_TIMEOUT)
+    source = local_file_path(file.file_path or '')
+    if source and os.path.isfile(source):
+        action = await asyncio.get_running_loop().run_in_executor(None, adopt_local_file, source, file_path)
+        logger.info(f"接管本地服务器文件 ({action}): {source} -> {file_path}")
+    else:
+        await file.download_to_drive(custom_path=file_path)
 
 # 添加进度条辅助函数
 def create_progress_bar(progress):
@@ -60,40 +851,340 @@ def format_size(size):
     """格式化文件大小"""
     return humanize.naturalsize(size, binary=True)
 
-async def progress_callback(current, total, message, start_time, file_name):
-    """更新下载进度"""
-    try:
+class TokenBucket:
+    """令牌桶，rate 为每秒补充的令牌数，capacity 为允许的突发量"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now, amount=1):
+        """距离 amount 个令牌可用还需等待的秒数"""
+        self._refill(now)
+        return 0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, now, amount=1):
+        self._refill(now)
+        self.tokens -= amount
+
+    def set_rate(self, now, rate, capacity):
+        self._refill(now)
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+
+def parse_schedule(text):
+    """解析 09:00-18:00=20MB,18:00-23:00=50MB 这样的限速时间表，返回 [(开始分钟, 结束分钟, 速度)]"""
+    schedule = []
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)', item)
+        if not match:
+            raise ValueError(f"无法解析限速时间段: {item}")
+        start = int(match.group(1)) * 60 + int(match.group(2))
+        end = int(match.group(3)) * 60 + int(match.group(4))
+        schedule.append((start, end, parse_rate(match.group(5))))
+    return schedule
+
+def parse_rate(text):
+    return 0 if text.strip().lower() in ('off', '0', '') else parse_size(text)
+
+class BandwidthShaper:
+    """下载限速，全局和每个频道各用一个以字节为单位的令牌桶
+
+    全局限速可以按时间段变化。令牌不足一次读取的量时先欠着，之后的读取等待补足，平均速度仍然准确。
+    """
+
+    def __init__(self):
+        self.global_rate = parse_rate(BANDWIDTH_LIMIT)
+        self.schedule = parse_schedule(BANDWIDTH_SCHEDULE)
+        self.buckets = {}
+
+    def current_rate(self, now=None):
+        """当前时间段的全局限速"""
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if start <= minute < end or (start > end and (minute >= start or minute < end)):
+                return rate
+        return self.global_rate
+
+    async def acquire(self, chat_id, amount):
+        """下载 amount 字节之前调用，超过限速时等待"""
+        limits = [('global', self.current_rate())]
+        if chat_id is not None:
+            limits.append((chat_id, monitored_channels.get(chat_id, {}).get('bandwidth', 0)))
+        for key, rate in limits:
+            if not rate:
+                continue
+            now = time.monotonic()
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate, rate)
+            elif bucket.rate != rate:
+                bucket.set_rate(now, rate, rate)
+            while True:
+                wait = bucket.wait_time(now, min(amount, bucket.capacity))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+                now = time.monotonic()
+            bucket.take(now, amount)
+
+bandwidth_shaper = BandwidthShaper()
+
+class OutgoingMessage:
+    """待发送的消息或待执行的编辑"""
+
+    def __init__(self, chat_id, text, priority, message=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.priority = priority
+        self.message = message
+        self.future = asyncio.get_running_loop().create_future()
+
+    @property
+    def edit_key(self):
+        return (self.chat_id, self.message.message_id) if self.message is not None else None
+
+class Outbox:
+    """统一调度所有发出的消息和编辑
+
+    - 按会话和全局两级令牌桶限速
+    - 遇到 FloodWait 时自动暂停，等待结束后重新发送
+    - 同一条消息尚未执行的编辑会被合并，只发送最新的内容
+    - 积压时先发送完成和错误通知，过多的低优先级进度编辑会被丢弃
+    """
+
+    HIGH = 0
+    LOW = 1
+
+    def __init__(self, global_rate, chat_rate, max_low=OUTBOX_MAX_LOW):
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.max_low = max_low
+        self.queues = {self.HIGH: deque(), self.LOW: deque()}
+        self.pending_edits = {}
+        self.flood_until = 0
+        self.bot = None
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+
+    def __len__(self):
+        return sum(len(pending) for pending in self.queues.values())
+
+    def start(self, bot):
+        # 应用只创建一次，重新轮询时沿用同一个事件循环，这里只在首次初始化时调用
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        for pending in self.queues.values():
+            pending.clear()
+        self.pending_edits.clear()
+        return asyncio.create_task(self.run())
+
+    def _enqueue(self, item):
+        pending = self.queues[item.priority]
+        pending.append(item)
+        if item.priority == self.LOW and len(pending) > self.max_low:
+            # 丢弃最旧的进度编辑
+            dropped = pending.popleft()
+            if dropped.edit_key is not None:
+                self.pending_edits.pop(dropped.edit_key, None)
+            dropped.future.set_result(None)
+            metrics.inc('outgoing_dropped_total')
+        self._wakeup.set()
+        return item.future
+
+    def send(self, chat_id, text, priority=HIGH):
+        """排队发送一条新消息，返回的 future 在发送后得到消息对象，被丢弃时为 None"""
+        return self._enqueue(OutgoingMessage(chat_id, text, priority))
+
+    def respond(self, update, text, priority=HIGH):
+        return self.send(update.effective_chat.id, text, priority)
+
+    def edit(self, message, text, priority=LOW):
+        """排队编辑一条消息，同一条消息尚未执行的编辑只保留最新内容"""
+        key = (message.chat_id, message.message_id)
+        pending = self.pending_edits.get(key)
+        if pending is not None:
+            pending.text = text
+            if priority < pending.priority:
+                # 提升优先级，例如进度编辑被完成通知取代
+                self.queues[pending.priority].remove(pending)
+                pending.priority = priority
+                self.queues[priority].append(pending)
+                self._wakeup.set()
+            return pending.future
+        item = OutgoingMessage(message.chat_id, text, priority, message)
+        self.pending_edits[key] = item
+        return self._enqueue(item)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, max(1, self.chat_rate * 3))
+        return bucket
+
+    def _next_item(self, now):
+        """取出下一个可以立即发送的消息，没有时返回 (None, 需要等待的秒数)"""
+        wait = max(0, self.flood_until - now, self.global_bucket.wait_time(now))
+        if wait > 0:
+            return None, wait
+        wait = None
+        for priority in (self.HIGH, self.LOW):
+            pending = self.queues[priority]
+            for item in pending:
+                chat_wait = self._chat_bucket(item.chat_id).wait_time(now)
+                if chat_wait == 0:
+                    pending.remove(item)
+                    return item, 0
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    async def _perform(self, item):
+        if item.message is None:
+            return await self.bot.send_message(chat_id=item.chat_id, text=item.text)
+        try:
+            return await item.message.edit_text(item.text)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+            return item.message
+
+    async def _execute(self, item):
+        try:
+            result = await self._perform(item)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"发送消息触发 FloodWait，暂停 {retry_after} 秒")
+            metrics.inc('flood_waits_total', source='outbox')
+            metrics.inc('flood_wait_seconds_total', retry_after, source='outbox')
+            self.flood_until = max(self.flood_until, time.monotonic() + retry_after)
+            if item.message is not None and self.pending_edits.get(item.edit_key) not in (None, item):
+                # 等待期间已有更新的编辑，这次的内容作废
+                item.future.set_result(None)
+                return
+            if item.edit_key is not None:
+                self.pending_edits[item.edit_key] = item
+            self.queues[item.priority].appendleft(item)
+            self._wakeup.set()
+        except Exception as e:
+            logger.error(f"发送消息时出错: {str(e)}")
+            item.future.set_result(None)
+        else:
+            metrics.inc('outgoing_messages_total', kind='send' if item.message is None else 'edit')
+            item.future.set_result(result)
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            item, wait = self._next_item(now)
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if item.edit_key is not None and self.pending_edits.get(item.edit_key) is item:
+                del self.pending_edits[item.edit_key]
+            self.global_bucket.take(now)
+            self._chat_bucket(item.chat_id).take(now)
+            task = asyncio.create_task(self._execute(item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+outbox = Outbox(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE)
+
+class ProgressBoard:
+    """在内存中记录所有进行中的下载，由单个任务定时把汇总结果编辑到一条面板消息中
+
+    下载过程只更新内存中的状态，不直接发送消息，因此并发下载数再多，
+    每个刷新周期也最多只会编辑一次消息。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.transfers = {}
+        self.message = None
+        self._last_text = None
+
+    def start(self, key, file_name, total, current=0):
+        self.transfers[key] = {
+            'file_name': file_name,
+            'current': current,
+            'total': total,
+            'start_bytes': current,
+            'start_time': time.time(),
+        }
+
+    def update(self, key, current, total):
+        transfer = self.transfers.get(key)
+        if transfer is not None:
+            transfer['current'] = current
+            transfer['total'] = total
+
+    def finish(self, key):
+        self.transfers.pop(key, None)
+
+    def render(self):
+        """生成面板文本"""
         now = time.time()
-        # 每2秒更新一次进度，避免频繁更新
-        if now - progress_callback.last_update < 2:
+        lines = [f"📥 正在下载 ({len(self.transfers)})"]
+        for transfer in self.transfers.values():
+            current, total = transfer['current'], transfer['total']
+            progress = current / total if total else 0
+            elapsed = now - transfer['start_time']
+            speed = (current - transfer['start_bytes']) / elapsed if elapsed > 0 else 0
+            eta = (total - current) / speed if speed > 0 else 0
+
+            bar = create_progress_bar(progress)
+
+            lines.append(
+                f"\n{transfer['file_name']}\n"
+                f"{bar} {progress * 100:.1f}% "
+                f"{format_size(current)}/{format_size(total)} "
+                f"{format_size(speed)}/s 剩余 {int(eta)}秒"
+            )
+        return "\n".join(lines)
+
+    async def _refresh(self):
+        if not self.transfers:
+            if self.message is not None:
+                # 一批下载结束，下次有新下载时发送新的面板消息
+                await outbox.edit(self.message, "✅ 当前没有进行中的下载")
+                self.message = None
+                self._last_text = None
             return
-        progress_callback.last_update = now
 
-        progress = current / total
-        bar = create_progress_bar(progress)
-        percentage = progress * 100
-        
-        # 计算速度和剩余时间
-        elapsed_time = now - start_time
-        speed = current / elapsed_time if elapsed_time > 0 else 0
-        eta = (total - current) / speed if speed > 0 else 0
-        
-        # 格式化消息
-        text = (
-            f"📥 正在下载: {file_name}\n"
-            f"进度: {bar} {percentage:.1f}%\n"
-            f"大小: {format_size(current)}/{format_size(total)}\n"
-            f"速度: {format_size(speed)}/s\n"
-            f"预计剩余时间: {int(eta)}秒"
-        )
-        
-        # 更新消息
-        await message.edit_text(text)
-    except Exception as e:
-        logger.error(f"更新进度时出错: {str(e)}")
+        text = self.render()
+        if text == self._last_text:
+            return
+        if self.message is None:
+            self.message = await outbox.send(ADMIN_USER_ID, text, priority=Outbox.LOW)
+        else:
+            await outbox.edit(self.message, text)
+        self._last_text = text
+
+    async def run(self):
+        """按固定周期刷新面板"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._refresh()
+            except Exception as e:
+                logger.error(f"更新进度面板时出错: {str(e)}")
 
-# 初始化最后更新时间
-progress_callback.last_update = 0
+progress_board = ProgressBoard(DASHBOARD_INTERVAL)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理 /start 命令"""
@@ -101,16 +1192,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if update.effective_user.id != ADMIN_USER_ID:
         logger.warning(f"Unauthorized access attempt from user {update.effective_user.id}")
-        await update.message.reply_text("抱歉，您没有使用此机器人的权限。")
+        await outbox.respond(update, "抱歉，您没有使用此机器人的权限。")
         return
     
     logger.info("Sending welcome message to admin")
-    await update.message.reply_text(
+    await outbox.respond(
+        update,
         "欢迎使用频道视频下载机器人！\n"
         "/add_channel <频道链接> - 添加要监控的频道\n"
         "/remove_channel <频道链接> - 移除监控的频道\n"
         "/list_channels - 列出所有监控的频道\n"
-        "/status - 查看下载状态和统计信息"
+        "/filter <频道链接> [规则=值 ...] - 查看或设置频道的下载过滤规则\n"
+        "/status - 查看下载状态和统计信息\n"
+        "/migrate - 把旧版本平铺存放的视频移动到视频目录"
     )
 
 async def add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -119,7 +1213,7 @@ async def add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if not context.args:
-        await update.message.reply_text("请提供频道用户名，例如: /add_channel @channel_name")
+        await outbox.respond(update, "请提供频道用户名，例如: /add_channel @channel_name")
         return
     
     channel = context.args[0].strip('@')
@@ -127,27 +1221,28 @@ async def add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # 验证频道
         chat = await context.bot.get_chat(f"@{channel}")
         if chat.type != 'channel':
-            await update.message.reply_text("这不是一个频道")
+            await outbox.respond(update, "这不是一个频道")
             return
             
         # 检查机器人权限
         member = await chat.get_member(context.bot.id)
         if not member.status in ['administrator', 'creator']:
-            await update.message.reply_text("请先将机器人添加为频道管理员")
+            await outbox.respond(update, "请先将机器人添加为频道管理员")
             return
         
-        monitored_channels.add(channel)
+        monitored_channels[chat.id] = {'username': chat.username, 'title': chat.title}
+        channel_filter.add_chat_ids(chat.id)
         save_channels()  # 保存配置
-        await update.message.reply_text(f"已成功添加频道: @{channel}\n机器人将自动下载该频道的新视频")
-        logger.info(f"Added channel: @{channel}")
+        await outbox.respond(update, f"已成功添加频道: @{channel}\n机器人将自动下载该频道的新视频")
+        logger.info(f"Added channel: @{channel} ({chat.id})")
         
     except Exception as e:
         error_message = str(e)
         logger.error(f"Failed to add channel {channel}: {error_message}")
         if "Chat not found" in error_message:
-            await update.message.reply_text("找不到该频道，请确保:\n1. 频道用户名正确\n2. 频道是公开的\n3. 机器人已加入该频道")
+            await outbox.respond(update, "找不到该频道，请确保:\n1. 频道用户名正确\n2. 频道是公开的\n3. 机器人已加入该频道")
         else:
-            await update.message.reply_text(f"添加频道失败: {error_message}\n请确保:\n1. 频道用户名正确\n2. 机器人是频道管理员")
+            await outbox.respond(update, f"添加频道失败: {error_message}\n请确保:\n1. 频道用户名正确\n2. 机器人是频道管理员")
 
 async def remove_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """移除监控的频道"""
@@ -155,15 +1250,39 @@ async def remove_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if not context.args:
-        await update.message.reply_text("请提供要移除的频道链接或用户名")
+        await outbox.respond(update, "请提供要移除的频道链接或用户名")
         return
     
-    channel = context.args[0]
-    if channel.strip('@') in monitored_channels:
-        monitored_channels.remove(channel.strip('@'))
-        await update.message.reply_text(f"已移除频道: {channel}")
+    chat_id = find_channel(context.args[0])
+    if chat_id is not None:
+        label = channel_label(chat_id)
+        del monitored_channels[chat_id]
+        channel_filter.remove_chat_ids(chat_id)
+        save_channels()
+        await outbox.respond(update, f"已移除频道: {label}")
     else:
-        await update.message.reply_text("未找到该频道")
+        await outbox.respond(update, "未找到该频道")
+
+async def filter_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看或设置频道的下载过滤规则"""
+    if update.effective_user.id != ADMIN_USER_ID:
+        return
+    
+    if not context.args:
+        await outbox.respond(update, FILTER_HELP)
+        return
+    
+    chat_id = find_channel(context.args[0])
+    if chat_id is None:
+        await outbox.respond(update, "未找到该频道，请先使用 /add_channel 添加")
+        return
+    try:
+        if len(context.args) > 1:
+            update_rules(chat_id, context.args[1:])
+            logger.info(f"更新频道 {channel_label(chat_id)} 的过滤规则: {context.args[1:]}")
+        await outbox.respond(update, describe_rules(chat_id))
+    except ValueError as e:
+        await outbox.respond(update, f"设置过滤规则失败: {str(e)}\n\n{FILTER_HELP}")
 
 async def list_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """列出所有监控的频道"""
@@ -171,68 +1290,76 @@ async def list_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if not monitored_channels:
-        await update.message.reply_text("当前没有监控任何频道")
+        await outbox.respond(update, "当前没有监控任何频道")
         return
     
-    channels_list = "\n".join(f"- {channel}" for channel in monitored_channels)
-    await update.message.reply_text(f"当前监控的频道：\n{channels_list}")
+    channels_list = "\n".join(
+        f"- {channel_label(chat_id)} ({chat_id})" for chat_id in monitored_channels
+    )
+    await outbox.respond(update, f"当前监控的频道：\n{channels_list}")
 
 async def handle_new_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理新消息，下载视频"""
-    logger.info("收到新消息")
-    
     if not update.channel_post:
-        logger.info("不是频道消息，忽略")
         return
     
-    channel_username = update.effective_chat.username
-    logger.info(f"消息来自频道: {channel_username}")
-    
-    if channel_username not in monitored_channels:
-        logger.info(f"频道 {channel_username} 不在监控列表中")
+    # 处理器已按频道 id 过滤，这里只需同步频道改名
+    chat = update.effective_chat
+    info = monitored_channels.get(chat.id)
+    if info is None:
         return
+    if chat.username != info.get('username'):
+        logger.info(f"频道 {chat.id} 用户名变更: {info.get('username')} -> {chat.username}")
+        info['username'] = chat.username
+        info['title'] = chat.title
+        save_channels()
     
     try:
         if update.channel_post.video:
             video = update.channel_post.video
             logger.info(f"检测到视频: {video.file_name}, 大小: {format_size(video.file_size)}")
             
+            post = update.channel_post
+            file_name = os.path.basename((video.file_name or '').replace('\\', '/'))
+            if not file_name:
+                file_name = f"video_{post.message_id}{mimetypes.guess_extension(video.mime_type or '') or '.mp4'}"
+            
+            # 按频道的过滤规则检查，在下载之前跳过不需要的视频
+            duration = video.duration
+            if isinstance(duration, timedelta):
+                duration = duration.total_seconds()
+            reason = check_rules(info.get('rules'), video.file_size, file_name, duration=duration, height=video.height)
+            if reason:
+                logger.info(f"按过滤规则跳过 {file_name}: {reason}")
+                return
+            
             # 修改文件大小限制检查
-            if video.file_size > 50 * 1024 * 1024:  # 50MB
+            if video.file_size > MAX_FILE_SIZE:
                 error_msg = (
                     f"文件太大 ({format_size(video.file_size)})，超过 Telegram Bot API 限制\n"
                     f"建议：\n"
-                    f"1. 使用较小的视频文件（<50MB）\n"
+                    f"1. 使用较小的视频文件（<{format_size(MAX_FILE_SIZE)}）\n"
                     f"2. 或者将视频分段上传\n"
-                    f"3. 或者使用其他下载方式"
+                    f"3. 或者自建 Bot API 服务器并设置 LOCAL_BOT_API=on"
                 )
                 logger.error(error_msg)
-                await context.bot.send_message(
+                outbox.send(
                     chat_id=ADMIN_USER_ID,
                     text=f"❌ 下载失败\n"
-                         f"频道: @{channel_username}\n"
+                         f"频道: {channel_label(chat.id)}\n"
                          f"文件: {video.file_name}\n"
                          f"大小: {format_size(video.file_size)}\n"
-                         f"原因: 文件超过50MB限制"
+                         f"原因: 文件超过{format_size(MAX_FILE_SIZE)}限制"
                 )
                 return
             
-            now = datetime.now().strftime('%Y%m%d_%H%M%S')
-            file_name = video.file_name or f'video_{now}.mp4'
-            file_path = os.path.join(DOWNLOAD_PATH, file_name)
+            file_path = build_file_path(chat.id, chat.username, post.message_id, file_name, post.date)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
             
-            # 确保文件名唯一
-            base_name, ext = os.path.splitext(file_name)
-            counter = 1
-            while os.path.exists(file_path):
-                file_path = os.path.join(DOWNLOAD_PATH, f'{base_name}_{counter}{ext}')
-                counter += 1
+            await disk_guard.reserve(file_path, video.file_size)
             
-            # 发送初始下载消息
-            progress_message = await context.bot.send_message(
-                chat_id=ADMIN_USER_ID,
-                text=f"开始下载视频: {file_name}\n大小: {format_size(video.file_size)}"
-            )
+            # 进度只记录在面板中，不再逐个编辑消息
+            progress_board.start(video.file_unique_id, file_name, video.file_size)
             
             try:
                 # 记录开始时间
@@ -240,33 +1367,29 @@ async def handle_new_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 
                 # 下载视频
                 logger.info(f'开始下载视频: {file_path}')
-                file = await context.bot.get_file(video.file_id)
-                await file.download_to_drive(
-                    custom_path=file_path,
-                    progress_callback=lambda current, total: asyncio.create_task(
-                        progress_callback(
-                            current, total, progress_message, 
-                            start_time, file_name
-                        )
-                    )
-                )
+                await fetch_video(context.bot, video, file_path, chat.id)
                 
                 # 下载完成后的处理
                 file_size = os.path.getsize(file_path)
+                storage_stats.record_download(chat.id, file_size, file_size, file_size)
                 duration = time.time() - start_time
                 average_speed = file_size / duration if duration > 0 else 0
+                metrics.inc('downloaded_bytes_total', file_size, channel=channel_label(chat.id))
+                metrics.inc('downloads_total', result='completed')
+                metrics.observe('download_duration_seconds', duration)
+                metrics.observe('download_speed_bytes_per_second', average_speed)
                 
                 # 发送完成消息
                 complete_message = (
                     f"✅ 视频下载完成\n"
-                    f"频道: @{channel_username}\n"
+                    f"频道: {channel_label(chat.id)}\n"
                     f"文件: {file_name}\n"
                     f"大小: {format_size(file_size)}\n"
                     f"用时: {int(duration)}秒\n"
                     f"平均速度: {format_size(average_speed)}/s"
                 )
                 
-                await progress_message.edit_text(complete_message)
+                outbox.send(chat_id=ADMIN_USER_ID, text=complete_message)
                 logger.info(f'视频下载完成: {file_path} ({format_size(file_size)})')
                 
             except Exception as e:
@@ -274,6 +1397,9 @@ async def handle_new_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 if os.path.exists(file_path):
                     os.remove(file_path)
                 raise e
+            finally:
+                progress_board.finish(video.file_unique_id)
+                disk_guard.release(file_path)
                 
         else:
             logger.info("消息中没有视频")
@@ -281,10 +1407,11 @@ async def handle_new_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except Exception as e:
         error_message = f"下载视频时出错: {str(e)}"
         logger.error(error_message)
+        metrics.inc('downloads_total', result='failed')
         # 通知管理员出错
-        await context.bot.send_message(
+        outbox.send(
             chat_id=ADMIN_USER_ID,
-            text=f"❌ 下载失败\n频道: @{channel_username}\n错误: {str(e)}"
+            text=f"❌ 下载失败\n频道: {channel_label(chat.id)}\n错误: {str(e)}"
         )
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -293,20 +1420,101 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        # 获取下载目录的统计信息
-        total_files = len([f for f in os.listdir(DOWNLOAD_PATH) if os.path.isfile(os.path.join(DOWNLOAD_PATH, f))])
-        total_size = sum(os.path.getsize(os.path.join(DOWNLOAD_PATH, f)) for f in os.listdir(DOWNLOAD_PATH) if os.path.isfile(os.path.join(DOWNLOAD_PATH, f)))
+        if storage_stats.reconciled:
+            storage_lines = (
+                f"已下载文件数: {storage_stats.total_files}\n"
+                f"总存储大小: {format_size(storage_stats.total_bytes)}"
+                + (f" / {format_size(DISK_QUOTA)}" if DISK_QUOTA else "") + "\n"
+            )
+        else:
+            storage_lines = "存储统计: 正在扫描下载目录...\n"
+        storage_lines += f"磁盘剩余空间: {format_size(shutil.disk_usage(DOWNLOAD_PATH).free)}\n"
+
+        speed, channel_speeds = storage_stats.throughput()
+        channel_lines = "".join(
+            f"\n- {channel_label(chat_id)}: "
+            f"{storage_stats.channels.get(chat_id, {}).get('files', 0)} 个文件, "
+            f"{format_size(storage_stats.channels.get(chat_id, {}).get('bytes', 0))}, "
+            f"{format_size(channel_speeds.get(chat_id, 0))}/s"
+            for chat_id in monitored_channels
+        )
         
         status_message = (
             "📊 下载统计信息\n"
             f"监控的频道数: {len(monitored_channels)}\n"
-            f"已下载文件数: {total_files}\n"
-            f"总存储大小: {total_size / 1024 / 1024:.2f} MB\n"
-            f"存储路径: {DOWNLOAD_PATH}"
+            + storage_lines +
+            f"存储路径: {VIDEO_PATH}\n"
+            f"Bot API: {'本地服务器' if LOCAL_BOT_API else '公共服务器'}，单个文件上限 {format_size(MAX_FILE_SIZE)}\n"
+            f"最近 {THROUGHPUT_WINDOW // 60} 分钟下载速度: {format_size(speed)}/s"
+            + (f"\n\n本次运行各频道统计:{channel_lines}" if channel_lines else "")
         )
-        await update.message.reply_text(status_message)
+        await outbox.respond(update, status_message)
     except Exception as e:
-        await update.message.reply_text(f"获取状态信息时出错: {str(e)}")
+        await outbox.respond(update, f"获取状态信息时出错: {str(e)}")
+
+async def migrate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """把旧版本平铺存放的视频移动到视频目录"""
+    if update.effective_user.id != ADMIN_USER_ID:
+        return
+
+    try:
+        await outbox.respond(update, "开始迁移平铺存放的视频...")
+        moved = await asyncio.get_running_loop().run_in_executor(None, migrate_flat_files)
+        # 移入视频目录的文件开始计入存储统计
+        await reconcile_storage()
+        await outbox.respond(update, f"迁移完成，共移动 {moved} 个文件到 {VIDEO_PATH}")
+        logger.info(f"迁移了 {moved} 个文件")
+    except Exception as e:
+        await outbox.respond(update, f"迁移失败: {str(e)}")
+        logger.error(f"Failed to migrate: {str(e)}")
+
+# 后台任务，事件循环只保留任务的弱引用，这里保留引用避免运行中被回收
+background_tasks = set()
+
+def keep_task(task):
+    background_tasks.add(task)
+    task.add_done_callback(background_task_done)
+    return task
+
+def background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"后台任务 {task.get_coro().__name__} 出错: {str(task.exception())}")
+
+async def post_init(application: Application):
+    """应用初始化完成后启动消息发送调度、进度面板和存储统计"""
+    if legacy_channels:
+        await migrate_channels(application.bot)
+    if outbox.bot is not None:
+        # 重新轮询时后台任务仍在同一个事件循环中运行，不需要再次启动
+        return
+    keep_task(outbox.start(application.bot))
+    disk_guard.start()
+    range_downloader.start()
+    keep_task(asyncio.create_task(progress_board.run()))
+    if not storage_stats.reconciled:
+        keep_task(asyncio.create_task(reconcile_storage()))
+    if RETENTION_DAYS:
+        keep_task(asyncio.create_task(retention_loop()))
+    keep_task(asyncio.create_task(metrics.watch_loop_lag()))
+    if METRICS_PORT:
+        keep_task(asyncio.create_task(metrics.serve(METRICS_HOST, METRICS_PORT)))
+
+def register_handlers(application):
+    """注册命令处理器和频道消息处理器"""
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("add_channel", add_channel))
+    application.add_handler(CommandHandler("remove_channel", remove_channel))
+    application.add_handler(CommandHandler("list_channels", list_channels))
+    application.add_handler(CommandHandler("filter", filter_rules))
+    application.add_handler(CommandHandler("status", status))
+    application.add_handler(CommandHandler("migrate", migrate))
+    
+    # 注册消息处理器
+    application.add_handler(MessageHandler(
+        filters.ChatType.CHANNEL & channel_filter & (filters.VIDEO | filters.FORWARDED),
+        handle_new_message
+    ))
 
 def main():
     """启动机器人"""
@@ -314,49 +1522,43 @@ def main():
     load_channels()  # 加载保存的频道配置
     logger.info(f"Admin ID: {ADMIN_USER_ID}")
     logger.info(f"Download path: {DOWNLOAD_PATH}")
-    logger.info(f"Monitored channels: {monitored_channels}")
+    logger.info(f"Bot API: {BASE_URL}" + (" (local mode)" if LOCAL_BOT_API else ""))
+    logger.info(f"Monitored channels: {len(monitored_channels)}")
+    
+    # 应用只创建一次，网络出错后重新轮询时复用它的连接池和事件循环
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BASE_URL)
+        .base_file_url(BASE_FILE_URL)
+        .local_mode(LOCAL_BOT_API)
+        .connect_timeout(30.0)
+        .read_timeout(30.0)
+        .write_timeout(30.0)
+        .pool_timeout(30.0)
+        .get_updates_read_timeout(30.0)
+        .post_init(post_init)
+        .build()
+    )
+    logger.info("Application built successfully")
+    
+    register_handlers(application)
+    logger.info("All handlers registered")
     
     while True:
         try:
-            # 每次循环创建新的应用实例
-            application = (
-                Application.builder()
-                .token(BOT_TOKEN)
-                .connect_timeout(30.0)
-                .read_timeout(30.0)
-                .write_timeout(30.0)
-                .pool_timeout(30.0)
-                .get_updates_read_timeout(30.0)
-                .build()
-            )
-            
-            logger.info("Application built successfully")
-            
-            # 注册命令处理器
-            application.add_handler(CommandHandler("start", start))
-            application.add_handler(CommandHandler("add_channel", add_channel))
-            application.add_handler(CommandHandler("remove_channel", remove_channel))
-            application.add_handler(CommandHandler("list_channels", list_channels))
-            application.add_handler(CommandHandler("status", status))
-            
-            # 注册消息处理器
-            application.add_handler(MessageHandler(
-                filters.ChatType.CHANNEL & (filters.VIDEO | filters.FORWARDED),
-                handle_new_message
-            ))
-            
-            logger.info("All handlers registered")
-            
             # 启动轮询
             logger.info("Starting polling...")
             application.run_polling(
                 allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True,
+                # 保留停机期间积压的更新，重启后补下载这段时间发布的视频
+                drop_pending_updates=False,
                 timeout=30,
                 read_timeout=30,
                 write_timeout=30,
                 connect_timeout=30,
-                pool_timeout=30
+                pool_timeout=30,
+                close_loop=False
             )
             
         except (TimedOut, NetworkError) as e:
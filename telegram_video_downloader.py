@@ -2,21 +2,33 @@ import os
 import asyncio
 from datetime import datetime
 import logging
-from telethon import TelegramClient, events
+import logging.handlers
+import atexit
+import contextlib
+from telethon import TelegramClient, events, functions, errors, types, utils
+from telethon.network import MTProtoSender
 import humanize
+import hashlib
 import json
+import re
+import fnmatch
+import mimetypes
+import math
+import sqlite3
+import queue
+import random
+import heapq
+import itertools
+import shutil
+import threading
 import time
-
-# 配置日志
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('/root/video/logs/bot.log'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import boto3  # 上传到对象存储需要安装: pip install boto3
+    from botocore.config import Config as BotoConfig
+except ImportError:
+    boto3 = None
 
 # Telegram Bot配置
 BOT_TOKEN = os.getenv('BOT_TOKEN', '7701103060:AAEfjw6DUzRT3XSQwcTRROL2Q1I8Dkv1PKI')
@@ -27,263 +39,3716 @@ API_ID = 2040
 API_HASH = "b18441a1ff607e10a989891a5462e627"
 
 # 视频保存路径
-DOWNLOAD_PATH = '/root/video'
-os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+DOWNLOAD_PATH = os.getenv('DOWNLOAD_PATH', '/root/video')
+os.makedirs(os.path.join(DOWNLOAD_PATH, 'logs'), exist_ok=True)
+
+# 配置日志：事件循环中只把日志放入队列，由单独的线程写入文件和控制台，磁盘慢时不会阻塞下载
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.FileHandler(os.path.join(DOWNLOAD_PATH, 'logs', 'bot.log')),
+    logging.StreamHandler()
+)
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO,
+    handlers=[logging.handlers.QueueHandler(log_queue)]
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
 
 # session 文件路径
-SESSION_PATH = '/root/video/session/bot_session'
+SESSION_PATH = os.path.join(DOWNLOAD_PATH, 'session', 'bot_session')
 
-# 存储被监控的频道
-monitored_channels = set()
+# 数据目录：续传记录等运行数据
+DATA_PATH = os.path.join(DOWNLOAD_PATH, 'data')
+JOURNAL_PATH = os.path.join(DATA_PATH, 'journals')
+os.makedirs(JOURNAL_PATH, exist_ok=True)
+# 续传记录的最短保存间隔（秒）
+JOURNAL_SAVE_INTERVAL = 5
+# 写入配置：排队等待写盘的数据上限，以及单次合并写入的最大字节数
+WRITE_BUFFER_SIZE = int(os.getenv('WRITE_BUFFER_SIZE', str(64 * 1024 * 1024)))
+WRITE_COALESCE_SIZE = 8 * 1024 * 1024
+# fsync 策略: interval 每次保存续传记录前同步，always 每次写入后同步，
+# none 不主动同步（只能防止进程崩溃，断电时续传记录可能不可靠）
+FSYNC_POLICY = os.getenv('FSYNC_POLICY', 'interval')
+# 视频存放目录和分层布局，布局中可以使用 {channel} {year} {month} {day}
+# 视频目录必须和内容寻址存储目录在同一个文件系统上
+VIDEO_PATH = os.getenv('VIDEO_PATH', os.path.join(DOWNLOAD_PATH, 'videos'))
+STORAGE_LAYOUT = os.getenv('STORAGE_LAYOUT', '{channel}/{year}/{month}')
 
-# 保存和加载频道配置
-def save_channels():
-    with open('/root/video/channels.json', 'w') as f:
-        json.dump(list(monitored_channels), f)
-    logger.info(f"保存频道配置: {monitored_channels}")
+# 内容寻址存储目录，按内容哈希保存文件，可读的文件名都是指向这里的硬链接
+OBJECTS_PATH = os.path.join(DOWNLOAD_PATH, 'objects')
+os.makedirs(OBJECTS_PATH, exist_ok=True)
+# 下载记录数据库
+LEDGER_PATH = os.path.join(DATA_PATH, 'ledger.db')
+# 遇到已下载过的视频时的处理方式：skip 跳过，link 为新消息创建硬链接
+DUPLICATE_ACTION = os.getenv('DUPLICATE_ACTION', 'skip')
 
-def load_channels():
+# 磁盘配额（字节，0 表示不限制）和下载时需要保留的最小剩余空间
+DISK_QUOTA = int(os.getenv('DISK_QUOTA', '0'))
+MIN_FREE_SPACE = int(os.getenv('MIN_FREE_SPACE', str(1024 * 1024 * 1024)))
+# 空间不足时的淘汰顺序：oldest 最早下载的优先，lru 最久未访问的优先，off 不自动删除
+EVICTION_POLICY = os.getenv('EVICTION_POLICY', 'oldest')
+# 保留策略：视频保存天数和单个频道的空间上限（0 表示不限制），每小时检查一次
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', '0'))
+CHANNEL_QUOTA = int(os.getenv('CHANNEL_QUOTA', '0'))
+RETENTION_INTERVAL = 3600
+
+# S3 兼容对象存储：设置 S3_BUCKET 后下载的数据同时以分段上传（multipart upload）写入存储桶，
+# 访问密钥使用 boto3 的标准配置（AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY）
+S3_BUCKET = os.getenv('S3_BUCKET', '')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL', '') or None
+S3_REGION = os.getenv('S3_REGION', 'us-east-1')
+S3_PREFIX = os.getenv('S3_PREFIX', '').strip('/')
+# 上传分片大小（S3 要求除最后一片外不小于 5 MiB，这里还要是下载分段的整数倍）、
+# 同时上传的分片数和每个下载在内存中最多保留的分片数
+S3_PART_SIZE = max(5 * 1024 * 1024, int(os.getenv('S3_PART_SIZE', str(8 * 1024 * 1024))))
+S3_UPLOAD_CONCURRENCY = int(os.getenv('S3_UPLOAD_CONCURRENCY', '4'))
+S3_MAX_BUFFERS = int(os.getenv('S3_MAX_BUFFERS', '8'))
+# 是否同时保留本地副本，关闭后视频只保存在对象存储中
+S3_KEEP_LOCAL = not S3_BUCKET or os.getenv('S3_KEEP_LOCAL', 'on').lower() in ('1', 'on', 'true', 'yes')
+
+# 下载并发配置：同时下载的任务数和排队任务上限
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '3'))
+DOWNLOAD_QUEUE_SIZE = int(os.getenv('DOWNLOAD_QUEUE_SIZE', '200'))
+
+# 下载调度：不超过 SMALL_FILE_SIZE 的视频算作小文件，其中 SMALL_FILE_SLOTS 个下载槽位只处理小文件
+SMALL_FILE_SIZE = int(os.getenv('SMALL_FILE_SIZE', str(50 * 1024 * 1024)))
+SMALL_FILE_SLOTS = int(os.getenv('SMALL_FILE_SLOTS', '1'))
+# 任务每排队一秒，按少 QUEUE_AGING_RATE 字节计算，避免大文件一直排在小文件后面
+QUEUE_AGING_RATE = int(os.getenv('QUEUE_AGING_RATE', str(1024 * 1024)))
+# 频道优先级，每高一级文件大小按一半计算
+PRIORITY_LEVELS = {'low': -1, 'normal': 0, 'high': 1}
+
+# 下载限速（每秒字节数，如 20MB，0 表示不限制）：全局、补抓历史消息的任务，
+# 以及按时间段覆盖全局限速的时间表，如 09:00-18:00=20MB,18:00-23:00=50MB
+BANDWIDTH_LIMIT = os.getenv('BANDWIDTH_LIMIT', '0')
+BACKFILL_BANDWIDTH = os.getenv('BACKFILL_BANDWIDTH', '0')
+BANDWIDTH_SCHEDULE = os.getenv('BANDWIDTH_SCHEDULE', '')
+
+# 分段并行下载配置：每个下载使用的连接数，以及启用分段下载的最小文件大小
+PARALLEL_CONNECTIONS = int(os.getenv('PARALLEL_CONNECTIONS', '4'))
+PARALLEL_MIN_SIZE = int(os.getenv('PARALLEL_MIN_SIZE', str(20 * 1024 * 1024)))
+# upload.GetFile 单次请求的最大字节数
+PART_SIZE = 512 * 1024
+PART_RETRIES = 5
+
+# 额外的下载会话：逗号分隔的机器人 token，这些机器人需要是被监控频道的成员
+# 配置后主会话只负责监听消息和处理命令，下载优先分配给这些会话
+WORKER_BOT_TOKENS = [token.strip() for token in os.getenv('WORKER_BOT_TOKENS', '').split(',') if token.strip()]
+# 会话触发超过这么多秒的 FloodWait 时，把下载切换到其它会话
+FLOOD_FAILOVER_SECONDS = int(os.getenv('FLOOD_FAILOVER_SECONDS', '30'))
+# 会话断开后暂停分配任务的时间（秒）
+SESSION_RETRY_DELAY = 30
+
+# 下载连接池：启动时为每个被监控频道所在的 DC 预先建立的连接数（0 表示不预热），
+# 空闲连接保留的时间（秒），以及检查空闲连接的间隔（秒）
+MEDIA_POOL_WARM = int(os.getenv('MEDIA_POOL_WARM', str(PARALLEL_CONNECTIONS)))
+MEDIA_POOL_IDLE_TIMEOUT = int(os.getenv('MEDIA_POOL_IDLE_TIMEOUT', '300'))
+MEDIA_POOL_CHECK_INTERVAL = 60
+
+# /status 中统计最近下载速度的时间窗口（秒）
+THROUGHPUT_WINDOW = 600
+
+# 指标接口：设置端口后在 http://METRICS_HOST:METRICS_PORT/metrics 以 Prometheus 格式输出运行指标，0 表示关闭
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# 下载时间线：开启后每个下载的各阶段和每个分段的耗时写入视频旁边的 .trace.jsonl，用 /perf 查看汇总
+TRACE_DOWNLOADS = os.getenv('TRACE_DOWNLOADS', 'off').lower() in ('1', 'on', 'true', 'yes')
+
+# 进度面板刷新间隔（秒）
+DASHBOARD_INTERVAL = int(os.getenv('DASHBOARD_INTERVAL', '5'))
+
+# 发送消息限速：全局和单个会话每秒最多发送的消息数，以及积压的进度编辑上限
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '20'))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_MAX_LOW = 50
+
+# 补抓历史消息：每批请求的消息数和同时进行的批次数
+BACKFILL_BATCH_SIZE = 100
+BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', '4'))
+# /backfill 未指定数量时补抓的消息数
+BACKFILL_DEFAULT_LIMIT = 200
+
+# 频道配置文件及其格式版本
+CHANNELS_PATH = os.path.join(DOWNLOAD_PATH, 'channels.json')
+CHANNELS_VERSION = 2
+
+# 存储被监控的频道: 频道 id（带 -100 前缀的 peer id）-> {'username': ..., 'title': ...}
+monitored_channels = {}
+
+class DownloadTrace:
+    """记录一个下载各阶段的时间线，开启 TRACE_DOWNLOADS 时在下载结束后写成 JSONL
+
+    每条记录包含阶段名 span、相对任务入队时间的开始时间 t 和持续时间 dur（秒）。
+    未开启时 event 直接返回，下载热路径上只多几次 time.time() 调用。
+    """
+
+    def __init__(self, enabled=False, origin=None):
+        self.enabled = enabled
+        self.origin = origin if origin is not None else time.time()
+        self.events = []
+
+    def event(self, span, start=None, duration=0.0, **fields):
+        # 也会从 FileSink 的写入线程调用，list.append 本身是线程安全的
+        if not self.enabled:
+            return
+        start = time.time() if start is None else start
+        record = {'span': span, 't': round(start - self.origin, 6), 'dur': round(duration, 6)}
+        record.update(fields)
+        self.events.append(record)
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.event(name, start, time.time() - start, **fields)
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in self.events:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, path)
+
+def trace_file(file_path):
+    """下载的时间线文件，与视频放在一起"""
+    return file_path + '.trace.jsonl'
+
+def percentile(values, q):
+    """最近秩百分位数，values 需已排序"""
+    if not values:
+        return 0
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+# 各阶段的名称和耗时最长时的调优建议
+TRACE_PHASES = {
+    'queue': ("排队", "增加 DOWNLOAD_WORKERS，或用 /priority 提前重要的视频"),
+    'reserve': ("预留磁盘空间", "下载前淘汰旧视频耗时过长，提高 DISK_QUOTA 或缩短 RETENTION_DAYS"),
+    'session': ("准备会话", "工作会话重新获取消息较慢，检查 WORKER_BOT_TOKENS 对应的机器人"),
+    'connect': ("连接媒体 DC", "小文件可以提高 PARALLEL_MIN_SIZE 走已有的单个连接"),
+    'network': ("分段请求", "网络延迟是瓶颈，可以增加 PARALLEL_CONNECTIONS"),
+    'throttle': ("限速等待", "受下载限速约束，用 /limit 调整"),
+    'storage': ("等待写盘", "磁盘写入或上传跟不上下载，检查存储性能或调整 FSYNC_POLICY、WRITE_BUFFER_SIZE、S3_UPLOAD_CONCURRENCY"),
+    'refresh': ("刷新文件引用", "文件引用频繁过期，通常是任务排队太久"),
+    'flood': ("FloodWait", "请求过于频繁，减少 PARALLEL_CONNECTIONS 或配置更多 WORKER_BOT_TOKENS"),
+    'finalize': ("完成处理", "入库（硬链接）和清理耗时过长，检查存储性能"),
+}
+
+def summarize_trace(events, name):
+    """汇总一个下载的时间线：各阶段耗时、分段延迟百分位和主要耗时阶段"""
+    spans = {}
+    for record in events:
+        spans.setdefault(record['span'], []).append(record)
+    chunks = spans.get('chunk', [])
+    done = (spans.get('done') or spans.get('error') or [events[-1]])[-1]
+    total = done['t'] + done['dur']
+
+    # 各分段内部的请求、限速和写盘等待按比例折算到传输阶段的实际用时
+    phases = {
+        key: sum(record['dur'] for record in spans.get(key, []))
+        for key in ('queue', 'reserve', 'session', 'connect', 'refresh', 'finalize')
+    }
+    phases['flood'] = sum(record.get('seconds', 0) for record in spans.get('flood', []))
+    if chunks:
+        transfer = max(r['t'] + r['dur'] for r in chunks) - min(r['t'] for r in chunks)
+        parts = {
+            'network': sum(r['request'] for r in chunks),
+            'throttle': sum(r['throttle'] for r in chunks),
+            'storage': sum(r['write_wait'] for r in chunks),
+        }
+        busy = sum(parts.values()) or 1
+        for key, value in parts.items():
+            phases[key] = transfer * value / busy
+    dominant = max(phases, key=phases.get)
+
+    size = sum(r['bytes'] for r in chunks)
+    requests = sorted(r['request'] * 1000 for r in chunks)
+    disk = sorted(r['dur'] * 1000 for r in spans.get('disk_write', []))
+    fsync = sum(r['dur'] for r in spans.get('fsync', []))
+    first_byte = spans.get('first_byte', [None])[0]
+    connections = spans.get('connect', [{}])[-1].get('connections', 1)
+
+    lines = [
+        f"📈 下载分析: {name}",
+        f"总用时: {total:.1f}秒, 本次下载 {format_size(size)}"
+        + (f", 平均 {format_size(size / total)}/s" if total > 0 else "")
+        + f", 连接数 {connections}",
+    ]
+    if first_byte is not None:
+        lines.append(f"首字节: 入队后 {first_byte['t']:.2f}秒")
+    lines.append("\n各阶段耗时:")
+    for key, seconds in sorted(phases.items(), key=lambda item: -item[1]):
+        if seconds >= 0.01:
+            share = seconds / total * 100 if total > 0 else 0
+            lines.append(f"- {TRACE_PHASES[key][0]}: {seconds:.2f}秒 ({share:.0f}%)")
+    if requests:
+        lines.append(
+            f"\n分段请求 ({len(requests)} 个) 延迟: "
+            f"p50 {percentile(requests, 0.5):.0f}ms, p90 {percentile(requests, 0.9):.0f}ms, "
+            f"p99 {percentile(requests, 0.99):.0f}ms, 最大 {requests[-1]:.0f}ms"
+        )
+    if disk:
+        lines.append(
+            f"磁盘写入 ({len(disk)} 次): p50 {percentile(disk, 0.5):.1f}ms, "
+            f"p99 {percentile(disk, 0.99):.1f}ms, fsync 共 {fsync:.2f}秒"
+        )
+    retries = len(spans.get('retry', []))
+    if retries:
+        lines.append(f"分段重试: {retries} 次")
+    if phases[dominant] > 0:
+        lines.append(f"\n主要耗时: {TRACE_PHASES[dominant][0]}，建议: {TRACE_PHASES[dominant][1]}")
+    return "\n".join(lines)
+
+def find_trace(query):
+    """在视频目录中查找文件名包含 query 的时间线文件，有多个时返回最新的"""
+    matches = []
+    for root, _, names in os.walk(VIDEO_PATH):
+        for name in names:
+            if name.endswith('.trace.jsonl') and query in name:
+                path = os.path.join(root, name)
+                matches.append((os.path.getmtime(path), path))
+    return max(matches)[1] if matches else None
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class DownloadJob:
+    """一个待下载的视频任务"""
+
+    def __init__(self, chat_id, channel_username, message_id, document, file_name, date=None):
+        self.chat_id = chat_id
+        self.channel_username = channel_username
+        self.message_id = message_id
+        self.document = document
+        self.file_name = file_name
+        self.date = date
+        self.file_size = document.size
+        # 该任务使用的并行连接数，小文件走单连接
+        self.connections = PARALLEL_CONNECTIONS if self.file_size >= PARALLEL_MIN_SIZE else 1
+        self.enqueued_at = time.time()
+        # 管理员用 /priority 提升的任务排在所有任务之前
+        self.bumped = False
+        # 补抓历史消息产生的任务，受补抓限速约束
+        self.backfill = False
+        # 开始下载时确定，续传的任务从记录中恢复
+        self.file_path = None
+        self.journal = None
+        self.trace = DownloadTrace()
+        # 属于相册时为所在的 AlbumBatch
+        self.album = None
+
+    @classmethod
+    def from_journal(cls, journal):
+        """根据续传记录重建任务"""
+        data = journal.data
+        document = types.Document(
+            id=data['document_id'],
+            access_hash=data['access_hash'],
+            file_reference=bytes.fromhex(data['file_reference']),
+            date=None,
+            mime_type=data['mime_type'],
+            size=data['size'],
+            dc_id=data['dc_id'],
+            attributes=[]
+        )
+        job = cls(data['chat_id'], data['channel_username'], data['message_id'], document, data['file_name'])
+        job.file_path = data['file_path']
+        job.journal = journal
+        return job
+
+def schedule_key(job):
+    """任务在所在频道内的调度顺序，越小越先下载
+
+    剩余大小减去排队时间的折算量。所有任务按同样的速度老化，
+    所以只要在入队时加上 enqueued_at * QUEUE_AGING_RATE，顺序就不会随时间变化。
+    """
+    remaining = job.file_size - (job.journal.completed_bytes() if job.journal else 0)
+    return (not job.bumped, remaining + job.enqueued_at * QUEUE_AGING_RATE)
+
+class QueuedChannel:
+    """下载队列中一个频道的任务，小文件和大文件分别放在两个堆中"""
+
+    def __init__(self, served, turn):
+        self.small = []  # [(调度顺序, 序号, DownloadJob)]
+        self.large = []
+        self.served = served  # 按优先级折算的已出队任务数，越少越先轮到
+        self.turn = turn  # 服务量相同时按上次轮到的先后
+
+    def __len__(self):
+        return len(self.small) + len(self.large)
+
+    def top(self, small_only=False):
+        """调度顺序最靠前的任务所在的堆，没有任务时返回 None"""
+        heaps = [heap for heap in ((self.small,) if small_only else (self.small, self.large)) if heap]
+        return min(heaps, key=lambda heap: heap[0][:2]) if heaps else None
+
+class DownloadQueue:
+    """有界下载队列：频道之间按优先级加权轮流出队，频道内按剩余大小和排队时间
+
+    单个频道涌入大量任务时其它频道仍能轮到；优先级每高一级，轮到的次数多一倍。
+    用 /priority 提升的任务排在所有任务之前。预留给小文件的下载槽位只从小文件堆中取任务，
+    因此小文件不会全部堵在大文件后面。
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._channels = {}  # chat_id -> QueuedChannel
+        self._size = 0
+        self._served = 0  # 最近出队的频道的服务量，新加入的频道从这里开始
+        self._seq = itertools.count()
+        self._cond = asyncio.Condition()
+
+    def __len__(self):
+        return self._size
+
+    def small_count(self):
+        return sum(len(channel.small) for channel in self._channels.values())
+
+    async def put(self, job):
+        """加入任务，队列已满时等待"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._size < self.maxsize)
+            channel = self._channels.get(job.chat_id)
+            if channel is None:
+                # 新加入的频道不能凭空积攒轮次
+                served = min((channel.served for channel in self._channels.values()), default=self._served)
+                channel = self._channels[job.chat_id] = QueuedChannel(served, next(self._seq))
+            heap = channel.small if job.file_size <= SMALL_FILE_SIZE else channel.large
+            heapq.heappush(heap, (schedule_key(job), next(self._seq), job))
+            self._size += 1
+            self._cond.notify_all()
+
+    def _pop(self, small_only):
+        candidates = []
+        for chat_id, channel in self._channels.items():
+            heap = channel.top(small_only)
+            if heap is not None:
+                candidates.append((heap, chat_id, channel))
+        bumped = [candidate for candidate in candidates if candidate[0][0][2].bumped]
+        if bumped:
+            heap, chat_id, channel = min(bumped, key=lambda candidate: candidate[0][0][:2])
+        else:
+            heap, chat_id, channel = min(candidates, key=lambda candidate: (candidate[2].served, candidate[2].turn))
+            self._served = channel.served
+            priority = monitored_channels.get(chat_id, {}).get('priority', 0)
+            channel.served += 1 / 2 ** priority
+            channel.turn = next(self._seq)
+        job = heapq.heappop(heap)[2]
+        if not channel:
+            del self._channels[chat_id]
+        self._size -= 1
+        return job
+
+    async def get(self, small_only=False):
+        """按频道轮流取出任务，small_only 时只取小文件"""
+        async with self._cond:
+            if small_only:
+                await self._cond.wait_for(lambda: self.small_count() > 0)
+            else:
+                await self._cond.wait_for(lambda: self._size > 0)
+            job = self._pop(small_only)
+            self._cond.notify_all()
+            return job
+
+    def _entries(self):
+        for channel in self._channels.values():
+            yield from channel.small
+            yield from channel.large
+
+    def find(self, chat_id, message_id):
+        for _, _, job in self._entries():
+            if job.chat_id == chat_id and job.message_id == message_id:
+                return job
+        return None
+
+    def has_document(self, document_id):
+        return any(job.document.id == document_id for _, _, job in self._entries())
+
+    def reschedule(self):
+        """任务被提升后重新计算调度顺序"""
+        for channel in self._channels.values():
+            for heap in (channel.small, channel.large):
+                heap[:] = [(schedule_key(job), seq, job) for _, seq, job in heap]
+                heapq.heapify(heap)
+
+class CdnRedirectError(Exception):
+    """文件被重定向到 CDN，分段下载不支持，需要回退到 download_file"""
+
+class DocumentUnavailableError(Exception):
+    """原消息或其中的视频已被删除，无法继续下载"""
+
+class SessionUnavailableError(Exception):
+    """当前会话被限流或无法访问频道，需要换一个会话继续下载"""
+
+    def __init__(self, message, seconds=0):
+        super().__init__(message)
+        self.seconds = seconds
+
+class DiskSpaceError(Exception):
+    """清理旧视频后仍没有足够的磁盘空间"""
+
+class DownloadJournal:
+    """未完成下载的续传记录，保存文档定位信息和已写入磁盘的字节区间"""
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.part_size = data['part_size']
+        self.size = data['size']
+        self.completed_parts = set()
+        for start, end in data['completed']:
+            self.completed_parts.update(range(start // self.part_size, math.ceil(end / self.part_size)))
+
+    @classmethod
+    def create(cls, job, part_size=PART_SIZE):
+        document = job.document
+        data = {
+            'document_id': document.id,
+            'access_hash': document.access_hash,
+            'file_reference': document.file_reference.hex(),
+            'dc_id': document.dc_id,
+            'mime_type': document.mime_type,
+            'size': document.size,
+            'chat_id': job.chat_id,
+            'channel_username': job.channel_username,
+            'message_id': job.message_id,
+            'file_name': job.file_name,
+            'file_path': job.file_path,
+            'part_size': part_size,
+            'completed': [],
+        }
+        if job.album is not None:
+            data['album'] = job.album.journal_data()
+        return cls(os.path.join(JOURNAL_PATH, f"{document.id}.json"), data)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(path, json.load(f))
+
+    @property
+    def part_path(self):
+        return self.data['file_path'] + '.part'
+
+    def update_file_reference(self, file_reference):
+        self.data['file_reference'] = file_reference.hex()
+
+    def mark_done(self, index):
+        self.completed_parts.add(index)
+
+    def completed_bytes(self):
+        return sum(min(self.part_size, self.size - index * self.part_size) for index in self.completed_parts)
+
+    def save(self):
+        """原子地写入续传记录，调用前数据必须已经落盘"""
+        ranges = []
+        for index in sorted(self.completed_parts):
+            start = index * self.part_size
+            end = min(start + self.part_size, self.size)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        self.data['completed'] = ranges
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class StreamHasher:
+    """在下载过程中按字节顺序计算 SHA-256，不需要在下载完成后再读一遍文件
+
+    关联了文件时，乱序到达的分段（调用前必须已写入文件）不在内存中暂存，
+    等前面的分段到齐后再从文件中读回，续传前已经落盘的分段也是这样；
+    这时内存占用不受乱序程度影响。没有关联文件时乱序的分段暂存在内存中。
+    """
+
+    def __init__(self, size, part_size, on_disk_parts=()):
+        self.size = size
+        self.part_size = part_size
+        self.offset = 0
+        self._hash = hashlib.sha256()
+        self._pending = {}
+        self._on_disk = set(on_disk_parts)
+        self._fd = None
+
+    def attach(self, fd):
+        self._fd = fd
+        self._advance()
+
+    def update(self, offset, data):
+        if offset == self.offset:
+            self._hash.update(data)
+            self.offset += len(data)
+        elif self._fd is not None:
+            self._on_disk.add(offset // self.part_size)
+        else:
+            self._pending[offset] = data
+        self._advance()
+
+    def _advance(self):
+        while self.offset < self.size:
+            data = self._pending.pop(self.offset, None)
+            if data is None:
+                if self._fd is None or self.offset // self.part_size not in self._on_disk:
+                    break
+                data = os.pread(self._fd, min(self.part_size, self.size - self.offset), self.offset)
+            self._hash.update(data)
+            self.offset += len(data)
+
+    def hexdigest(self):
+        if self.offset != self.size:
+            raise RuntimeError(f"哈希计算不完整: {self.offset}/{self.size}")
+        return self._hash.hexdigest()
+
+def object_file(digest):
+    """内容寻址存储中 sha256 对应的文件路径"""
+    return os.path.join(OBJECTS_PATH, digest[:2], digest[2:4], digest)
+
+def store_object(part_path, digest, file_path):
+    """把下载完成的文件放入内容寻址存储，并在 file_path 创建指向它的硬链接
+
+    内容已存在时直接链接到已有文件并删除新下载的副本，返回 True。
+    """
+    object_path = object_file(digest)
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
     try:
-        with open('/root/video/channels.json', 'r') as f:
-            channels = json.load(f)
-            monitored_channels.update(channels)
-            logger.info(f"加载频道配置: {monitored_channels}")
-    except FileNotFoundError:
-        logger.info("没有找到频道配置文件")
+        os.link(part_path, object_path)
+    except FileExistsError:
+        os.remove(part_path)
+        os.link(object_path, file_path)
+        return True
+    os.replace(part_path, file_path)
+    return False
 
-def format_size(size):
-    """格式化文件大小"""
-    return humanize.naturalsize(size, binary=True)
+def remove_download(path, digest):
+    """删除一个已下载的视频，内容不再被其他文件引用时一并删除存储对象
 
-async def progress_callback(current, total, message, start_time, file_name):
-    """显示下载进度"""
+    返回实际释放的字节数，文件已不存在时返回 None。
+    """
     try:
-        now = time.time()
-        # 每2秒更新一次进度
-        if hasattr(progress_callback, 'last_update'):
-            if now - progress_callback.last_update < 2:
-                return
-        progress_callback.last_update = now
-
-        # 计算进度
-        percentage = (current / total) * 100
-        speed = current / (now - start_time) if now - start_time > 0 else 0
-        eta = (total - current) / speed if speed > 0 else 0
-
-        # 创建进度条
-        bar_length = 10
-        filled = int(percentage / 100 * bar_length)
-        bar = '█' * filled + '░' * (bar_length - filled)
-
-        # 更新消息
-        await message.edit(
-            f"📥 正在下载: {file_name}\n"
-            f"进度: {bar} {percentage:.1f}%\n"
-            f"大小: {format_size(current)}/{format_size(total)}\n"
-            f"速度: {format_size(speed)}/s\n"
-            f"预计剩余时间: {int(eta)}秒"
-        )
-    except Exception as e:
-        logger.error(f"更新进度时出错: {str(e)}")
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    os.remove(path)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(trace_file(path))
+    links_left = stat.st_nlink - 1
+    if links_left == 1 and digest:
+        object_path = object_file(digest)
+        try:
+            object_stat = os.stat(object_path)
+        except FileNotFoundError:
+            object_stat = None
+        if object_stat is not None and object_stat.st_ino == stat.st_ino:
+            os.remove(object_path)
+            links_left = 0
+    return stat.st_size if links_left == 0 else 0
 
-async def main():
+def allocated_bytes(path):
+    """文件已在磁盘上分配的字节数，文件不存在时为 0"""
     try:
-        # 创建客户端
-        logger.info("Creating client...")
-        client = TelegramClient(SESSION_PATH, API_ID, API_HASH)
-        
-        logger.info("Starting client with bot token...")
-        await client.start(bot_token=BOT_TOKEN)
-        
-        logger.info("Bot started successfully")
-        logger.info(f"Bot username: {(await client.get_me()).username}")
-        
-        # 加载保存的频道配置
-        load_channels()
-        
-        @client.on(events.NewMessage(pattern='/start'))
-        async def start_handler(event):
-            if event.sender_id != ADMIN_USER_ID:
-                return
-            
-            await event.respond(
-                "欢迎使用频道视频下载机器人！\n"
-                "/add_channel <频道链接> - 添加要监控的频道\n"
-                "/remove_channel <频道链接> - 移除监控的频道\n"
-                "/list_channels - 列出所有监控的频道\n"
-                "/status - 查看下载状态和统计信息"
+        return os.stat(path).st_blocks * 512
+    except FileNotFoundError:
+        return 0
+
+def preallocate_file(fd, size):
+    """为文件预先分配空间，文件系统不支持时退化为 ftruncate"""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+def pwrite_all(fd, bufs, offset):
+    """从 offset 开始把 bufs 依次写入文件，处理部分写入的情况"""
+    data = memoryview(b''.join(bufs)) if len(bufs) > 1 else memoryview(bufs[0])
+    while data:
+        written = os.pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+class DownloadSink:
+    """下载数据的去向，ParallelDownloader 只通过这个接口写入数据
+
+    write 按分段序号和偏移写入，close 在全部写入后调用并返回内容的 SHA-256，
+    abort 在下载失败时调用，已经写入的分段仍然会被保留。
+    """
+
+    async def open(self):
+        pass
+
+    async def write(self, index, offset, data):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def abort(self):
+        pass
+
+class FileSink(DownloadSink):
+    """把分段写入预分配的 .part 文件
+
+    实际的磁盘写入、哈希计算和 fsync 都在单独的后台线程中完成，事件循环只负责
+    把数据交给线程。排队中的数据超过 WRITE_BUFFER_SIZE 时 write 会等待，
+    相邻的分段会合并成一次较大的写入。分段落盘后才会记入续传记录。
+    """
+
+    def __init__(self, journal, size, fsync_policy=FSYNC_POLICY, trace=None):
+        self.journal = journal
+        self.size = size
+        self.fsync_policy = fsync_policy
+        self.trace = trace or DownloadTrace()
+        self.hasher = StreamHasher(size, journal.part_size, journal.completed_parts)
+        self._queue = queue.Queue()
+        self._buffered = 0
+        self._space = asyncio.Event()
+        self._error = None
+        self._fd = None
+        self._thread = None
+        self._done = None
+        self._loop = None
+
+    def _open_file(self):
+        fd = os.open(self.journal.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            preallocate_file(fd, self.size)
+            # 续传时先把已落盘的连续部分计入哈希
+            self.hasher.attach(fd)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    async def open(self):
+        self._loop = asyncio.get_running_loop()
+        self._fd = await self._loop.run_in_executor(None, self._open_file)
+        self._done = self._loop.create_future()
+        self._thread = threading.Thread(target=self._run, name=f"sink-{os.path.basename(self.journal.part_path)}", daemon=True)
+        self._thread.start()
+
+    async def write(self, index, offset, data):
+        while self._error is None and self._buffered and self._buffered + len(data) > WRITE_BUFFER_SIZE:
+            self._space.clear()
+            await self._space.wait()
+        if self._error is not None:
+            raise self._error
+        self._buffered += len(data)
+        self._queue.put((offset, index, data))
+
+    async def _stop(self):
+        self._queue.put(None)
+        await self._done
+        os.close(self._fd)
+
+    async def close(self):
+        await self._stop()
+        if self._error is not None:
+            raise self._error
+        return self.hasher.hexdigest()
+
+    async def abort(self):
+        await self._stop()
+
+    # 以下方法在事件循环中由后台线程回调
+
+    def _on_written(self, nbytes):
+        self._buffered -= nbytes
+        self._space.set()
+
+    def _on_synced(self, indexes):
+        for index in indexes:
+            self.journal.mark_done(index)
+        self.journal.save()
+
+    def _on_error(self, error):
+        self._error = error
+        self._space.set()
+
+    # 以下方法运行在后台线程中
+
+    def _write_batch(self, items):
+        start = time.time()
+        items.sort(key=lambda item: item[0])
+        run_offset, run_bufs, run_size = None, [], 0
+        for offset, index, data in items:
+            if run_bufs and (offset != run_offset + run_size or run_size >= WRITE_COALESCE_SIZE):
+                pwrite_all(self._fd, run_bufs, run_offset)
+                run_bufs, run_size = [], 0
+            if not run_bufs:
+                run_offset = offset
+            run_bufs.append(data)
+            run_size += len(data)
+        if run_bufs:
+            pwrite_all(self._fd, run_bufs, run_offset)
+        written = time.time()
+        for offset, index, data in items:
+            self.hasher.update(offset, data)
+        self.trace.event('disk_write', start, written - start, bytes=sum(len(data) for _, _, data in items))
+        self.trace.event('hash', written, time.time() - written)
+
+    def _run(self):
+        unsynced = []
+        synced_at = time.monotonic()
+        try:
+            stop = False
+            while not stop:
+                # 取出当前排队的所有分段，一起写入
+                items = []
+                item = self._queue.get()
+                while item is not None:
+                    items.append(item)
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                stop = item is None
+
+                if items:
+                    self._write_batch(items)
+                    unsynced.extend(index for _, index, _ in items)
+                    self._loop.call_soon_threadsafe(self._on_written, sum(len(data) for _, _, data in items))
+
+                now = time.monotonic()
+                if unsynced and (stop or self.fsync_policy == 'always' or now - synced_at >= JOURNAL_SAVE_INTERVAL):
+                    # 先落盘再记录，保证续传记录中的区间都是可靠的
+                    if self.fsync_policy != 'none':
+                        with self.trace.span('fsync'):
+                            os.fdatasync(self._fd)
+                    self._loop.call_soon_threadsafe(self._on_synced, unsynced)
+                    unsynced = []
+                    synced_at = now
+        except BaseException as e:
+            self._loop.call_soon_threadsafe(self._on_error, e)
+        finally:
+            self._loop.call_soon_threadsafe(self._done.set_result, None)
+
+def object_key(journal):
+    """下载在对象存储中的键，与视频目录下的相对路径相同
+
+    相册中的视频直接使用相册目录，不经过 .partial 目录。
+    """
+    path = journal.data['file_path']
+    album = journal.data.get('album')
+    if album is not None:
+        path = os.path.join(album['directory'], os.path.basename(path))
+    key = os.path.relpath(path, VIDEO_PATH).replace(os.sep, '/')
+    return f"{S3_PREFIX}/{key}" if S3_PREFIX else key
+
+def is_object_url(path):
+    return path.startswith('s3://')
+
+def download_exists(path):
+    """下载记录中的文件是否还在，只保存在对象存储中的视频视为存在"""
+    return is_object_url(path) or os.path.exists(path)
+
+def s3_error_code(error):
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+class ObjectStore:
+    """S3 兼容的对象存储
+
+    boto3 的调用都是阻塞的，放在专用线程池中执行，线程数就是所有下载合计同时上传的分片数。
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.client = None
+        self._executor = None
+
+    @property
+    def enabled(self):
+        return bool(self.bucket)
+
+    def start(self):
+        if boto3 is None:
+            raise RuntimeError("设置了 S3_BUCKET 但没有安装 boto3: pip install boto3")
+        self.client = boto3.client(
+            's3', endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION,
+            config=BotoConfig(
+                max_pool_connections=S3_UPLOAD_CONCURRENCY + 2,
+                retries={'max_attempts': 5, 'mode': 'standard'}
             )
+        )
+        self._executor = ThreadPoolExecutor(S3_UPLOAD_CONCURRENCY, thread_name_prefix='s3')
+        logger.info(
+            f"对象存储: s3://{self.bucket}/{S3_PREFIX}"
+            + (f" ({S3_ENDPOINT_URL})" if S3_ENDPOINT_URL else "")
+            + ("" if S3_KEEP_LOCAL else "，不保留本地副本")
+        )
 
-        @client.on(events.NewMessage(pattern='/add_channel'))
-        async def add_channel_handler(event):
-            if event.sender_id != ADMIN_USER_ID:
-                return
-            
+    def url(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+    async def _call(self, method, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, lambda: getattr(self.client, method)(Bucket=self.bucket, **kwargs)
+        )
+
+    async def create_upload(self, key):
+        response = await self._call('create_multipart_upload', Key=key)
+        return response['UploadId']
+
+    async def uploaded_parts(self, key, upload_id):
+        """已上传的分片 {分片号: ETag}，上传已不存在（已完成或被清理）时返回 None"""
+        parts = {}
+        marker = 0
+        while True:
             try:
-                channel = event.text.split(maxsplit=1)[1].strip('@')
-                entity = await client.get_entity(channel)
-                if not hasattr(entity, 'broadcast'):
-                    await event.respond("这不是一个频道")
-                    return
-                
-                monitored_channels.add(channel)
-                save_channels()
-                await event.respond(f"已成功添加频道: @{channel}")
-                logger.info(f"Added channel: @{channel}")
+                response = await self._call('list_parts', Key=key, UploadId=upload_id, PartNumberMarker=marker)
             except Exception as e:
-                await event.respond(f"添加频道失败: {str(e)}")
-                logger.error(f"Failed to add channel: {str(e)}")
+                if s3_error_code(e) == 'NoSuchUpload':
+                    return None
+                raise
+            for part in response.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+            if not response.get('IsTruncated'):
+                return parts
+            marker = response['NextPartNumberMarker']
+
+    async def upload_part(self, key, upload_id, number, data):
+        response = await self._call('upload_part', Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+        return response['ETag']
+
+    async def complete_upload(self, key, upload_id, etags):
+        await self._call(
+            'complete_multipart_upload', Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': etags[number]} for number in sorted(etags)]}
+        )
+
+    async def abort_upload(self, key, upload_id):
+        try:
+            await self._call('abort_multipart_upload', Key=key, UploadId=upload_id)
+        except Exception as e:
+            logger.warning(f"取消分段上传 {key} 失败: {str(e)}")
+
+    async def discard(self, journal):
+        """放弃续传记录中未完成的分段上传"""
+        state = journal.data.pop('s3', None)
+        if state is not None:
+            await self.abort_upload(state['key'], state['upload_id'])
+
+class S3Sink(DownloadSink):
+    """把分段同时写入对象存储的分段上传（multipart upload），local 为 None 时不保留本地副本
+
+    下载分段按偏移拼进内存中的上传分片，分片收齐后立即交给上传线程池，多个分片并发上传；
+    内存中的分片（包括上传中的）达到 S3_MAX_BUFFERS 个时 write 会等待。
+    上传 id 保存在续传记录中，中断后继续同一个上传，已上传的分片不再重复上传。
+    不保留本地副本时，分段要等所在的分片上传完成后才记入续传记录。
+    """
+
+    def __init__(self, journal, size, local=None, trace=None):
+        self.journal = journal
+        self.size = size
+        self.local = local
+        self.trace = trace or DownloadTrace()
+        self.chunks = math.ceil(S3_PART_SIZE / journal.part_size)  # 每个上传分片包含的下载分段数
+        self.part_size = self.chunks * journal.part_size
+        self.part_count = math.ceil(size / self.part_size)
+        self.key = None
+        self.upload_id = None
+        self.hasher = None  # 不保留本地副本时由这里计算 SHA-256
+        self._etags = {}  # 分片号 -> ETag
+        self._buffers = {}  # 分片序号 -> [bytearray, 已收到的字节数]
+        self._uploads = set()
+        self._local_parts = set()  # 续传前本地已有、不会再下载的分段
+        self._local_fd = None
+        self._hashed = None
+        self._space = asyncio.Event()
+        self._error = None
 
-        @client.on(events.NewMessage(pattern='/remove_channel'))
-        async def remove_channel_handler(event):
-            if event.sender_id != ADMIN_USER_ID:
+    def _chunk_range(self, part):
+        return range(part * self.chunks, min((part + 1) * self.chunks, math.ceil(self.size / self.journal.part_size)))
+
+    async def _resume(self):
+        state = self.journal.data.get('s3')
+        if state is not None and state.get('part_size') == self.part_size:
+            etags = await object_store.uploaded_parts(state['key'], state['upload_id'])
+            if etags is not None:
+                self.key, self.upload_id, self._etags = state['key'], state['upload_id'], etags
+                logger.info(f"继续分段上传 {self.key}: 已上传 {len(etags)}/{self.part_count} 个分片")
                 return
-            
+            logger.warning(f"分段上传 {state['key']} 已不存在，重新上传")
+        elif state is not None:
+            # 分片大小改变后旧的上传无法继续
+            await object_store.abort_upload(state['key'], state['upload_id'])
+        self.key = object_key(self.journal)
+        self.upload_id = await object_store.create_upload(self.key)
+        self._etags = {}
+        self.journal.data['s3'] = {'key': self.key, 'upload_id': self.upload_id, 'part_size': self.part_size}
+        self.journal.save()
+
+    async def open(self):
+        if self.local is not None:
+            await self.local.open()
+        try:
+            with self.trace.span('s3_open'):
+                await self._resume()
+            if self.local is not None:
+                # 续传前已在本地的分段不会再下载，上传时从 .part 文件读回
+                self._local_parts = set(self.journal.completed_parts)
+                if self._local_parts:
+                    self._local_fd = os.open(self.journal.part_path, os.O_RDONLY)
+                for part in range(self.part_count):
+                    if part + 1 not in self._etags and all(c in self._local_parts for c in self._chunk_range(part)):
+                        await self._wait_space()
+                        await self._buffer(part)
+            else:
+                # 没有本地副本时只有已上传的分片是可靠的
+                self.journal.completed_parts = {
+                    chunk for number in self._etags for chunk in self._chunk_range(number - 1)
+                }
+                self.journal.save()
+                if not self.journal.completed_parts:
+                    self.hasher = StreamHasher(self.size, self.journal.part_size)
+        except BaseException:
+            await self.abort()
+            raise
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error
+
+    async def _wait_space(self):
+        while self._error is None and len(self._buffers) + len(self._uploads) >= S3_MAX_BUFFERS:
+            self._space.clear()
+            await self._space.wait()
+        self._raise()
+
+    def _read_local(self, part, data, chunks):
+        total = 0
+        for chunk in chunks:
+            offset = chunk * self.journal.part_size
+            length = min(self.journal.part_size, self.size - offset)
+            start = offset - part * self.part_size
+            data[start:start + length] = os.pread(self._local_fd, length, offset)
+            total += length
+        return total
+
+    async def _buffer(self, part):
+        """取得分片的缓冲区，新建时先填入本地已有的分段"""
+        buffer = self._buffers.get(part)
+        if buffer is None:
+            buffer = self._buffers[part] = [bytearray(min(self.part_size, self.size - part * self.part_size)), 0]
+            local = [chunk for chunk in self._chunk_range(part) if chunk in self._local_parts]
+            if local:
+                buffer[1] += await asyncio.get_running_loop().run_in_executor(
+                    None, self._read_local, part, buffer[0], local
+                )
+                self._check(part)
+        return buffer
+
+    def _check(self, part):
+        """分片收齐后开始上传"""
+        buffer = self._buffers.get(part)
+        if buffer is None or buffer[1] < len(buffer[0]):
+            return
+        del self._buffers[part]
+        task = asyncio.create_task(self._upload(part, buffer[0]))
+        self._uploads.add(task)
+        if self.hasher is not None:
+            self._hashed = asyncio.ensure_future(self._hash(self._hashed, part * self.part_size, buffer[0]))
+
+    async def _hash(self, previous, offset, data):
+        # 依次在线程中计算，不阻塞事件循环
+        if previous is not None:
+            await previous
+        await asyncio.get_running_loop().run_in_executor(None, self.hasher.update, offset, data)
+
+    async def _upload(self, part, data):
+        start = time.time()
+        try:
+            self._etags[part + 1] = await object_store.upload_part(self.key, self.upload_id, part + 1, data)
+        except Exception as e:
+            logger.error(f"上传分片 {part + 1} 到 {self.key} 失败: {str(e)}")
+            self._error = self._error or e
+        else:
+            self.trace.event('s3_upload', start, time.time() - start, part=part + 1, bytes=len(data))
+            metrics.inc('s3_uploaded_bytes_total', len(data))
+            if self.local is None:
+                for chunk in self._chunk_range(part):
+                    self.journal.mark_done(chunk)
+                self.journal.save()
+        finally:
+            # 先移出上传集合再唤醒，等待中的 write 重新检查时才不会把这个分片算进去
+            self._uploads.discard(asyncio.current_task())
+            self._space.set()
+
+    async def write(self, index, offset, data):
+        if self.local is not None:
+            await self.local.write(index, offset, data)
+        part = index // self.chunks
+        if part + 1 in self._etags:
+            # 上次已经上传过，只是本地还没来得及记入续传记录
+            return
+        if part not in self._buffers:
+            await self._wait_space()
+        buffer = await self._buffer(part)
+        start = offset - part * self.part_size
+        buffer[0][start:start + len(data)] = data
+        buffer[1] += len(data)
+        self._check(part)
+
+    async def _drain(self):
+        await asyncio.gather(*list(self._uploads))
+        if self._local_fd is not None:
+            os.close(self._local_fd)
+            self._local_fd = None
+
+    async def close(self):
+        try:
+            digest = await self.local.close() if self.local is not None else None
+        finally:
+            await self._drain()
+        self._raise()
+        if len(self._etags) < self.part_count:
+            raise RuntimeError(f"分段上传不完整: {len(self._etags)}/{self.part_count}")
+        with self.trace.span('s3_complete'):
+            await object_store.complete_upload(self.key, self.upload_id, self._etags)
+        if self.hasher is not None:
+            await self._hashed
+            digest = self.hasher.hexdigest()
+        return digest
+
+    async def abort(self):
+        # 等上传中的分片完成，续传时不需要重新上传
+        try:
+            if self.local is not None:
+                await self.local.abort()
+        finally:
+            await self._drain()
+            if self._hashed is not None:
+                await asyncio.gather(self._hashed, return_exceptions=True)
+
+def create_sink(journal, size, trace=None):
+    """按配置创建下载 sink：本地 .part 文件，配置了对象存储时同时（或只）上传到存储桶"""
+    local = FileSink(journal, size, trace=trace) if S3_KEEP_LOCAL else None
+    if not object_store.enabled:
+        return local
+    return S3Sink(journal, size, local, trace=trace)
+
+
+async def create_media_sender(client, dc_id, auth_key=None):
+    """创建一个连接到 dc_id 的独立 MTProtoSender
+
+    返回的 sender 拥有自己的连接，可以和其它 sender 并发请求。
+    目标 DC 不是当前会话所在的 DC 时，首次需要导出/导入授权，
+    之后可以用同一个 auth_key 继续创建连接。
+    """
+    if dc_id == client.session.dc_id:
+        auth_key = client.session.auth_key
+    elif auth_key is None:
+        return await client._create_exported_sender(dc_id)
+
+    dc = await client._get_dc(dc_id)
+    sender = MTProtoSender(auth_key, loggers=client._log)
+    await sender.connect(client._connection(
+        dc.ip_address,
+        dc.port,
+        dc.id,
+        loggers=client._log,
+        proxy=client._proxy
+    ))
+    return sender
+
+async def refresh_document(client, job):
+    """文件引用过期时重新获取原消息，拿到新的 file_reference"""
+    message = await client.get_messages(job.chat_id, ids=job.message_id)
+    document = getattr(getattr(message, 'media', None), 'document', None)
+    if document is None or document.id != job.document.id:
+        raise DocumentUnavailableError(f"消息 {job.message_id} 中的视频已不可用")
+    job.document = document
+    return document
+
+class MediaDc:
+    """一个会话在某个媒体 DC 上的连接：导出的授权和空闲的 sender"""
+
+    def __init__(self, client, dc_id):
+        self.client = client
+        self.dc_id = dc_id
+        self.auth_key = None  # 非主 DC 首次导出授权后保存，之后新建连接不再导出
+        self.idle = []  # [(sender, 开始空闲的 time.monotonic())]
+        self.keep = 0  # 预热的 DC 至少保留这么多空闲连接，不会因空闲被关闭
+        self.lock = asyncio.Lock()
+
+class MediaSenderPool:
+    """按会话和 DC 复用已授权的下载连接
+
+    下载结束后连接放回池中，下一个同 DC 的下载直接使用，不必再导出授权和建立连接。
+    启动时为被监控频道所在的 DC 预先建立连接，定期检查空闲连接是否可用，
+    超过 MEDIA_POOL_IDLE_TIMEOUT 没有使用的连接会被关闭。
+    """
+
+    def __init__(self):
+        self.dcs = {}  # (id(client), dc_id) -> MediaDc
+
+    def _dc(self, client, dc_id):
+        key = (id(client), dc_id)
+        if key not in self.dcs:
+            self.dcs[key] = MediaDc(client, dc_id)
+        return self.dcs[key]
+
+    async def _create(self, dc, count):
+        """新建 count 个连接，第一次连接非主 DC 时先导出授权"""
+        created = []
+        async with dc.lock:
+            if dc.auth_key is None and dc.dc_id != dc.client.session.dc_id:
+                first = await create_media_sender(dc.client, dc.dc_id)
+                dc.auth_key = first.auth_key
+                created.append(first)
+        results = await asyncio.gather(*(
+            create_media_sender(dc.client, dc.dc_id, dc.auth_key)
+            for _ in range(count - len(created))
+        ), return_exceptions=True)
+        error = next((result for result in results if isinstance(result, BaseException)), None)
+        created += [result for result in results if not isinstance(result, BaseException)]
+        if error is not None:
+            await self._disconnect(created)
+            if isinstance(error, errors.RPCError):
+                # 导出的授权可能已失效，下次重新导出
+                dc.auth_key = None
+            raise error
+        metrics.inc('media_senders_total', len(created), result='created')
+        return created
+
+    async def _disconnect(self, senders):
+        await asyncio.gather(*(sender.disconnect() for sender in senders), return_exceptions=True)
+
+    async def discard(self, senders):
+        """关闭出错的下载用过的连接"""
+        await self._disconnect(senders)
+
+    async def acquire(self, client, dc_id, count):
+        """取出 count 个连接到 dc_id 的 sender，优先使用空闲连接"""
+        dc = self._dc(client, dc_id)
+        senders, broken = [], []
+        while dc.idle and len(senders) < count:
+            sender, _ = dc.idle.pop()
+            (senders if sender.is_connected() else broken).append(sender)
+        if broken:
+            await self._disconnect(broken)
+        metrics.inc('media_senders_total', len(senders), result='reused')
+        if len(senders) < count:
             try:
-                channel = event.text.split(maxsplit=1)[1].strip('@')
-                if channel in monitored_channels:
-                    monitored_channels.remove(channel)
-                    save_channels()
-                    await event.respond(f"已移除频道: @{channel}")
+                senders += await self._create(dc, count - len(senders))
+            except BaseException:
+                self.release(client, dc_id, senders)
+                raise
+        return senders
+
+    def release(self, client, dc_id, senders):
+        """下载结束后把连接放回池中"""
+        now = time.monotonic()
+        self._dc(client, dc_id).idle.extend((sender, now) for sender in senders)
+
+    async def warm(self, client, dc_id, count):
+        """为 dc_id 预先建立 count 个空闲连接，并在之后一直保留"""
+        dc = self._dc(client, dc_id)
+        dc.keep = max(dc.keep, count)
+        missing = count - len(dc.idle)
+        if missing > 0:
+            self.release(client, dc_id, await self._create(dc, missing))
+            logger.info(f"预热 DC {dc_id} 下载连接: {count} 个")
+
+    async def _ping(self, sender):
+        try:
+            await asyncio.wait_for(sender.send(functions.PingRequest(ping_id=random.getrandbits(63))), 10)
+            return True
+        except Exception:
+            return False
+
+    async def check(self):
+        """关闭长时间空闲的连接，检查剩下的连接，预热的 DC 连接不足时补齐"""
+        now = time.monotonic()
+        for dc in list(self.dcs.values()):
+            # 检查期间连接不留在池中，避免下载取走正在检查、随后可能被关闭的连接
+            idle, dc.idle = dc.idle, []
+            expired, checked = [], []
+            for index, item in enumerate(reversed(idle)):
+                sender, idle_since = item
+                if not sender.is_connected() or (index >= dc.keep and now - idle_since > MEDIA_POOL_IDLE_TIMEOUT):
+                    expired.append(sender)
                 else:
-                    await event.respond("未找到该频道")
+                    checked.append(item)
+            alive = await asyncio.gather(*(self._ping(sender) for sender, _ in checked))
+            dead = [sender for (sender, _), ok in zip(checked, alive) if not ok]
+            # 检查期间放回的连接更新，排在后面先被取用
+            dc.idle[:0] = [item for item, ok in zip(reversed(checked), reversed(alive)) if ok]
+            if expired or dead:
+                logger.info(f"DC {dc.dc_id}: 关闭 {len(expired)} 个空闲连接, {len(dead)} 个无响应的连接")
+                await self._disconnect(expired + dead)
+            if len(dc.idle) < dc.keep:
+                try:
+                    self.release(dc.client, dc.dc_id, await self._create(dc, dc.keep - len(dc.idle)))
+                except Exception as e:
+                    logger.warning(f"补充 DC {dc.dc_id} 下载连接失败: {str(e)}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(MEDIA_POOL_CHECK_INTERVAL)
+            try:
+                await self.check()
             except Exception as e:
-                await event.respond(f"移除频道失败: {str(e)}")
+                logger.error(f"检查下载连接时出错: {str(e)}")
 
-        @client.on(events.NewMessage(pattern='/list_channels'))
-        async def list_channels_handler(event):
-            if event.sender_id != ADMIN_USER_ID:
-                return
-            
-            if not monitored_channels:
-                await event.respond("当前没有监控任何频道")
-                return
-            
-            channels_list = "\n".join(f"- {channel}" for channel in monitored_channels)
-            await event.respond(f"当前监控的频道：\n{channels_list}")
+    def describe(self):
+        counts = {}
+        for dc in self.dcs.values():
+            counts[dc.dc_id] = counts.get(dc.dc_id, 0) + len(dc.idle)
+        return ", ".join(f"DC{dc_id} {count}" for dc_id, count in sorted(counts.items())) or "无"
 
-        @client.on(events.NewMessage(pattern='/status'))
-        async def status_handler(event):
-            if event.sender_id != ADMIN_USER_ID:
-                return
-            
+async def warm_media_pool():
+    """启动时为被监控频道所在的 DC 预先建立下载连接
+
+    频道头像所在的 DC 就是该频道媒体文件所在的 DC，没有头像的频道无法预先知道，跳过。
+    """
+    if not MEDIA_POOL_WARM or not client_pool.sessions:
+        return
+    listener = next(session for session in client_pool.sessions if session.listener)
+    dc_ids = set()
+    for chat_id in list(monitored_channels):
+        try:
+            entity = await listener.client.get_entity(chat_id)
+        except (ValueError, errors.RPCError) as e:
+            logger.warning(f"无法获取频道 {channel_label(chat_id)} 的信息: {str(e)}")
+            continue
+        dc_id = getattr(getattr(entity, 'photo', None), 'dc_id', None)
+        if dc_id:
+            dc_ids.add(dc_id)
+    # 有工作会话时下载都由工作会话完成，只为它们预热
+    sessions = [session for session in client_pool.sessions if not session.listener] or client_pool.sessions
+    for session in sessions:
+        for dc_id in dc_ids:
             try:
-                total_files = len([f for f in os.listdir(DOWNLOAD_PATH) if os.path.isfile(os.path.join(DOWNLOAD_PATH, f))])
-                total_size = sum(os.path.getsize(os.path.join(DOWNLOAD_PATH, f)) for f in os.listdir(DOWNLOAD_PATH) if os.path.isfile(os.path.join(DOWNLOAD_PATH, f)))
-                
-                await event.respond(
-                    "📊 下载统计信息\n"
-                    f"监控的频道数: {len(monitored_channels)}\n"
-                    f"已下载文件数: {total_files}\n"
-                    f"总存储大小: {format_size(total_size)}\n"
-                    f"存储路径: {DOWNLOAD_PATH}"
-                )
+                await media_pool.warm(session.client, dc_id, MEDIA_POOL_WARM)
             except Exception as e:
-                await event.respond(f"获取状态信息时出错: {str(e)}")
+                logger.warning(f"会话 {session.name} 预热 DC {dc_id} 失败: {str(e)}")
+
+class ParallelDownloader:
+    """把文档切成固定大小的字节段，通过多个连接并发下载，并按偏移写入预分配的文件
+
+    已完成的分段记录在任务的续传记录中，中断后再次下载只会请求缺失的分段。
+    """
+
+    def __init__(self, client, job, sink=None, max_flood_wait=None):
+        self.client = client
+        self.job = job
+        self.max_flood_wait = max_flood_wait
+        self.journal = job.journal
+        self.size = job.document.size
+        self.dc_id, self.location = utils.get_input_location(job.document)
+        self.part_size = self.journal.part_size
+        self._plan()
+        self.trace = job.trace
+        self.sink = sink or create_sink(self.journal, self.size, trace=self.trace)
+        self._first_byte = False
+        self._refresh_lock = asyncio.Lock()
+
+    def _plan(self):
+        """按续传记录确定需要下载的分段"""
+        part_count = math.ceil(self.size / self.part_size)
+        self._pending = deque(
+            index for index in range(part_count) if index not in self.journal.completed_parts
+        )
+        self.connections = max(1, min(self.job.connections, len(self._pending)))
+        self.downloaded = self.journal.completed_bytes()
+
+    async def _open_senders(self):
+        if self.connections == 1 and self.dc_id == self.client.session.dc_id:
+            # 单连接下载直接使用客户端已有的连接，省去建立新连接的开销
+            return [self.client._sender]
+        # 其余情况从连接池中取已授权的连接
+        return await media_pool.acquire(self.client, self.dc_id, self.connections)
 
-        @client.on(events.NewMessage)
-        async def download_handler(event):
+    async def _close_senders(self, senders, healthy):
+        if senders == [self.client._sender]:
+            return
+        if healthy:
+            media_pool.release(self.client, self.dc_id, senders)
+        else:
+            # 连接可能已经不可用，不放回池中
+            await media_pool.discard(senders)
+
+    async def _refresh_location(self, stale_reference):
+        async with self._refresh_lock:
+            # 其它连接可能已经刷新过
+            if self.location.file_reference != stale_reference:
+                return
+            logger.info(f"文件引用已过期，重新获取: {self.job.file_name}")
+            document = await refresh_document(self.client, self.job)
+            self.location = utils.get_input_location(document)[1]
+            self.journal.update_file_reference(document.file_reference)
+            self.journal.save()
+
+    async def _request_part(self, sender, offset):
+        for attempt in range(PART_RETRIES):
+            location = self.location
+            request = functions.upload.GetFileRequest(location, offset, self.part_size)
             try:
-                # 添加更多日志
-                logger.info(f"Received message: {event.message.id}")
-                
-                if not event.is_channel:
-                    logger.info("Not a channel message")
-                    return
-                
-                channel_username = (await event.get_chat()).username
-                logger.info(f"Message from channel: @{channel_username}")
-                
-                if channel_username not in monitored_channels:
-                    logger.info(f"Channel @{channel_username} not in monitored list")
-                    return
+                result = await sender.send(request)
+            except (errors.FileReferenceExpiredError, errors.FileReferenceInvalidError):
+                with self.trace.span('refresh'):
+                    await self._refresh_location(location.file_reference)
+            except errors.FloodWaitError as e:
+                if self.max_flood_wait is not None and e.seconds > self.max_flood_wait:
+                    raise SessionUnavailableError(f"会话触发 FloodWait {e.seconds} 秒", e.seconds)
+                logger.warning(f"获取分段时触发 FloodWait，等待 {e.seconds} 秒")
+                metrics.inc('flood_waits_total', source='download')
+                metrics.inc('flood_wait_seconds_total', e.seconds, source='download')
+                self.trace.event('flood', seconds=e.seconds)
+                await asyncio.sleep(e.seconds)
+            except (errors.ServerError, errors.TimedOutError, ConnectionError) as e:
+                if attempt == PART_RETRIES - 1:
+                    raise
+                logger.warning(f"获取分段 {offset} 失败，重试: {str(e)}")
+                self.trace.event('retry', offset=offset, error=type(e).__name__)
+                await asyncio.sleep(2 ** attempt)
+            else:
+                if isinstance(result, types.upload.FileCdnRedirect):
+                    raise CdnRedirectError()
+                return result.bytes
+        raise RuntimeError(f"获取分段 {offset} 失败次数过多")
 
-                if hasattr(event.message, 'media') and event.message.media:
-                    logger.info("Message has media")
-                    # 获取视频信息
-                    media = event.message.media
-                    if hasattr(media, 'document'):
-                        # 获取文件信息
-                        file_size = media.document.size
-                        mime_type = media.document.mime_type
-                        
-                        # 只处理视频文件
-                        if not mime_type or not mime_type.startswith('video/'):
-                            return
-                        
-                        # 获取文件名
-                        for attribute in media.document.attributes:
-                            if hasattr(attribute, 'file_name') and attribute.file_name:
-                                file_name = attribute.file_name
-                                break
-                        else:
-                            file_name = f"video_{int(time.time())}.mp4"
-                        
-                        file_path = os.path.join(DOWNLOAD_PATH, file_name)
-                        
-                        # 确保文件名唯一
-                        base_name, ext = os.path.splitext(file_name)
-                        counter = 1
-                        while os.path.exists(file_path):
-                            file_path = os.path.join(DOWNLOAD_PATH, f"{base_name}_{counter}{ext}")
-                            counter += 1
-                        
-                        # 发送开始下载消息
-                        status_message = await client.send_message(
-                            ADMIN_USER_ID,
-                            f"开始下载视频: {file_name}\n大小: {format_size(file_size)}"
-                        )
-                        
-                        try:
-                            # 记录开始时间
-                            start_time = time.time()
-                            
-                            # 创建进度回调
-                            async def progress(current, total):
-                                try:
-                                    await progress_callback(current, total, status_message, start_time, file_name)
-                                except Exception as e:
-                                    logger.error(f"Progress callback error: {str(e)}")
-                            
-                            # 下载视频
-                            await client.download_media(
-                                message=event.message.media,
-                                file=file_path,
-                                progress_callback=progress
-                            )
-                            
-                            # 下载完成后的处理
-                            actual_size = os.path.getsize(file_path)
-                            duration = time.time() - start_time
-                            average_speed = actual_size / duration if duration > 0 else 0
-                            
-                            # 发送完成消息
-                            await status_message.edit(
-                                f"✅ 视频下载完成\n"
-                                f"频道: @{channel_username}\n"
-                                f"文件: {file_name}\n"
-                                f"大小: {format_size(actual_size)}\n"
-                                f"用时: {int(duration)}秒\n"
-                                f"平均速度: {format_size(average_speed)}/s"
-                            )
-                            
-                            logger.info(f"视频下载完成: {file_path}")
-                            
-                        except Exception as e:
-                            # 如果下载失败，删除部分下载的文件
-                            if os.path.exists(file_path):
-                                os.remove(file_path)
-                            raise e
-                            
-            except Exception as e:
-                error_msg = f"下载视频时出错: {str(e)}"
-                logger.error(error_msg)
-                await client.send_message(
-                    ADMIN_USER_ID, 
-                    f"❌ 下载失败\n"
-                    f"频道: @{channel_username}\n"
-                    f"错误: {str(e)}"
-                )
+    async def _worker(self, sender, progress_callback):
+        while self._pending:
+            index = self._pending.popleft()
+            offset = index * self.part_size
+            start = time.time()
+            await bandwidth_shaper.acquire(self.job, min(self.part_size, self.size - offset))
+            requested = time.time()
+            data = await self._request_part(sender, offset)
+            received = time.time()
+            if not self._first_byte:
+                self._first_byte = True
+                self.trace.event('first_byte', received)
+            await self.sink.write(index, offset, data)
+            self.trace.event(
+                'chunk', start, time.time() - start, index=index, bytes=len(data),
+                throttle=round(requested - start, 6), request=round(received - requested, 6),
+                write_wait=round(time.time() - received, 6)
+            )
+            self.downloaded += len(data)
+            if progress_callback:
+                progress_callback(self.downloaded, self.size)
+
+    async def download(self, progress_callback=None):
+        """下载所有缺失的分段并写入 sink，返回文件内容的 SHA-256"""
+        await self.sink.open()
+        # sink 可能按对象存储中已上传的分片修正了续传记录
+        self._plan()
+        try:
+            if self._pending:
+                with self.trace.span('connect', connections=self.connections, dc=self.dc_id):
+                    senders = await self._open_senders()
+                tasks = [
+                    asyncio.create_task(self._worker(sender, progress_callback))
+                    for sender in senders
+                ]
+                healthy = True
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException as e:
+                    # 这些错误与连接本身无关，连接仍可以给其它下载使用
+                    healthy = isinstance(e, (SessionUnavailableError, DocumentUnavailableError, CdnRedirectError))
+                    # 任一连接失败时取消其余连接，避免它们继续写入
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+                finally:
+                    await self._close_senders(senders, healthy)
+        except BaseException:
+            await self.sink.abort()
+            raise
+        return await self.sink.close()
+
+class PooledSession:
+    """下载会话池中的一个会话"""
+
+    def __init__(self, name, client, listener):
+        self.name = name
+        self.client = client
+        self.listener = listener  # 监听会话只在工作会话都不可用时下载
+        self.active = 0
+        self.available_at = 0  # time.monotonic()，限流或断开时推迟
+        self.resolved = set()  # 已解析过的频道 id
+
+    def usable(self, now):
+        return self.client.is_connected() and now >= self.available_at
+
+class ClientPool:
+    """多个会话组成的下载池，按当前下载数和 FloodWait 状态分配任务"""
+
+    def __init__(self):
+        self.sessions = []
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, name, client, listener=False):
+        self.sessions.append(PooledSession(name, client, listener))
+
+    def acquire(self, exclude=()):
+        """优先选择可用、下载数最少的工作会话，全部不可用时选择最早恢复的会话"""
+        candidates = [session for session in self.sessions if session not in exclude] or self.sessions
+        now = time.monotonic()
+        usable = [session for session in candidates if session.usable(now)]
+        if usable:
+            session = min(usable, key=lambda session: (session.listener, session.active))
+        else:
+            session = min(candidates, key=lambda session: session.available_at)
+        session.active += 1
+        return session
+
+    def release(self, session):
+        session.active -= 1
+
+    def suspend(self, session, seconds):
+        session.available_at = max(session.available_at, time.monotonic() + seconds)
+        logger.warning(f"会话 {session.name} 暂停分配下载 {seconds} 秒")
+
+async def prepare_session(session, job):
+    """用工作会话重新获取文档，文件引用和频道都以该会话自己的视角为准"""
+    try:
+        if job.chat_id not in session.resolved:
+            await session.client.get_input_entity(job.channel_username or job.chat_id)
+            session.resolved.add(job.chat_id)
+        document = await refresh_document(session.client, job)
+    except (ValueError, errors.RPCError) as e:
+        raise SessionUnavailableError(f"会话 {session.name} 无法访问频道: {str(e)}")
+    job.journal.update_file_reference(document.file_reference)
+    job.journal.save()
+
+class SinkWriter:
+    """给 download_file 用的文件对象，把顺序到达的数据按分段交给 sink
+
+    download_file 只能从头下载，续传前已完成的分段会再收到一次，但不会重复写入。
+    """
+
+    def __init__(self, job, sink, progress_callback=None):
+        self.job = job
+        self.sink = sink
+        self.progress_callback = progress_callback
+        self.part_size = job.journal.part_size
+        self.offset = 0
+        self.completed = set()
+        self.downloaded = 0
+
+    def start(self):
+        # sink 打开后续传记录才是准确的
+        self.completed = set(self.job.journal.completed_parts)
+        self.downloaded = self.job.journal.completed_bytes()
+
+    async def write(self, data):
+        index = self.offset // self.part_size
+        await bandwidth_shaper.acquire(self.job, len(data))
+        if index not in self.completed:
+            await self.sink.write(index, self.offset, bytes(data))
+            self.downloaded += len(data)
+            if self.progress_callback:
+                self.progress_callback(self.downloaded, self.job.file_size)
+        self.offset += len(data)
+
+async def download_from_cdn(client, job, progress_callback):
+    """下载位于 CDN 的文件
+
+    CDN 重定向和解密由 Telethon 的 download_file 处理，数据和分段下载一样经过 sink 写入，
+    续传记录、哈希、磁盘预分配和对象存储上传都保持一致。
+    """
+    journal = job.journal
+    sink = create_sink(journal, job.file_size, trace=job.trace)
+    writer = SinkWriter(job, sink, progress_callback)
+    await sink.open()
+    try:
+        writer.start()
+        await client.download_file(
+            job.document, writer, part_size_kb=journal.part_size // 1024, file_size=job.file_size
+        )
+        if writer.offset != job.file_size:
+            raise RuntimeError(f"CDN 下载不完整: {writer.offset}/{job.file_size}")
+    except BaseException:
+        await sink.abort()
+        raise
+    return await sink.close()
+
+async def download_with_pool(job, progress_callback):
+    """从会话池中选择会话下载，会话被限流或断开时换一个会话继续
+
+    已写入的分段记录在续传记录中，换会话后只下载剩余部分。
+    """
+    tried = set()
+    for _ in range(len(client_pool) * 2):
+        session = client_pool.acquire(exclude=tried)
+        try:
+            delay = session.available_at - time.monotonic()
+            if delay > 0:
+                logger.info(f"所有会话都不可用，等待会话 {session.name} 恢复 ({int(delay)}秒)")
+                await asyncio.sleep(delay)
+            if not session.listener:
+                with job.trace.span('session', name=session.name):
+                    await prepare_session(session, job)
+
+            try:
+                downloader = ParallelDownloader(
+                    session.client, job,
+                    max_flood_wait=FLOOD_FAILOVER_SECONDS if len(client_pool) > 1 else None
+                )
+                return await downloader.download(progress_callback=progress_callback)
+            except CdnRedirectError:
+                logger.info(f"{job.file_name} 位于 CDN，回退到 download_file")
+                with job.trace.span('cdn_download'):
+                    return await download_from_cdn(session.client, job, progress_callback)
+        except SessionUnavailableError as e:
+            if len(client_pool) == 1:
+                raise
+            logger.warning(f"{job.file_name}: {str(e)}，切换会话")
+            client_pool.suspend(session, e.seconds)
+        except ConnectionError as e:
+            if len(client_pool) == 1:
+                raise
+            logger.warning(f"{job.file_name}: 会话 {session.name} 连接失败，切换会话: {str(e)}")
+            client_pool.suspend(session, SESSION_RETRY_DELAY)
+        finally:
+            client_pool.release(session)
+        tried.add(session)
+    raise RuntimeError("所有会话都无法完成下载")
+
+class DownloadLedger:
+    """已下载文档的持久化记录，以 Telegram 文档 id 为键，用于去重"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS downloads (
+                    document_id INTEGER PRIMARY KEY,
+                    chat_id INTEGER,
+                    channel TEXT,
+                    message_id INTEGER,
+                    file_name TEXT,
+                    path TEXT,
+                    size INTEGER,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    enqueued_at REAL,
+                    started_at REAL,
+                    completed_at REAL
+                )
+                """
+            )
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    chat_id INTEGER PRIMARY KEY,
+                    message_id INTEGER NOT NULL,
+                    updated_at REAL
+                )
+                """
+            )
+            columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(downloads)")}
+            if 'sha256' not in columns:
+                self.conn.execute("ALTER TABLE downloads ADD COLUMN sha256 TEXT")
+
+    def get(self, document_id):
+        return self.conn.execute(
+            "SELECT * FROM downloads WHERE document_id = ?", (document_id,)
+        ).fetchone()
+
+    def record_queued(self, job):
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO downloads
+                    (document_id, chat_id, channel, message_id, file_name, size, status, enqueued_at)
+                VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)
+                """,
+                (job.document.id, job.chat_id, job.channel_username, job.message_id,
+                 job.file_name, job.file_size, job.enqueued_at)
+            )
+
+    def mark_started(self, job):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE downloads SET status = 'downloading', path = ?, started_at = ? WHERE document_id = ?",
+                (job.file_path, time.time(), job.document.id)
+            )
+
+    def mark_completed(self, job, size, sha256, path=None):
+        with self.conn:
+            self.conn.execute(
+                """
+                UPDATE downloads SET status = 'completed', path = ?, size = ?, sha256 = ?,
+                    error = NULL, completed_at = ?
+                WHERE document_id = ?
+                """,
+                (path or job.file_path, size, sha256, time.time(), job.document.id)
+            )
+
+    def mark_failed(self, job, error):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE downloads SET status = 'failed', error = ? WHERE document_id = ?",
+                (error, job.document.id)
+            )
+
+    def reset_interrupted(self, resumable_ids):
+        """把上次进程退出时仍在排队或下载、且没有续传记录的任务标记为中断"""
+        with self.conn:
+            rows = self.conn.execute(
+                "SELECT document_id FROM downloads WHERE status IN ('queued', 'downloading')"
+            ).fetchall()
+            interrupted = [(row['document_id'],) for row in rows if row['document_id'] not in resumable_ids]
+            self.conn.executemany(
+                "UPDATE downloads SET status = 'interrupted' WHERE document_id = ?", interrupted
+            )
+        return len(interrupted)
+
+    def completed_paths(self):
+        """已完成下载的 路径 -> 记录"""
+        rows = self.conn.execute(
+            "SELECT * FROM downloads WHERE status = 'completed' AND path IS NOT NULL"
+        ).fetchall()
+        return {row['path']: row for row in rows}
+
+    def update_path(self, document_id, path):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE downloads SET path = ? WHERE document_id = ?", (path, document_id)
+            )
+
+    def eviction_candidates(self, chat_id=None, before=None):
+        """已完成的下载，按完成时间从早到晚排列，可限定频道和完成时间"""
+        # 只保存在对象存储中的视频不占用本地空间，不参与清理；
+        # 还在 .partial 目录中的相册视频要等相册发布，不能在这之前删除
+        query = (
+            "SELECT * FROM downloads WHERE status = 'completed' AND path IS NOT NULL"
+            " AND path NOT LIKE 's3://%' AND path NOT LIKE ?"
+        )
+        params = ['%.partial' + os.sep + '%']
+        if chat_id is not None:
+            query += " AND chat_id = ?"
+            params.append(chat_id)
+        if before is not None:
+            query += " AND completed_at < ?"
+            params.append(before)
+        return self.conn.execute(query + " ORDER BY completed_at", params).fetchall()
+
+    def mark_evicted(self, document_id):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE downloads SET status = 'evicted' WHERE document_id = ?", (document_id,)
+            )
+
+    def channel_totals(self):
+        """各频道已完成下载的文件数和大小"""
+        return self.conn.execute(
+            """
+            SELECT chat_id, COUNT(*), COALESCE(SUM(size), 0) FROM downloads
+            WHERE status = 'completed' GROUP BY chat_id
+            """
+        ).fetchall()
+
+    def get_checkpoint(self, chat_id):
+        """频道最后处理的消息 id，没有记录时返回 None"""
+        row = self.conn.execute(
+            "SELECT message_id FROM checkpoints WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        return row['message_id'] if row else None
+
+    def set_checkpoint(self, chat_id, message_id):
+        """更新频道的检查点，只会向前推进"""
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO checkpoints (chat_id, message_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    message_id = MAX(message_id, excluded.message_id),
+                    updated_at = excluded.updated_at
+                """,
+                (chat_id, message_id, time.time())
+            )
+
+class StorageStats:
+    """增量维护的存储统计，/status 直接读取，不再遍历下载目录
+
+    启动时用 os.scandir 完整核对一次，之后随下载完成和文件删除更新。
+    """
+
+    def __init__(self, window=THROUGHPUT_WINDOW):
+        self.window = window
+        self.reconciled = False
+        self.total_files = 0
+        self.total_bytes = 0
+        self.channels = {}  # chat_id -> {'files': ..., 'bytes': ...}
+        self.recent = deque()  # (完成时间, chat_id, 本次传输的字节数)
+
+    @staticmethod
+    def scan(root, skip_dirs, tracked=None):
+        """统计 root 下的视频文件数和占用空间，硬链接只计算一次
+
+        tracked 不为空时只统计 (st_dev, st_ino) 在其中的文件。
+        """
+        files = 0
+        inodes = {}
+        pending = [root]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in skip_dirs:
+                            pending.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and is_video_file(entry.name):
+                        stat = entry.stat(follow_symlinks=False)
+                        if tracked is not None and (stat.st_dev, stat.st_ino) not in tracked:
+                            continue
+                        files += 1
+                        inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+        return files, sum(inodes.values())
+
+    def load(self, files, total_bytes, channel_totals):
+        self.total_files = files
+        self.total_bytes = total_bytes
+        self.channels = {
+            chat_id: {'files': count, 'bytes': size} for chat_id, count, size in channel_totals
+        }
+        self.reconciled = True
+
+    def _channel(self, chat_id):
+        return self.channels.setdefault(chat_id, {'files': 0, 'bytes': 0})
+
+    def record_download(self, chat_id, size, transferred, new_bytes):
+        """记录一个新文件，new_bytes 为实际新占用的磁盘空间（重复内容为 0）"""
+        self.total_files += 1
+        self.total_bytes += new_bytes
+        channel = self._channel(chat_id)
+        channel['files'] += 1
+        channel['bytes'] += size
+        self.recent.append((time.time(), chat_id, transferred))
+
+    def record_removal(self, chat_id, size, freed_bytes):
+        """记录一个被删除的文件，freed_bytes 为实际释放的磁盘空间"""
+        self.total_files -= 1
+        self.total_bytes -= freed_bytes
+        channel = self._channel(chat_id)
+        channel['files'] -= 1
+        channel['bytes'] -= size
+
+    def throughput(self):
+        """最近 window 秒内的平均下载速度，返回 (总速度, {chat_id: 速度})"""
+        cutoff = time.time() - self.window
+        while self.recent and self.recent[0][0] < cutoff:
+            self.recent.popleft()
+        per_channel = {}
+        for _, chat_id, transferred in self.recent:
+            per_channel[chat_id] = per_channel.get(chat_id, 0) + transferred
+        total = sum(per_channel.values())
+        return total / self.window, {chat_id: size / self.window for chat_id, size in per_channel.items()}
+
+class DiskGuard:
+    """下载开始前按文件大小预留磁盘空间，空间不够时按淘汰策略删除旧视频
+
+    剩余空间只计算预留中尚未在磁盘上分配的部分（下载开始时会预分配整个文件），
+    配额则按整个文件大小预留，直到下载完成计入存储统计。
+    """
+
+    def __init__(self):
+        self.reservations = {}  # document_id -> (文件大小, .part 路径)
+        self.lock = asyncio.Lock()
+
+    def shortfall(self, size, part_path):
+        """再预留 size 字节还差多少空间，空间足够时返回 0 或负数"""
+        pending = sum(
+            max(0, reserved - allocated_bytes(path)) for reserved, path in self.reservations.values()
+        )
+        pending += max(0, size - allocated_bytes(part_path))
+        short = MIN_FREE_SPACE + pending - shutil.disk_usage(DOWNLOAD_PATH).free
+        if DISK_QUOTA:
+            reserved = sum(reserved for reserved, _ in self.reservations.values()) + size
+            short = max(short, storage_stats.total_bytes + reserved - DISK_QUOTA)
+        return short
+
+    async def reserve(self, job):
+        async with self.lock:
+            short = self.shortfall(job.file_size, job.journal.part_path)
+            if short > 0 and EVICTION_POLICY != 'off':
+                loop = asyncio.get_running_loop()
+                candidates = ledger.eviction_candidates()
+                available = await loop.run_in_executor(None, evictable_bytes, candidates)
+                if available >= short:
+                    if EVICTION_POLICY == 'lru':
+                        candidates = await loop.run_in_executor(None, sort_by_access, candidates)
+                    await evict_downloads(candidates, short, reason="空间不足")
+                    short = self.shortfall(job.file_size, job.journal.part_path)
+                else:
+                    # 删光也不够时一个都不删
+                    logger.warning(
+                        f"空间不足 {format_size(short)}，可清理的视频只有 {format_size(available)}，不清理"
+                    )
+            if short > 0:
+                raise DiskSpaceError(f"磁盘空间不足，还需要 {format_size(short)}")
+            self.reservations[job.document.id] = (job.file_size, job.journal.part_path)
+
+    def release(self, job):
+        self.reservations.pop(job.document.id, None)
+
+def evictable_bytes(records):
+    """删除 records 中的所有视频最多能释放的字节数，其它位置还有硬链接的文件不计"""
+    inodes = {}  # (st_dev, st_ino) -> [文件大小, 剩余链接数]
+    for record in records:
+        try:
+            stat = os.stat(record['path'])
+        except FileNotFoundError:
+            continue
+        key = (stat.st_dev, stat.st_ino)
+        if key not in inodes:
+            links = stat.st_nlink
+            if record['sha256']:
+                # 存储对象在内容不再被引用时一并删除，见 remove_download
+                with contextlib.suppress(FileNotFoundError):
+                    if os.stat(object_file(record['sha256'])).st_ino == stat.st_ino:
+                        links -= 1
+            inodes[key] = [stat.st_size, links]
+        inodes[key][1] -= 1
+    return sum(size for size, links in inodes.values() if links <= 0)
+
+def tracked_inodes(paths):
+    """paths 中已存在的文件的 (st_dev, st_ino)"""
+    inodes = set()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        inodes.add((stat.st_dev, stat.st_ino))
+    return inodes
+
+def sort_by_access(records):
+    """按文件最后访问时间从早到晚排列，文件已不存在的排在最前"""
+    def access_time(record):
+        try:
+            return os.stat(record['path']).st_atime
+        except OSError:
+            return 0
+    return sorted(records, key=access_time)
+
+async def evict_downloads(records, needed=None, reason="", by_size=False):
+    """依次删除 records 中的视频，直到释放 needed 字节（by_size 时按文件大小计）
+
+    返回释放的字节数。
+    """
+    loop = asyncio.get_running_loop()
+    released = 0
+    for record in records:
+        if needed is not None and released >= needed:
+            break
+        freed = await loop.run_in_executor(None, remove_download, record['path'], record['sha256'])
+        ledger.mark_evicted(record['document_id'])
+        if freed is None:
+            continue
+        storage_stats.record_removal(record['chat_id'], record['size'] or 0, freed)
+        released += (record['size'] or 0) if by_size else freed
+        logger.info(f"{reason}，删除视频: {record['path']} (释放 {format_size(freed)})")
+    return released
+
+async def retention_loop():
+    """定期按保存天数和频道配额清理旧视频"""
+    while True:
+        try:
+            if RETENTION_DAYS:
+                cutoff = time.time() - RETENTION_DAYS * 86400
+                await evict_downloads(
+                    ledger.eviction_candidates(before=cutoff), reason=f"超过 {RETENTION_DAYS} 天"
+                )
+            if CHANNEL_QUOTA:
+                for chat_id, _, size in ledger.channel_totals():
+                    if size > CHANNEL_QUOTA:
+                        await evict_downloads(
+                            ledger.eviction_candidates(chat_id=chat_id), size - CHANNEL_QUOTA,
+                            reason=f"频道 {channel_label(chat_id)} 超过配额", by_size=True
+                        )
+        except Exception as e:
+            logger.error(f"清理旧视频时出错: {str(e)}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+ledger = DownloadLedger(LEDGER_PATH)
+storage_stats = StorageStats()
+disk_guard = DiskGuard()
+client_pool = ClientPool()
+media_pool = MediaSenderPool()
+object_store = ObjectStore(S3_BUCKET)
+download_queue = DownloadQueue(DOWNLOAD_QUEUE_SIZE)
+# worker_id -> 正在下载的任务
+active_downloads = {}
+
+class Metrics:
+    """进程内的计数器、直方图和即时值，以 Prometheus 文本格式输出
+
+    只在内存中累加，记录一次的开销很小，可以在下载热路径上调用。
+    """
+
+    DURATION_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 14400)
+    SPEED_BUCKETS = tuple(2 ** power for power in range(16, 28, 2))  # 64KiB/s - 128MiB/s
+    LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.kinds = {}  # 指标名 -> (类型, 说明, 直方图分桶)
+        self.values = {}  # (指标名, 标签) -> 计数器的值或直方图 [各桶计数, 总和, 次数]
+        self.gauges = {}  # 指标名 -> 返回当前值的函数
+        self.server = None
+
+    def counter(self, name, help_text):
+        self.kinds[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self.kinds[name] = ('histogram', help_text, buckets)
+
+    def gauge(self, name, help_text, func):
+        self.kinds[name] = ('gauge', help_text, None)
+        self.gauges[name] = func
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.kinds[name][2]
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(buckets), 0.0, 0]
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for key, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        """生成 Prometheus 文本格式的全部指标"""
+        lines = []
+        for name, (kind, help_text, buckets) in self.kinds.items():
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if kind == 'gauge':
+                try:
+                    lines.append(f"{full_name} {self.gauges[name]()}")
+                except Exception as e:
+                    logger.error(f"读取指标 {name} 时出错: {str(e)}")
+                continue
+            for (metric, labels), value in self.values.items():
+                if metric != name:
+                    continue
+                if kind == 'counter':
+                    lines.append(f"{full_name}{self._labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{full_name}_bucket{self._labels(labels, [('le', bound)])} {bucket_count}")
+                lines.append(f"{full_name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{full_name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{full_name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            # 读完请求头，只处理 GET /metrics
+            while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        try:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        except OSError as e:
+            logger.error(f"无法启动指标接口: {str(e)}")
+            return
+        logger.info(f"Metrics endpoint: http://{host}:{port}/metrics")
+
+    async def watch_loop_lag(self, interval=1.0):
+        """定时测量事件循环的调度延迟"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.observe('event_loop_lag_seconds', max(0.0, loop.time() - expected))
+
+metrics = Metrics('telegram_downloader')
+metrics.counter('downloaded_bytes_total', '各频道本次运行下载的字节数（不含续传前已下载的部分）')
+metrics.counter('downloads_total', '按结果统计的下载任务数')
+metrics.histogram('download_duration_seconds', '单个下载的用时', Metrics.DURATION_BUCKETS)
+metrics.histogram('download_speed_bytes_per_second', '单个下载的平均速度', Metrics.SPEED_BUCKETS)
+metrics.histogram('queue_wait_seconds', '任务从入队到开始下载的等待时间', Metrics.DURATION_BUCKETS)
+metrics.histogram('event_loop_lag_seconds', '事件循环的调度延迟', Metrics.LAG_BUCKETS)
+metrics.counter('flood_waits_total', '触发 FloodWait 的次数')
+metrics.counter('flood_wait_seconds_total', 'FloodWait 要求等待的总秒数')
+metrics.counter('outgoing_messages_total', '发送和编辑的消息数')
+metrics.counter('media_senders_total', '下载使用的媒体 DC 连接数，按复用和新建统计')
+metrics.counter('s3_uploaded_bytes_total', '上传到对象存储的字节数')
+metrics.counter('outgoing_dropped_total', '被丢弃的进度编辑数')
+metrics.gauge('queue_length', '排队中的下载任务数', lambda: len(download_queue))
+metrics.gauge('active_downloads', '正在进行的下载数', lambda: len(active_downloads))
+metrics.gauge('disk_free_bytes', '下载目录所在磁盘的剩余空间', lambda: shutil.disk_usage(DOWNLOAD_PATH).free)
+metrics.gauge('stored_bytes', '下载目录中视频占用的空间', lambda: storage_stats.total_bytes)
+
+# 保存和加载频道配置
+def save_channels():
+    channels = [{'id': chat_id, **info} for chat_id, info in monitored_channels.items()]
+    tmp_path = CHANNELS_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': CHANNELS_VERSION, 'channels': channels}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, CHANNELS_PATH)
+    logger.info(f"保存频道配置: {len(monitored_channels)} 个频道")
+
+def load_channels():
+    """加载频道配置，返回旧版本配置中尚未解析为 id 的频道用户名"""
+    try:
+        with open(CHANNELS_PATH, 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        logger.info("没有找到频道配置文件")
+        return []
+
+    # 第一版配置只是用户名列表
+    if isinstance(data, list):
+        return data
+
+    for channel in data['channels']:
+        channel = dict(channel)
+        monitored_channels[channel.pop('id')] = channel
+    logger.info(f"加载频道配置: {len(monitored_channels)} 个频道")
+    return []
+
+async def migrate_channels(client, usernames):
+    """把旧版本配置中的频道用户名解析为稳定的频道 id"""
+    for username in usernames:
+        try:
+            entity = await client.get_entity(username)
+        except Exception as e:
+            logger.error(f"无法解析频道 @{username}，已从配置中移除: {str(e)}")
+            continue
+        monitored_channels[utils.get_peer_id(entity)] = {
+            'username': entity.username,
+            'title': entity.title,
+        }
+    save_channels()
+    logger.info(f"频道配置已升级到版本 {CHANNELS_VERSION}")
+
+def channel_label(chat_id):
+    """频道的显示名称"""
+    info = monitored_channels.get(chat_id, {})
+    if info.get('username'):
+        return f"@{info['username']}"
+    return info.get('title') or str(chat_id)
+
+def find_channel(text):
+    """根据用户名、@用户名或 id 查找已监控的频道"""
+    name = text.strip().lstrip('@').lower()
+    for chat_id, info in monitored_channels.items():
+        if str(chat_id) == name or (info.get('username') or '').lower() == name:
+            return chat_id
+    return None
+
+def parse_size(text):
+    """解析 500MB、1.5G、1024 这样的文件大小，单位按 1024 进位"""
+    match = re.fullmatch(r'([\d.]+)\s*([kmgt]?)i?b?', text.strip().lower())
+    if not match:
+        raise ValueError(f"无法解析文件大小: {text}")
+    unit = match.group(2)
+    return int(float(match.group(1)) * 1024 ** ('kmgt'.index(unit) + 1 if unit else 0))
+
+def parse_duration(text):
+    """解析 90、30s、5m、1.5h 这样的时长，返回秒数"""
+    match = re.fullmatch(r'([\d.]+)\s*([smh]?)', text.strip().lower())
+    if not match:
+        raise ValueError(f"无法解析时长: {text}")
+    return int(float(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match.group(2)])
+
+def parse_switch(text):
+    value = text.strip().lower()
+    if value in ('on', 'yes', 'true', '1'):
+        return True
+    if value in ('off', 'no', 'false', '0'):
+        return False
+    raise ValueError(f"请使用 on 或 off: {text}")
+
+# 频道过滤规则: 名称 -> (说明, 解析函数)
+FILTER_RULES = {
+    'min_size': ("最小文件大小，如 10MB", parse_size),
+    'max_size': ("最大文件大小，如 2GB", parse_size),
+    'min_duration': ("最短时长，如 30s、5m", parse_duration),
+    'max_duration': ("最长时长，如 2h", parse_duration),
+    'min_height': ("最低分辨率（画面高度），如 720", int),
+    'max_height': ("最高分辨率（画面高度），如 1080", int),
+    'include': ("文件名需要匹配的通配符，如 *.mkv", str),
+    'exclude': ("文件名不能匹配的通配符，如 *sample*", str),
+    'skip_round': ("跳过圆形视频消息，on/off", parse_switch),
+    'skip_gif': ("跳过 GIF 类的无声短片，on/off", parse_switch),
+}
+
+def format_rule(name, value):
+    if name.endswith('_size'):
+        return f"{name}={format_size(value)}"
+    if name.endswith('_duration'):
+        return f"{name}={value}s"
+    if isinstance(value, bool):
+        return f"{name}={'on' if value else 'off'}"
+    return f"{name}={value}"
+
+def check_rules(rules, size, file_name, duration=None, height=None, round_message=False, animated=False):
+    """在下载前按频道的过滤规则检查视频，需要跳过时返回原因，否则返回 None
+
+    视频没有对应属性（例如缺少时长）时，相关规则不生效。
+    """
+    if not rules:
+        return None
+    if 'min_size' in rules and size < rules['min_size']:
+        return f"文件小于 {format_size(rules['min_size'])}"
+    if 'max_size' in rules and size > rules['max_size']:
+        return f"文件大于 {format_size(rules['max_size'])}"
+    if duration is not None:
+        if 'min_duration' in rules and duration < rules['min_duration']:
+            return f"时长短于 {rules['min_duration']} 秒"
+        if 'max_duration' in rules and duration > rules['max_duration']:
+            return f"时长超过 {rules['max_duration']} 秒"
+    if height:
+        if 'min_height' in rules and height < rules['min_height']:
+            return f"分辨率低于 {rules['min_height']}p"
+        if 'max_height' in rules and height > rules['max_height']:
+            return f"分辨率高于 {rules['max_height']}p"
+    name = file_name.lower()
+    if 'include' in rules and not fnmatch.fnmatch(name, rules['include'].lower()):
+        return f"文件名不匹配 {rules['include']}"
+    if 'exclude' in rules and fnmatch.fnmatch(name, rules['exclude'].lower()):
+        return f"文件名匹配 {rules['exclude']}"
+    if rules.get('skip_round') and round_message:
+        return "圆形视频消息"
+    if rules.get('skip_gif') and animated:
+        return "GIF 类短片"
+    return None
+
+def update_rules(chat_id, args):
+    """按 name=value 参数修改频道的过滤规则，值为空时删除该规则，clear 清空所有规则"""
+    info = monitored_channels[chat_id]
+    rules = dict(info.get('rules', {}))
+    for arg in args:
+        if arg == 'clear':
+            rules.clear()
+            continue
+        name, _, value = arg.partition('=')
+        if name not in FILTER_RULES:
+            raise ValueError(f"未知的规则: {name}")
+        if value:
+            rules[name] = FILTER_RULES[name][1](value)
+        else:
+            rules.pop(name, None)
+    if rules:
+        info['rules'] = rules
+    else:
+        info.pop('rules', None)
+    save_channels()
+
+def describe_rules(chat_id):
+    rules = monitored_channels[chat_id].get('rules')
+    if not rules:
+        return f"{channel_label(chat_id)} 没有过滤规则，所有视频都会下载"
+    return f"{channel_label(chat_id)} 的过滤规则:\n" + "\n".join(
+        f"- {format_rule(name, value)}" for name, value in rules.items()
+    )
+
+FILTER_HELP = (
+    "用法: /filter <频道> [规则=值 ...]\n"
+    "不带规则时查看当前规则，值为空时删除该规则，clear 清空所有规则\n"
+    + "\n".join(f"- {name}: {description}" for name, (description, _) in FILTER_RULES.items())
+)
+
+# 部分系统的 mime.types 中没有 mkv
+mimetypes.add_type('video/x-matroska', '.mkv')
+
+def is_video_file(name):
+    """根据扩展名判断是否为下载的视频文件"""
+    mime_type = mimetypes.guess_type(name)[0]
+    return mime_type is not None and mime_type.startswith('video/')
+
+async def reconcile_storage():
+    """启动时完整扫描一次下载目录，之后的统计都增量更新
+
+    只统计下载记录中的视频（包括它们的硬链接），和清理时的候选范围一致。
+    没有下载记录的旧文件（平铺存放或 /migrate 后放在 unsorted 中的视频）不计入配额，也不会被自动清理。
+    """
+    skip_dirs = {OBJECTS_PATH, DATA_PATH, os.path.join(DOWNLOAD_PATH, 'logs'), os.path.dirname(SESSION_PATH)}
+    loop = asyncio.get_running_loop()
+    paths = [path for path in ledger.completed_paths() if not is_object_url(path)]
+    tracked = await loop.run_in_executor(None, tracked_inodes, paths)
+    files, total_bytes = await loop.run_in_executor(
+        None, StorageStats.scan, DOWNLOAD_PATH, skip_dirs, tracked
+    )
+    storage_stats.load(files, total_bytes, ledger.channel_totals())
+    logger.info(f"存储统计完成: {files} 个文件, {format_size(total_bytes)}")
+
+def format_size(size):
+    """格式化文件大小"""
+    return humanize.naturalsize(size, binary=True)
+
+class TokenBucket:
+    """令牌桶，rate 为每秒补充的令牌数，capacity 为允许的突发量"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now, amount=1):
+        """距离 amount 个令牌可用还需等待的秒数"""
+        self._refill(now)
+        return 0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, now, amount=1):
+        self._refill(now)
+        self.tokens -= amount
+
+    def set_rate(self, now, rate, capacity):
+        self._refill(now)
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+
+def parse_schedule(text):
+    """解析 09:00-18:00=20MB,18:00-23:00=50MB 这样的限速时间表，返回 [(开始分钟, 结束分钟, 速度)]"""
+    schedule = []
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)', item)
+        if not match:
+            raise ValueError(f"无法解析限速时间段: {item}")
+        start = int(match.group(1)) * 60 + int(match.group(2))
+        end = int(match.group(3)) * 60 + int(match.group(4))
+        schedule.append((start, end, parse_rate(match.group(5))))
+    return schedule
+
+def parse_rate(text):
+    return 0 if text.strip().lower() in ('off', '0', '') else parse_size(text)
+
+def format_rate(rate):
+    return f"{format_size(rate)}/s" if rate else "不限速"
+
+class BandwidthShaper:
+    """下载限速，全局、每个频道和补抓任务各用一个以字节为单位的令牌桶
+
+    全局限速可以按时间段变化。被 /priority 提升的任务只受全局限速约束。
+    令牌不足一个分段时先欠着，之后的请求等待补足，平均速度仍然准确。
+    """
+
+    def __init__(self):
+        self.global_rate = parse_rate(BANDWIDTH_LIMIT)
+        self.backfill_rate = parse_rate(BACKFILL_BANDWIDTH)
+        self.schedule = parse_schedule(BANDWIDTH_SCHEDULE)
+        self.buckets = {}
+
+    def current_rate(self, now=None):
+        """当前时间段的全局限速"""
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if start <= minute < end or (start > end and (minute >= start or minute < end)):
+                return rate
+        return self.global_rate
+
+    def _limits(self, job):
+        limits = [('global', self.current_rate())]
+        if not job.bumped:
+            limits.append((job.chat_id, monitored_channels.get(job.chat_id, {}).get('bandwidth', 0)))
+            if job.backfill:
+                limits.append(('backfill', self.backfill_rate))
+        return limits
+
+    async def acquire(self, job, amount):
+        """下载 amount 字节之前调用，超过限速时等待"""
+        for key, rate in self._limits(job):
+            if not rate:
+                continue
+            now = time.monotonic()
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate, rate)
+            elif bucket.rate != rate:
+                bucket.set_rate(now, rate, rate)
+            while True:
+                wait = bucket.wait_time(now, min(amount, bucket.capacity))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+                now = time.monotonic()
+            bucket.take(now, amount)
+
+    def describe(self):
+        lines = [f"全局: {format_rate(self.current_rate())}"]
+        if self.schedule:
+            lines.append("时间表: " + ", ".join(
+                f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}={format_rate(rate)}"
+                for start, end, rate in self.schedule
+            ) + f"（其余时间 {format_rate(self.global_rate)}）")
+        lines.append(f"补抓: {format_rate(self.backfill_rate)}")
+        lines += [
+            f"{channel_label(chat_id)}: {format_rate(info['bandwidth'])}"
+            for chat_id, info in monitored_channels.items() if info.get('bandwidth')
+        ]
+        return "\n".join(lines)
+
+bandwidth_shaper = BandwidthShaper()
+
+class OutgoingMessage:
+    """待发送的消息或待执行的编辑"""
+
+    def __init__(self, chat_id, text, priority, message=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.priority = priority
+        self.message = message
+        self.future = asyncio.get_running_loop().create_future()
+
+    @property
+    def edit_key(self):
+        return (self.chat_id, self.message.id) if self.message is not None else None
+
+class Outbox:
+    """统一调度所有发出的消息和编辑
+
+    - 按会话和全局两级令牌桶限速
+    - 遇到 FloodWait 时自动暂停，等待结束后重新发送
+    - 同一条消息尚未执行的编辑会被合并，只发送最新的内容
+    - 积压时先发送完成和错误通知，过多的低优先级进度编辑会被丢弃
+    """
+
+    HIGH = 0
+    LOW = 1
+
+    def __init__(self, global_rate, chat_rate, max_low=OUTBOX_MAX_LOW):
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.max_low = max_low
+        self.queues = {self.HIGH: deque(), self.LOW: deque()}
+        self.pending_edits = {}
+        self.flood_until = 0
+        self.client = None
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+
+    def __len__(self):
+        return sum(len(pending) for pending in self.queues.values())
+
+    def start(self, client):
+        self.client = client
+        return asyncio.create_task(self.run())
+
+    def _enqueue(self, item):
+        pending = self.queues[item.priority]
+        pending.append(item)
+        if item.priority == self.LOW and len(pending) > self.max_low:
+            # 丢弃最旧的进度编辑
+            dropped = pending.popleft()
+            if dropped.edit_key is not None:
+                self.pending_edits.pop(dropped.edit_key, None)
+            dropped.future.set_result(None)
+            metrics.inc('outgoing_dropped_total')
+        self._wakeup.set()
+        return item.future
+
+    def send(self, chat_id, text, priority=HIGH):
+        """排队发送一条新消息，返回的 future 在发送后得到消息对象，被丢弃时为 None"""
+        return self._enqueue(OutgoingMessage(chat_id, text, priority))
+
+    def respond(self, event, text, priority=HIGH):
+        return self.send(event.chat_id, text, priority)
+
+    def edit(self, message, text, priority=LOW):
+        """排队编辑一条消息，同一条消息尚未执行的编辑只保留最新内容"""
+        key = (message.chat_id, message.id)
+        pending = self.pending_edits.get(key)
+        if pending is not None:
+            pending.text = text
+            if priority < pending.priority:
+                # 提升优先级，例如进度编辑被完成通知取代
+                self.queues[pending.priority].remove(pending)
+                pending.priority = priority
+                self.queues[priority].append(pending)
+                self._wakeup.set()
+            return pending.future
+        item = OutgoingMessage(message.chat_id, text, priority, message)
+        self.pending_edits[key] = item
+        return self._enqueue(item)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, max(1, self.chat_rate * 3))
+        return bucket
+
+    def _next_item(self, now):
+        """取出下一个可以立即发送的消息，没有时返回 (None, 需要等待的秒数)"""
+        wait = max(0, self.flood_until - now, self.global_bucket.wait_time(now))
+        if wait > 0:
+            return None, wait
+        wait = None
+        for priority in (self.HIGH, self.LOW):
+            pending = self.queues[priority]
+            for item in pending:
+                chat_wait = self._chat_bucket(item.chat_id).wait_time(now)
+                if chat_wait == 0:
+                    pending.remove(item)
+                    return item, 0
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    async def _perform(self, item):
+        if item.message is None:
+            return await self.client.send_message(item.chat_id, item.text)
+        try:
+            return await item.message.edit(item.text)
+        except errors.MessageNotModifiedError:
+            return item.message
+
+    async def _execute(self, item):
+        try:
+            result = await self._perform(item)
+        except errors.FloodWaitError as e:
+            logger.warning(f"发送消息触发 FloodWait，暂停 {e.seconds} 秒")
+            metrics.inc('flood_waits_total', source='outbox')
+            metrics.inc('flood_wait_seconds_total', e.seconds, source='outbox')
+            self.flood_until = max(self.flood_until, time.monotonic() + e.seconds)
+            if item.message is not None and self.pending_edits.get(item.edit_key) not in (None, item):
+                # 等待期间已有更新的编辑，这次的内容作废
+                item.future.set_result(None)
+                return
+            if item.edit_key is not None:
+                self.pending_edits[item.edit_key] = item
+            self.queues[item.priority].appendleft(item)
+            self._wakeup.set()
+        except Exception as e:
+            logger.error(f"发送消息时出错: {str(e)}")
+            item.future.set_result(None)
+        else:
+            metrics.inc('outgoing_messages_total', kind='send' if item.message is None else 'edit')
+            item.future.set_result(result)
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            item, wait = self._next_item(now)
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if item.edit_key is not None and self.pending_edits.get(item.edit_key) is item:
+                del self.pending_edits[item.edit_key]
+            self.global_bucket.take(now)
+            self._chat_bucket(item.chat_id).take(now)
+            task = asyncio.create_task(self._execute(item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+outbox = Outbox(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE)
+
+class ProgressBoard:
+    """在内存中记录所有进行中的下载，由单个任务定时把汇总结果编辑到一条面板消息中
+
+    下载过程只更新内存中的状态，不直接发送消息，因此并发下载数再多，
+    每个刷新周期也最多只会编辑一次消息。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.transfers = {}
+        self.message = None
+        self._last_text = None
+
+    def start(self, key, file_name, total, current=0):
+        self.transfers[key] = {
+            'file_name': file_name,
+            'current': current,
+            'total': total,
+            'start_bytes': current,
+            'start_time': time.time(),
+        }
+
+    def update(self, key, current, total):
+        transfer = self.transfers.get(key)
+        if transfer is not None:
+            transfer['current'] = current
+            transfer['total'] = total
+
+    def finish(self, key):
+        self.transfers.pop(key, None)
+
+    def render(self):
+        """生成面板文本"""
+        now = time.time()
+        lines = [f"📥 正在下载 ({len(self.transfers)})"]
+        for transfer in self.transfers.values():
+            current, total = transfer['current'], transfer['total']
+            progress = current / total if total else 0
+            elapsed = now - transfer['start_time']
+            speed = (current - transfer['start_bytes']) / elapsed if elapsed > 0 else 0
+            eta = (total - current) / speed if speed > 0 else 0
+
+            # 创建进度条
+            bar_length = 10
+            filled = int(progress * bar_length)
+            bar = '█' * filled + '░' * (bar_length - filled)
+
+            lines.append(
+                f"\n{transfer['file_name']}\n"
+                f"{bar} {progress * 100:.1f}% "
+                f"{format_size(current)}/{format_size(total)} "
+                f"{format_size(speed)}/s 剩余 {int(eta)}秒"
+            )
+        return "\n".join(lines)
+
+    async def _refresh(self):
+        if not self.transfers:
+            if self.message is not None:
+                # 一批下载结束，下次有新下载时发送新的面板消息
+                await outbox.edit(self.message, "✅ 当前没有进行中的下载")
+                self.message = None
+                self._last_text = None
+            return
+
+        text = self.render()
+        if text == self._last_text:
+            return
+        if self.message is None:
+            self.message = await outbox.send(ADMIN_USER_ID, text, priority=Outbox.LOW)
+        else:
+            await outbox.edit(self.message, text)
+        self._last_text = text
+
+    async def run(self):
+        """按固定周期刷新面板"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._refresh()
+            except Exception as e:
+                logger.error(f"更新进度面板时出错: {str(e)}")
+
+progress_board = ProgressBoard(DASHBOARD_INTERVAL)
+
+def build_download_job(chat_id, channel_username, message):
+    """从消息中的视频文档构建下载任务，不是视频时返回 None"""
+    media = message.media
+    if not media or not hasattr(media, 'document'):
+        return None
+
+    document = media.document
+    mime_type = document.mime_type
+
+    # 只处理视频文件
+    if not mime_type or not mime_type.startswith('video/'):
+        return None
+
+    # 获取文件名，去掉其中可能包含的目录
+    for attribute in document.attributes:
+        if hasattr(attribute, 'file_name') and attribute.file_name:
+            file_name = os.path.basename(attribute.file_name.replace('\\', '/'))
+            break
+    else:
+        file_name = ''
+    if not file_name:
+        file_name = f"video_{message.id}{mimetypes.guess_extension(mime_type) or '.mp4'}"
+
+    # 按频道的过滤规则检查，在任何数据传输之前跳过不需要的视频
+    video = next(
+        (attribute for attribute in document.attributes if isinstance(attribute, types.DocumentAttributeVideo)),
+        None
+    )
+    reason = check_rules(
+        monitored_channels.get(chat_id, {}).get('rules'),
+        document.size,
+        file_name,
+        duration=video.duration if video else None,
+        height=video.h if video else None,
+        round_message=bool(video and video.round_message),
+        animated=any(isinstance(attribute, types.DocumentAttributeAnimated) for attribute in document.attributes)
+    )
+    if reason:
+        logger.info(f"按过滤规则跳过 {file_name}: {reason}")
+        return None
+
+    return DownloadJob(chat_id, channel_username, message.id, document, file_name, message.date)
+
+def build_file_path(chat_id, channel_username, message_id, file_name, date=None):
+    """按存储布局生成文件路径
+
+    文件名以消息 id 开头，同一频道内不会重复，因此不需要逐个检查文件是否已存在。
+    布局中不含频道时再加上频道 id。
+    """
+    date = date or datetime.now()
+    directory = os.path.join(VIDEO_PATH, STORAGE_LAYOUT.format(
+        channel=channel_username or str(chat_id),
+        year=f"{date.year:04d}",
+        month=f"{date.month:02d}",
+        day=f"{date.day:02d}"
+    ))
+    prefix = f"{message_id}" if '{channel}' in STORAGE_LAYOUT else f"{abs(chat_id)}_{message_id}"
+    return os.path.join(directory, f"{prefix}_{file_name}")
+
+def job_file_path(job):
+    if job.album is not None:
+        return job.album.file_path(job)
+    return build_file_path(job.chat_id, job.channel_username, job.message_id, job.file_name, job.date)
+
+class AlbumBatch:
+    """一个相册（grouped_id 相同的多条消息）中的视频，作为一批下载
+
+    各个视频仍是独立的任务，由多个 worker 并行下载，但共用一个相册目录和一条状态消息。
+    下载时写入 <相册目录>.partial，所有视频都完成后整体改名为相册目录，
+    因此相册目录出现时内容总是完整的。
+    """
+
+    def __init__(self, chat_id, grouped_id, directory, parts):
+        self.chat_id = chat_id
+        self.grouped_id = grouped_id
+        self.directory = directory
+        self.staging = directory + '.partial'
+        self.parts = parts  # message_id -> document_id
+        self.completed = {}  # message_id -> 文件大小
+        self.failed = {}  # message_id -> 错误信息
+        self.downloaded = set()  # 下载到 .partial 目录中的视频，发布后需要更新下载记录中的路径
+        self.started_at = time.time()
+        self.status = None  # 状态消息的 future
+        self._tasks = set()  # 更新状态消息的任务，保留引用避免被回收
+
+    @classmethod
+    def create(cls, chat_id, channel_username, grouped_id, jobs, date=None):
+        first_id = min(job.message_id for job in jobs)
+        base = os.path.dirname(build_file_path(chat_id, channel_username, first_id, '', date))
+        album = cls(
+            chat_id, grouped_id, os.path.join(base, f"{first_id}_album"),
+            {job.message_id: job.document.id for job in jobs}
+        )
+        for job in jobs:
+            job.album = album
+            # 同一相册的视频同时入队，排序时不会被其它任务隔开
+            job.enqueued_at = album.started_at
+        return album
+
+    @classmethod
+    def from_journal(cls, data, jobs):
+        """根据续传记录中的相册信息重建相册，不在 jobs 中的视频按下载记录判断是否已完成"""
+        parts = {int(message_id): document_id for message_id, document_id in data['parts'].items()}
+        album = cls(jobs[0].chat_id, data['grouped_id'], data['directory'], parts)
+        resumed = {job.message_id for job in jobs}
+        for message_id, document_id in parts.items():
+            if message_id in resumed:
+                continue
+            record = ledger.get(document_id)
+            if record is not None and record['status'] == 'completed':
+                album.completed[message_id] = record['size'] or 0
+                if (record['path'] or '').startswith(album.staging + os.sep):
+                    album.downloaded.add(message_id)
+            else:
+                album.failed[message_id] = "上次运行中未完成且无法续传"
+        for job in jobs:
+            job.album = album
+        return album
+
+    def journal_data(self):
+        return {
+            'grouped_id': self.grouped_id,
+            'directory': self.directory,
+            'parts': {str(message_id): document_id for message_id, document_id in self.parts.items()},
+        }
+
+    def file_path(self, job):
+        return os.path.join(self.staging, f"{job.message_id}_{job.file_name}")
+
+    def _text(self, title):
+        lines = [
+            title,
+            f"频道: {channel_label(self.chat_id)}",
+            f"进度: {len(self.completed)}/{len(self.parts)} 个视频, {format_size(sum(self.completed.values()))}",
+        ]
+        lines += [f"❌ 消息 {message_id}: {error}" for message_id, error in self.failed.items()]
+        return "\n".join(lines)
+
+    async def _report(self, text, priority):
+        message = await self.status
+        if message is not None:
+            outbox.edit(message, text, priority=priority)
+
+    def start(self, title="📦 开始下载相册"):
+        self.status = outbox.send(ADMIN_USER_ID, self._text(f"{title} ({len(self.parts)} 个视频)"))
+        self._settle()
+
+    def part_done(self, job, size, downloaded=True):
+        self.completed[job.message_id] = size
+        if downloaded:
+            self.downloaded.add(job.message_id)
+        self._settle()
+
+    def part_failed(self, job, error):
+        self.failed[job.message_id] = error
+        self._settle()
+
+    def _settle(self):
+        if self.status is None:
+            # 状态消息还没发出，入队完成后由 start 统一汇报
+            return
+        if len(self.completed) + len(self.failed) < len(self.parts):
+            self._spawn(self._report(self._text("📦 正在下载相册"), Outbox.LOW))
+        else:
+            self._spawn(self._finish())
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"更新相册 {self.grouped_id} 的状态时出错: {str(task.exception())}")
+
+    async def _finish(self):
+        if self.failed:
+            await self._report(
+                self._text("⚠️ 相册下载不完整，已完成的视频保留在 .partial 目录中"), Outbox.HIGH
+            )
+            logger.warning(f"相册 {self.grouped_id} 下载不完整: {len(self.completed)}/{len(self.parts)}")
+            return
+        try:
+            moved = await asyncio.get_running_loop().run_in_executor(None, self._publish)
+        except OSError as e:
+            await self._report(self._text(f"❌ 相册已下载完但无法移动到相册目录: {str(e)}"), Outbox.HIGH)
+            logger.error(f"无法发布相册 {self.staging}: {str(e)}")
+            return
+        for document_id, path in moved:
+            ledger.update_path(document_id, path)
+        duration = time.time() - self.started_at
+        await self._report(self._text(f"✅ 相册下载完成，用时 {int(duration)}秒"), Outbox.HIGH)
+        logger.info(f"相册下载完成: {self.directory} ({len(self.parts)} 个视频)")
+
+    def _publish(self):
+        """把 .partial 目录改名为相册目录，相册目录已存在时逐个移入
+
+        返回本相册下载的视频的 [(document_id, 新路径)]。
+        """
+        names = os.listdir(self.staging)
+        if not os.path.exists(self.directory):
+            os.rename(self.staging, self.directory)
+        else:
+            for name in names:
+                os.replace(os.path.join(self.staging, name), os.path.join(self.directory, name))
+            os.rmdir(self.staging)
+        moved = []
+        for name in names:
+            prefix = name.split('_', 1)[0]
+            if prefix.isdigit() and int(prefix) in self.downloaded and not name.endswith('.trace.jsonl'):
+                moved.append((self.parts[int(prefix)], os.path.join(self.directory, name)))
+        return moved
+
+def migrate_flat_files(known_paths):
+    """把旧版本平铺在 DOWNLOAD_PATH 下的视频移动到分层目录
+
+    known_paths 为下载记录中的 路径 -> 记录，有记录的文件按原频道和消息 id 放置，
+    其余文件按修改时间放入 unsorted 目录。返回 [(document_id, 新路径)]。
+    """
+    moved = []
+    with os.scandir(DOWNLOAD_PATH) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False) or not is_video_file(entry.name):
+                continue
+            record = known_paths.get(entry.path)
+            mtime = datetime.fromtimestamp(entry.stat(follow_symlinks=False).st_mtime)
+            if record is not None:
+                new_path = build_file_path(
+                    record['chat_id'], record['channel'], record['message_id'], entry.name, mtime
+                )
+            else:
+                new_path = os.path.join(
+                    VIDEO_PATH, 'unsorted', f"{mtime.year:04d}", f"{mtime.month:02d}", entry.name
+                )
+            if os.path.exists(new_path):
+                logger.warning(f"迁移目标已存在，跳过: {new_path}")
+                continue
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.rename(entry.path, new_path)
+            moved.append((record['document_id'] if record is not None else None, new_path))
+    return moved
+
+def parse_message_link(args):
+    """从 t.me 消息链接或 “频道 消息id” 中解析出 (频道 id, 消息 id)，不是已监控的频道时返回 None"""
+    if len(args) == 1:
+        match = re.search(r't\.me/(?:c/(\d+)|(\w+))/(\d+)', args[0])
+        if not match:
+            return None
+        chat_id = int(f"-100{match.group(1)}") if match.group(1) else find_channel(match.group(2))
+        message_id = int(match.group(3))
+    elif len(args) == 2 and args[1].isdigit():
+        chat_id, message_id = find_channel(args[0]), int(args[1])
+    else:
+        return None
+    if chat_id not in monitored_channels:
+        return None
+    return chat_id, message_id
+
+def create_journal(job):
+    """入队时就写入续传记录，重启时排队中还没开始的任务也能恢复
+
+    频道检查点在入队时就已前进，补抓不会再找回这些消息。
+    同一个文档之前下载失败留下的续传记录和 .part 文件会沿用，已下载的部分不再重新下载。
+    """
+    job.file_path = job_file_path(job)
+    os.makedirs(os.path.dirname(job.file_path), exist_ok=True)
+    journal = DownloadJournal.create(job)
+    previous = None
+    if os.path.exists(journal.path):
+        try:
+            previous = DownloadJournal.load(journal.path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"无法读取续传记录 {journal.path}，重新下载: {str(e)}")
+    if previous is not None and previous.size == journal.size and previous.part_size == journal.part_size:
+        if 's3' in previous.data:
+            journal.data['s3'] = previous.data['s3']
+        if os.path.exists(previous.part_path):
+            if previous.part_path != journal.part_path:
+                # 再次出现在其它消息或相册中时把已下载的部分移到新位置
+                os.replace(previous.part_path, journal.part_path)
+            journal.completed_parts = previous.completed_parts
+            logger.info(f"沿用续传记录: {job.file_name} (已下载 {format_size(journal.completed_bytes())})")
+    job.journal = journal
+    job.journal.save()
+
+def is_document_active(document_id):
+    """文档是否已有任务在队列中或正在下载"""
+    return download_queue.has_document(document_id) or any(
+        job.document.id == document_id for job in active_downloads.values()
+    )
+
+async def enqueue_job(job):
+    """查询下载记录后把任务放入队列，已下载或正在下载的文档不会重复获取"""
+    record = ledger.get(job.document.id)
+    if (record is not None and record['status'] in ('queued', 'downloading')) or is_document_active(job.document.id):
+        logger.info(f"文档 {job.document.id} 已在下载队列中，跳过: {job.file_name}")
+        return False
+    if record is not None:
+        if record['status'] == 'completed' and record['path'] and download_exists(record['path']):
+            link_path = job_file_path(job)
+            if DUPLICATE_ACTION == 'link' and not is_object_url(record['path']) and not os.path.exists(link_path):
+                os.makedirs(os.path.dirname(link_path), exist_ok=True)
+                os.link(record['path'], link_path)
+                storage_stats.record_download(job.chat_id, record['size'] or 0, 0, 0)
+                logger.info(f"文档 {job.document.id} 已下载，创建硬链接: {link_path}")
+            else:
+                logger.info(f"文档 {job.document.id} 已下载，跳过: {record['path']}")
+            return False
+
+    create_journal(job)
+    ledger.record_queued(job)
+    # 只负责入队，下载由 worker 完成
+    await download_queue.put(job)
+    logger.info(f"任务已入队: {job.file_name} (队列长度: {len(download_queue)})")
+    return True
+
+async def enqueue_album(chat_id, channel_username, grouped_id, jobs, date=None):
+    """把一个相册中的视频作为一批任务入队
+
+    已下载过的视频链接到相册目录中，正在其它任务中下载的视频不计入相册。
+    """
+    queued = []
+    for job in list(jobs):
+        record = ledger.get(job.document.id)
+        if (record is not None and record['status'] in ('queued', 'downloading')) or is_document_active(job.document.id):
+            logger.info(f"文档 {job.document.id} 已在下载队列中，不计入相册: {job.file_name}")
+            jobs.remove(job)
+    if not jobs:
+        return
+    album = AlbumBatch.create(chat_id, channel_username, grouped_id, jobs, date)
+    os.makedirs(album.staging, exist_ok=True)
+    for job in jobs:
+        record = ledger.get(job.document.id)
+        if record is not None and record['status'] == 'completed' and record['path'] and download_exists(record['path']):
+            link_path = album.file_path(job)
+            if not is_object_url(record['path']) and not os.path.exists(link_path):
+                os.link(record['path'], link_path)
+            storage_stats.record_download(job.chat_id, record['size'] or 0, 0, 0)
+            album.part_done(job, record['size'] or 0, downloaded=False)
+            logger.info(f"文档 {job.document.id} 已下载，链接到相册: {link_path}")
+        else:
+            queued.append(job)
+    album.start()
+    for job in queued:
+        create_journal(job)
+        ledger.record_queued(job)
+        await download_queue.put(job)
+    logger.info(f"相册已入队: {len(queued)}/{len(jobs)} 个视频 (队列长度: {len(download_queue)})")
+
+async def get_top_message_id(client, entity, chat_id):
+    """获取频道最新的消息 id
+
+    机器人账号无法读取历史消息列表，此时退回到检查点记录的 id。
+    """
+    try:
+        messages = await client.get_messages(entity, limit=1)
+        if messages:
+            return messages[0].id
+    except errors.BotMethodInvalidError:
+        pass
+    return ledger.get_checkpoint(chat_id)
+
+async def backfill_channel(client, chat_id, first_id, last_id=None):
+    """并发分批获取 [first_id, last_id] 范围内的消息，交给正常的下载流程
+
+    last_id 为 None 时一直向后获取，直到一整轮批次都没有消息为止。
+    按 id 批量获取消息对机器人账号同样可用。返回找到的视频数。
+    """
+    entity = await client.get_input_entity(chat_id)
+    username = monitored_channels.get(chat_id, {}).get('username')
+    window = BACKFILL_BATCH_SIZE * BACKFILL_CONCURRENCY
+    queued = 0
+    next_id = max(1, first_id)
+
+    while last_id is None or next_id <= last_id:
+        window_end = next_id + window - 1 if last_id is None else min(next_id + window - 1, last_id)
+        batches = [
+            list(range(start, min(start + BACKFILL_BATCH_SIZE, window_end + 1)))
+            for start in range(next_id, window_end + 1, BACKFILL_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(*(client.get_messages(entity, ids=ids) for ids in batches))
+
+        # 按 id 顺序处理，检查点只前进到实际存在的最后一条消息
+        found = False
+        for messages in results:
+            for message in messages:
+                if message is None:
+                    continue
+                found = True
+                job = build_download_job(chat_id, username, message)
+                if job is not None:
+                    job.backfill = True
+                    if await enqueue_job(job):
+                        queued += 1
+                ledger.set_checkpoint(chat_id, message.id)
+
+        if last_id is None and not found:
+            break
+        next_id = window_end + 1
+
+    return queued
+
+async def catch_up_channels(client):
+    """启动时补抓停机期间各频道发布的消息"""
+    for chat_id in list(monitored_channels):
+        label = channel_label(chat_id)
+        try:
+            checkpoint = ledger.get_checkpoint(chat_id)
+            if checkpoint is None:
+                logger.info(f"频道 {label} 没有检查点，跳过补抓")
+                continue
+            queued = await backfill_channel(client, chat_id, checkpoint + 1)
+            logger.info(f"频道 {label} 补抓完成，新增 {queued} 个下载任务")
+        except Exception as e:
+            logger.error(f"补抓频道 {label} 时出错: {str(e)}")
+
+async def process_download(job):
+    """下载单个任务并向管理员报告结果"""
+    file_name = job.file_name
+    job.trace = DownloadTrace(TRACE_DOWNLOADS, origin=job.enqueued_at)
+    job.trace.event('queue', job.enqueued_at, time.time() - job.enqueued_at, size=job.file_size)
+
+    if job.journal is None:
+        create_journal(job)
+    if S3_KEEP_LOCAL:
+        with job.trace.span('reserve'):
+            await disk_guard.reserve(job)
+    ledger.mark_started(job)
+
+    journal = job.journal
+    file_path = job.file_path
+    resumed_bytes = journal.completed_bytes()
+
+    # 进度只记录在面板中，不再逐个编辑消息
+    progress_board.start(job.document.id, file_name, job.file_size, resumed_bytes)
+
+    try:
+        # 记录开始时间
+        start_time = time.time()
+
+        def progress(current, total):
+            progress_board.update(job.document.id, current, total)
+
+        # 下载视频到 .part 文件，大文件分段并行下载
+        digest = await download_with_pool(job, progress)
+
+        if S3_KEEP_LOCAL:
+            # 下载完成，放入内容寻址存储，重复内容只保留一份
+            with job.trace.span('finalize'):
+                duplicate = await asyncio.get_running_loop().run_in_executor(
+                    None, store_object, journal.part_path, digest, file_path
+                )
+                journal.remove()
+            stored_path = file_path
+            actual_size = os.path.getsize(file_path)
+        else:
+            # 只保存在对象存储中，下载记录中的路径为 s3:// 地址；续传的下载没有完整的 SHA-256
+            journal.remove()
+            duplicate = False
+            stored_path = object_store.url(object_key(journal))
+            actual_size = job.file_size
+
+        # 下载完成后的处理
+        ledger.mark_completed(job, actual_size, digest, stored_path)
+        storage_stats.record_download(
+            job.chat_id, actual_size, actual_size - resumed_bytes,
+            0 if duplicate or not S3_KEEP_LOCAL else actual_size
+        )
+        duration = time.time() - start_time
+        average_speed = (actual_size - resumed_bytes) / duration if duration > 0 else 0
+        metrics.inc('downloaded_bytes_total', actual_size - resumed_bytes, channel=channel_label(job.chat_id))
+        metrics.inc('downloads_total', result='completed')
+        metrics.observe('download_duration_seconds', duration)
+        metrics.observe('download_speed_bytes_per_second', average_speed)
+        job.trace.event('done', size=actual_size, resumed=resumed_bytes, duplicate=duplicate)
+
+        # 相册中的视频只更新相册的状态消息
+        if job.album is not None:
+            job.album.part_done(job, actual_size)
+            logger.info(f"视频下载完成: {stored_path} (sha256: {digest}{', 重复内容' if duplicate else ''})")
+            return
+
+        # 发送完成消息，只排队不等待发送
+        outbox.send(
+            ADMIN_USER_ID,
+            f"✅ 视频下载完成\n"
+            f"频道: {channel_label(job.chat_id)}\n"
+            f"文件: {file_name}\n"
+            f"大小: {format_size(actual_size)}\n"
+            f"用时: {int(duration)}秒\n"
+            f"平均速度: {format_size(average_speed)}/s"
+            + ("\n内容与已有文件相同，未占用额外空间" if duplicate else "")
+            + ("" if S3_KEEP_LOCAL else f"\n已保存到: {stored_path}")
+        )
+
+        logger.info(f"视频下载完成: {stored_path} (sha256: {digest}{', 重复内容' if duplicate else ''})")
+
+    except DocumentUnavailableError:
+        # 原视频已不存在，续传也无意义
+        if os.path.exists(journal.part_path):
+            os.remove(journal.part_path)
+        if object_store.enabled:
+            await object_store.discard(journal)
+        journal.remove()
+        job.trace.event('error', error="视频已不可用")
+        raise
+    except BaseException as e:
+        job.trace.event('error', error=str(e) or type(e).__name__)
+        raise
+    finally:
+        progress_board.finish(job.document.id)
+        disk_guard.release(job)
+        if job.trace.enabled:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, job.trace.save, trace_file(file_path))
+            except OSError as e:
+                logger.error(f"保存下载时间线失败: {str(e)}")
+
+async def resume_pending_downloads():
+    """启动时扫描续传记录，把未完成的下载重新放回队列"""
+    jobs = []
+    with os.scandir(JOURNAL_PATH) as entries:
+        paths = [entry.path for entry in entries if entry.name.endswith('.json')]
+    for path in paths:
+        try:
+            journal = DownloadJournal.load(path)
+            job = DownloadJob.from_journal(journal)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"无法读取续传记录 {os.path.basename(path)}: {str(e)}")
+            continue
+        # 启动后新消息中再次出现的文档可能已经沿用这份续传记录入队
+        if is_document_active(job.document.id):
+            logger.info(f"文档 {job.document.id} 已在下载队列中，不再恢复: {job.file_name}")
+            continue
+        jobs.append(job)
+
+    # 没有续传记录的排队任务无法恢复，标记为中断以便再次出现时重新下载
+    interrupted = ledger.reset_interrupted({job.document.id for job in jobs})
+    if interrupted:
+        logger.info(f"{interrupted} 个任务在上次退出时中断且无法续传")
+
+    # 属于同一相册的任务重新组成相册，全部完成后再发布相册目录
+    albums = {}
+    for job in jobs:
+        data = job.journal.data.get('album')
+        if data is not None:
+            albums.setdefault(data['directory'], (data, []))[1].append(job)
+    for data, album_jobs in albums.values():
+        AlbumBatch.from_journal(data, album_jobs).start("📦 继续下载相册")
+
+    for job in jobs:
+        journal = job.journal
+        ledger.record_queued(job)
+        await download_queue.put(job)
+        logger.info(
+            f"恢复未完成的下载: {job.file_name} "
+            f"({format_size(journal.completed_bytes())}/{format_size(job.file_size)})"
+        )
+
+async def download_worker(worker_id):
+    """从队列中不断取出任务并下载，前 SMALL_FILE_SLOTS 个 worker 只下载小文件"""
+    small_only = worker_id < SMALL_FILE_SLOTS < DOWNLOAD_WORKERS
+    while True:
+        job = await download_queue.get(small_only=small_only)
+        active_downloads[worker_id] = job
+        metrics.observe('queue_wait_seconds', time.time() - job.enqueued_at)
+        logger.info(f"Worker {worker_id} 开始处理: {job.file_name} (排队 {int(time.time() - job.enqueued_at)}秒)")
+        try:
+            await process_download(job)
+        except Exception as e:
+            error_msg = f"下载视频时出错: {str(e)}"
+            logger.error(error_msg)
+            metrics.inc('downloads_total', result='failed')
+            ledger.mark_failed(job, str(e))
+            if job.album is not None:
+                job.album.part_failed(job, str(e))
+                continue
+            outbox.send(
+                ADMIN_USER_ID,
+                f"❌ 下载失败\n"
+                f"频道: {channel_label(job.chat_id)}\n"
+                f"错误: {str(e)}"
+                + ("\n已保存下载进度，重启后将继续下载" if job.journal and os.path.exists(job.journal.path) else "")
+            )
+        finally:
+            active_downloads.pop(worker_id, None)
+
+def register_handlers(client):
+    """在客户端上注册命令和频道消息处理器"""
+    # 频道消息只在事件层按频道 id 过滤，增删频道时直接更新这个集合
+    channel_events = events.NewMessage(chats=list(monitored_channels))
+    album_events = events.Album(chats=list(monitored_channels))
+
+    def refresh_channel_filter():
+        for builder in (channel_events, album_events):
+            builder.chats = set(monitored_channels)
+            builder.resolved = True
+
+    refresh_channel_filter()
+
+    @client.on(events.NewMessage(pattern='/start'))
+    async def start_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        await outbox.respond(
+            event,
+            "欢迎使用频道视频下载机器人！\n"
+            "/add_channel <频道链接> - 添加要监控的频道\n"
+            "/remove_channel <频道链接> - 移除监控的频道\n"
+            "/list_channels - 列出所有监控的频道\n"
+            "/filter <频道链接> [规则=值 ...] - 查看或设置频道的下载过滤规则\n"
+            "/priority <消息链接> - 优先下载某个视频，或 /priority <频道> high|normal|low\n"
+            "/limit - 查看或设置下载限速\n"
+            "/backfill <频道链接> [数量] [最新消息id] - 下载频道最近的历史视频\n"
+            "/migrate - 把旧版本平铺存放的视频移动到分层目录\n"
+            "/perf <文件名> - 分析某个下载的耗时（需开启 TRACE_DOWNLOADS）\n"
+            "/status - 查看下载状态和统计信息"
+        )
+
+    @client.on(events.NewMessage(pattern='/add_channel'))
+    async def add_channel_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        try:
+            channel = event.text.split(maxsplit=1)[1].strip('@')
+            entity = await client.get_entity(channel)
+            if not getattr(entity, 'broadcast', False):
+                await outbox.respond(event, "这不是一个频道")
+                return
+
+            chat_id = utils.get_peer_id(entity)
+            # 重新添加已监控的频道时保留它的过滤规则
+            monitored_channels.setdefault(chat_id, {}).update(
+                username=entity.username,
+                title=entity.title
+            )
+            save_channels()
+            refresh_channel_filter()
+            await outbox.respond(event, f"已成功添加频道: {channel_label(chat_id)}")
+            logger.info(f"Added channel: {channel_label(chat_id)} ({chat_id})")
+        except Exception as e:
+            await outbox.respond(event, f"添加频道失败: {str(e)}")
+            logger.error(f"Failed to add channel: {str(e)}")
+
+    @client.on(events.NewMessage(pattern='/remove_channel'))
+    async def remove_channel_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        try:
+            chat_id = find_channel(event.text.split(maxsplit=1)[1])
+            if chat_id is not None:
+                label = channel_label(chat_id)
+                del monitored_channels[chat_id]
+                save_channels()
+                refresh_channel_filter()
+                await outbox.respond(event, f"已移除频道: {label}")
+            else:
+                await outbox.respond(event, "未找到该频道")
+        except Exception as e:
+            await outbox.respond(event, f"移除频道失败: {str(e)}")
+
+    @client.on(events.NewMessage(pattern='/list_channels'))
+    async def list_channels_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        if not monitored_channels:
+            await outbox.respond(event, "当前没有监控任何频道")
+            return
+
+        channels_list = "\n".join(
+            f"- {channel_label(chat_id)} ({chat_id})" for chat_id in monitored_channels
+        )
+        await outbox.respond(event, f"当前监控的频道：\n{channels_list}")
+
+    @client.on(events.NewMessage(pattern='/filter'))
+    async def filter_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        args = event.text.split()[1:]
+        if not args:
+            await outbox.respond(event, FILTER_HELP)
+            return
+        chat_id = find_channel(args[0])
+        if chat_id is None:
+            await outbox.respond(event, "未找到该频道，请先使用 /add_channel 添加")
+            return
+        try:
+            if len(args) > 1:
+                update_rules(chat_id, args[1:])
+                logger.info(f"更新频道 {channel_label(chat_id)} 的过滤规则: {args[1:]}")
+            await outbox.respond(event, describe_rules(chat_id))
+        except ValueError as e:
+            await outbox.respond(event, f"设置过滤规则失败: {str(e)}\n\n{FILTER_HELP}")
+
+    @client.on(events.NewMessage(pattern='/priority'))
+    async def priority_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        args = event.text.split()[1:]
+        try:
+            # 设置频道优先级
+            if len(args) == 2 and args[1].lower() in PRIORITY_LEVELS:
+                chat_id = find_channel(args[0])
+                if chat_id is None:
+                    await outbox.respond(event, "未找到该频道，请先使用 /add_channel 添加")
+                    return
+                level = args[1].lower()
+                if PRIORITY_LEVELS[level]:
+                    monitored_channels[chat_id]['priority'] = PRIORITY_LEVELS[level]
+                else:
+                    monitored_channels[chat_id].pop('priority', None)
+                save_channels()
+                await outbox.respond(event, f"频道 {channel_label(chat_id)} 的下载优先级已设为 {level}")
+                return
+
+            # 提升单个消息中视频的下载顺序
+            target = parse_message_link(args)
+            if target is None:
+                await outbox.respond(
+                    event,
+                    "用法:\n"
+                    "/priority <消息链接> - 优先下载该消息中的视频\n"
+                    "/priority <频道> <消息id> - 同上\n"
+                    "/priority <频道> high|normal|low - 设置频道的下载优先级"
+                )
+                return
+            chat_id, message_id = target
+            job = download_queue.find(chat_id, message_id)
+            if job is not None:
+                job.bumped = True
+                download_queue.reschedule()
+                await outbox.respond(event, f"已提升下载顺序: {job.file_name}")
+                return
+
+            message = await client.get_messages(chat_id, ids=message_id)
+            job = build_download_job(chat_id, monitored_channels[chat_id].get('username'), message) if message else None
+            if job is None:
+                await outbox.respond(event, "该消息中没有需要下载的视频")
+                return
+            job.bumped = True
+            if await enqueue_job(job):
+                await outbox.respond(event, f"已加入下载队列并优先下载: {job.file_name}")
+            else:
+                await outbox.respond(event, "该视频正在下载或已经下载过")
+        except Exception as e:
+            await outbox.respond(event, f"设置优先级失败: {str(e)}")
+            logger.error(f"Failed to set priority: {str(e)}")
+
+    @client.on(events.NewMessage(pattern='/limit'))
+    async def limit_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        args = event.text.split()[1:]
+        try:
+            if len(args) == 2:
+                target, value = args[0].lower(), args[1]
+                if target == 'global':
+                    bandwidth_shaper.global_rate = parse_rate(value)
+                elif target == 'backfill':
+                    bandwidth_shaper.backfill_rate = parse_rate(value)
+                elif target == 'schedule':
+                    bandwidth_shaper.schedule = [] if value.lower() == 'off' else parse_schedule(value)
+                else:
+                    chat_id = find_channel(args[0])
+                    if chat_id is None:
+                        await outbox.respond(event, "未找到该频道，请先使用 /add_channel 添加")
+                        return
+                    rate = parse_rate(value)
+                    if rate:
+                        monitored_channels[chat_id]['bandwidth'] = rate
+                    else:
+                        monitored_channels[chat_id].pop('bandwidth', None)
+                    save_channels()
+                logger.info(f"修改下载限速: {args}")
+            elif args:
+                await outbox.respond(
+                    event,
+                    "用法:\n"
+                    "/limit - 查看当前限速\n"
+                    "/limit global 20MB|off - 全局限速\n"
+                    "/limit backfill 5MB|off - 补抓任务限速\n"
+                    "/limit schedule 09:00-18:00=20MB,18:00-23:00=50MB|off - 按时间段设置全局限速\n"
+                    "/limit <频道> 10MB|off - 频道限速"
+                )
+                return
+            await outbox.respond(event, "下载限速:\n" + bandwidth_shaper.describe())
+        except ValueError as e:
+            await outbox.respond(event, f"设置限速失败: {str(e)}")
+
+    @client.on(events.NewMessage(pattern='/backfill'))
+    async def backfill_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        try:
+            args = event.text.split()
+            chat_id = find_channel(args[1])
+            if chat_id is None:
+                await outbox.respond(event, "未找到该频道，请先使用 /add_channel 添加")
+                return
+            limit = int(args[2]) if len(args) > 2 else BACKFILL_DEFAULT_LIMIT
+            entity = await client.get_input_entity(chat_id)
+            if len(args) > 3:
+                # 手动指定补抓的终点：消息 id 或消息链接
+                top_id = int(args[3]) if args[3].isdigit() else (parse_message_link(args[3:4]) or (None, None))[1]
+            else:
+                top_id = await get_top_message_id(client, entity, chat_id)
+            if top_id is None:
+                await outbox.respond(
+                    event,
+                    "无法确定该频道最新的消息 id：机器人账号不能读取频道历史，"
+                    "频道添加后还没有收到过新消息。\n"
+                    "请等频道发布新消息后再补抓，或者手动指定终点:\n"
+                    "/backfill <频道链接> <数量> <消息id或消息链接>"
+                )
+                return
+
+            label = channel_label(chat_id)
+            await outbox.respond(event, f"开始补抓 {label} 最近 {limit} 条消息")
+            queued = await backfill_channel(client, chat_id, top_id - limit + 1, top_id)
+            await outbox.respond(event, f"补抓完成: {label}\n新增下载任务: {queued}")
+        except Exception as e:
+            await outbox.respond(event, f"补抓失败: {str(e)}")
+            logger.error(f"Failed to backfill: {str(e)}")
+
+    @client.on(events.NewMessage(pattern='/migrate'))
+    async def migrate_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        try:
+            await outbox.respond(event, "开始迁移平铺存放的视频...")
+            moved = await asyncio.get_running_loop().run_in_executor(
+                None, migrate_flat_files, ledger.completed_paths()
+            )
+            for document_id, new_path in moved:
+                if document_id is not None:
+                    ledger.update_path(document_id, new_path)
+            await outbox.respond(event, f"迁移完成，共移动 {len(moved)} 个文件到 {VIDEO_PATH}")
+            logger.info(f"迁移了 {len(moved)} 个文件")
+        except Exception as e:
+            await outbox.respond(event, f"迁移失败: {str(e)}")
+            logger.error(f"Failed to migrate files: {str(e)}")
+
+    @client.on(events.NewMessage(pattern='/perf'))
+    async def perf_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        query = event.text.partition(' ')[2].strip()
+        if not query:
+            await outbox.respond(event, "用法: /perf <文件名或其中一部分>")
+            return
+        try:
+            loop = asyncio.get_running_loop()
+            path = await loop.run_in_executor(None, find_trace, os.path.basename(query))
+            if path is None:
+                hint = "" if TRACE_DOWNLOADS else "\n当前未开启 TRACE_DOWNLOADS，不会记录下载时间线"
+                await outbox.respond(event, f"没有找到 {query} 的下载时间线{hint}")
+                return
+            records = await loop.run_in_executor(None, load_trace, path)
+            if not records:
+                await outbox.respond(event, f"{os.path.basename(path)} 中没有记录")
+                return
+            name = os.path.basename(path)[:-len('.trace.jsonl')]
+            await outbox.respond(event, summarize_trace(records, name))
+        except Exception as e:
+            await outbox.respond(event, f"分析下载时间线失败: {str(e)}")
+            logger.error(f"Failed to summarize trace: {str(e)}")
+
+    @client.on(events.NewMessage(pattern='/status'))
+    async def status_handler(event):
+        if event.sender_id != ADMIN_USER_ID:
+            return
+
+        try:
+            if storage_stats.reconciled:
+                storage_lines = (
+                    f"已下载文件数: {storage_stats.total_files}\n"
+                    f"总存储大小: {format_size(storage_stats.total_bytes)}"
+                    + (f" / {format_size(DISK_QUOTA)}" if DISK_QUOTA else "") + "\n"
+                )
+            else:
+                storage_lines = "存储统计: 正在扫描下载目录...\n"
+            storage_lines += f"磁盘剩余空间: {format_size(shutil.disk_usage(DOWNLOAD_PATH).free)}\n"
+
+            speed, channel_speeds = storage_stats.throughput()
+            channel_lines = "".join(
+                f"\n- {channel_label(chat_id)}: "
+                f"{storage_stats.channels.get(chat_id, {}).get('files', 0)} 个文件, "
+                f"{format_size(storage_stats.channels.get(chat_id, {}).get('bytes', 0))}, "
+                f"{format_size(channel_speeds.get(chat_id, 0))}/s"
+                + (f" (限速 {format_rate(info['bandwidth'])})" if info.get('bandwidth') else "")
+                for chat_id, info in monitored_channels.items()
+            )
+
+            now = time.monotonic()
+            session_lines = "".join(
+                f"\n- {session.name}: {session.active} 个下载"
+                + ("" if session.client.is_connected() else ", 已断开")
+                + (f", 暂停 {int(session.available_at - now)}秒" if session.available_at > now else "")
+                for session in client_pool.sessions
+            )
+
+            await outbox.respond(
+                event,
+                "📊 下载统计信息\n"
+                f"监控的频道数: {len(monitored_channels)}\n"
+                + storage_lines +
+                f"存储路径: {VIDEO_PATH}\n"
+                + (
+                    f"对象存储: {object_store.url(S3_PREFIX)}{'' if S3_KEEP_LOCAL else '，不保留本地副本'}\n"
+                    if object_store.enabled else ""
+                ) +
+                f"最近 {THROUGHPUT_WINDOW // 60} 分钟下载速度: {format_size(speed)}/s\n"
+                f"排队任务数: {len(download_queue)} (小文件 {download_queue.small_count()})\n"
+                f"下载限速: {format_rate(bandwidth_shaper.current_rate())}"
+                + (f", 补抓 {format_rate(bandwidth_shaper.backfill_rate)}" if bandwidth_shaper.backfill_rate else "")
+                + "\n"
+                f"空闲下载连接: {media_pool.describe()}\n"
+                f"活动下载: {len(active_downloads)}/{DOWNLOAD_WORKERS}"
+                + "".join(f"\n- {job.file_name}" for job in active_downloads.values())
+                + (f"\n\n各频道统计:{channel_lines}" if channel_lines else "")
+                + (f"\n\n下载会话:{session_lines}" if len(client_pool) > 1 else "")
+            )
+        except Exception as e:
+            await outbox.respond(event, f"获取状态信息时出错: {str(e)}")
+
+    async def download_handler(event):
+        try:
+            info = monitored_channels.get(event.chat_id)
+            if info is None:
+                return
+
+            # 频道改名后同步更新用户名，event.chat 来自更新本身，不需要额外请求
+            chat = event.chat
+            if chat is not None and chat.username != info.get('username'):
+                logger.info(f"频道 {event.chat_id} 用户名变更: {info.get('username')} -> {chat.username}")
+                info['username'] = chat.username
+                info['title'] = chat.title
+                save_channels()
+
+            # 相册中的消息由 album_handler 一起处理
+            if event.message.grouped_id:
+                return
+
+            job = build_download_job(event.chat_id, info.get('username'), event.message)
+            if job is not None:
+                await enqueue_job(job)
+            ledger.set_checkpoint(event.chat_id, event.message.id)
+
+        except Exception as e:
+            logger.error(f"处理消息时出错: {str(e)}")
+
+    async def album_handler(event):
+        try:
+            info = monitored_channels.get(event.chat_id)
+            if info is None:
+                return
+
+            jobs = [
+                job for job in (
+                    build_download_job(event.chat_id, info.get('username'), message)
+                    for message in event.messages
+                )
+                if job is not None
+            ]
+            if jobs:
+                await enqueue_album(event.chat_id, info.get('username'), event.grouped_id, jobs, event.messages[0].date)
+            ledger.set_checkpoint(event.chat_id, max(message.id for message in event.messages))
+
+        except Exception as e:
+            logger.error(f"处理相册时出错: {str(e)}")
+
+    client.add_event_handler(download_handler, channel_events)
+    client.add_event_handler(album_handler, album_events)
+
+# 后台任务，事件循环只保留任务的弱引用，这里保留引用避免运行中被回收
+background_tasks = set()
+
+def keep_task(task):
+    background_tasks.add(task)
+    task.add_done_callback(background_task_done)
+    return task
+
+def background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"后台任务 {task.get_coro().__name__} 出错: {str(task.exception())}")
+
+def start_services(client):
+    """启动下载 worker 和各个后台任务"""
+    # 对象存储要在恢复未完成的下载之前准备好
+    if object_store.enabled:
+        object_store.start()
+
+    # 启动下载 worker
+    workers = [
+        keep_task(asyncio.create_task(download_worker(worker_id)))
+        for worker_id in range(DOWNLOAD_WORKERS)
+    ]
+    logger.info(f"Started {len(workers)} download workers")
+
+    # 启动消息发送调度
+    keep_task(outbox.start(client))
+
+    # 启动进度面板
+    keep_task(asyncio.create_task(progress_board.run()))
+
+    # 统计现有文件
+    keep_task(asyncio.create_task(reconcile_storage()))
+
+    # 恢复上次未完成的下载，并补抓停机期间的消息
+    keep_task(asyncio.create_task(resume_pending_downloads()))
+    keep_task(asyncio.create_task(catch_up_channels(client)))
+
+    # 按保留策略定期清理旧视频
+    keep_task(asyncio.create_task(retention_loop()))
+
+    # 预热并维护下载连接池
+    keep_task(asyncio.create_task(warm_media_pool()))
+    keep_task(asyncio.create_task(media_pool.run()))
+
+    # 运行指标
+    keep_task(asyncio.create_task(metrics.watch_loop_lag()))
+    if METRICS_PORT:
+        keep_task(asyncio.create_task(metrics.serve(METRICS_HOST, METRICS_PORT)))
+
+async def main():
+    try:
+        # 创建客户端
+        logger.info("Creating client...")
+        client = TelegramClient(SESSION_PATH, API_ID, API_HASH)
+        
+        logger.info("Starting client with bot token...")
+        await client.start(bot_token=BOT_TOKEN)
+        
+        logger.info("Bot started successfully")
+        logger.info(f"Bot username: {(await client.get_me()).username}")
+
+        # 下载会话池：配置了工作会话时主会话只作为后备
+        client_pool.add('main', client, listener=True)
+        for index, token in enumerate(WORKER_BOT_TOKENS, 1):
+            worker = TelegramClient(f"{SESSION_PATH}_worker{index}", API_ID, API_HASH, receive_updates=False)
+            await worker.start(bot_token=token)
+            client_pool.add(f"worker{index}", worker)
+            logger.info(f"下载会话 worker{index} 已启动: {(await worker.get_me()).username}")
+        
+        # 加载保存的频道配置，旧版本配置需要先解析频道 id
+        legacy_channels = load_channels()
+        if legacy_channels:
+            await migrate_channels(client, legacy_channels)
+
+        # 注册处理器并启动下载 worker 和后台任务
+        register_handlers(client)
+        start_services(client)
 
         try:
             logger.info("Starting bot...")
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# 脚本导入时会在 DOWNLOAD_PATH 下创建目录和数据库，测试时放到临时目录
+os.environ.setdefault('DOWNLOAD_PATH', tempfile.mkdtemp(prefix='tg-downloader-test-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import telegram_video_downloader as tvd
+
+
+def write_file(path, size):
+    path.write_bytes(b'\0' * size)
+    return str(path)
+
+
+def record(path, sha256=None):
+    return {'path': path, 'sha256': sha256, 'document_id': 1, 'chat_id': 1, 'size': None}
+
+
+def test_evictable_bytes_skips_files_linked_elsewhere(tmp_path):
+    alone = write_file(tmp_path / 'a.mp4', 100)
+    linked = write_file(tmp_path / 'b.mp4', 200)
+    os.link(linked, tmp_path / 'album.mp4')
+    records = [record(alone), record(linked), record(str(tmp_path / 'missing.mp4'))]
+    assert tvd.evictable_bytes(records) == 100
+    # 所有链接都在候选中时可以释放
+    records.append(record(str(tmp_path / 'album.mp4')))
+    assert tvd.evictable_bytes(records) == 300
+
+
+def test_reserve_does_not_evict_when_candidates_cannot_cover(tmp_path, monkeypatch):
+    candidates = [record(write_file(tmp_path / 'a.mp4', 100))]
+    evicted = []
+
+    async def fake_evict(records, needed=None, reason="", by_size=False):
+        evicted.extend(records)
+        return 0
+
+    monkeypatch.setattr(tvd, 'DISK_QUOTA', 1000)
+    monkeypatch.setattr(tvd, 'MIN_FREE_SPACE', 0)
+    monkeypatch.setattr(tvd, 'EVICTION_POLICY', 'oldest')
+    monkeypatch.setattr(tvd, 'ledger', SimpleNamespace(eviction_candidates=lambda: candidates))
+    monkeypatch.setattr(tvd, 'storage_stats', SimpleNamespace(total_bytes=1000))
+    monkeypatch.setattr(tvd, 'evict_downloads', fake_evict)
+    job = SimpleNamespace(
+        file_size=500, document=SimpleNamespace(id=1),
+        journal=SimpleNamespace(part_path=str(tmp_path / 'new.part')),
+    )
+
+    async def reserve():
+        await tvd.DiskGuard().reserve(job)
+
+    with pytest.raises(tvd.DiskSpaceError):
+        asyncio.run(reserve())
+    assert evicted == []
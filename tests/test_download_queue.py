@@ -0,0 +1,76 @@
+import asyncio
+import types
+
+import pytest
+
+import telegram_video_downloader as tvd
+
+MB = 1024 * 1024
+
+
+def make_job(chat_id, message_id, size, enqueued_at=1000.0):
+    document = types.SimpleNamespace(id=chat_id * 1000 + message_id, size=size)
+    job = tvd.DownloadJob(chat_id, None, message_id, document, f"{message_id}.mp4")
+    job.enqueued_at = enqueued_at
+    return job
+
+
+def drain(jobs, small_only=False, count=None):
+    async def run():
+        queue = tvd.DownloadQueue(1000)
+        for job in jobs:
+            await queue.put(job)
+        taken = []
+        for _ in range(count or len(jobs)):
+            job = await queue.get(small_only=small_only)
+            taken.append((job.chat_id, job.message_id))
+        return taken
+    return asyncio.run(asyncio.wait_for(run(), 5))
+
+
+@pytest.fixture(autouse=True)
+def channels(monkeypatch):
+    monkeypatch.setattr(tvd, 'monitored_channels', {1: {}, 2: {}, 3: {}})
+    return tvd.monitored_channels
+
+
+def test_busy_channel_does_not_starve_others():
+    jobs = [make_job(1, index, 10 * MB) for index in range(10)] + [make_job(2, 1, 500 * MB), make_job(3, 1, 500 * MB)]
+    taken = drain(jobs, count=4)
+    assert {chat_id for chat_id, _ in taken[:3]} == {1, 2, 3}
+
+
+def test_smaller_and_older_jobs_first_within_channel():
+    jobs = [
+        make_job(1, 1, 900 * MB),
+        make_job(1, 2, 100 * MB),
+        make_job(1, 3, 50 * MB),
+        # 排队足够久的大文件排在新来的小文件前面
+        make_job(1, 4, 900 * MB, enqueued_at=1000.0 - 2000),
+    ]
+    assert [message_id for _, message_id in drain(jobs)] == [4, 3, 2, 1]
+
+
+def test_bumped_job_goes_first():
+    jobs = [make_job(1, index, 10 * MB) for index in range(3)] + [make_job(2, 1, 900 * MB)]
+    jobs[-1].bumped = True
+    assert drain(jobs, count=1) == [(2, 1)]
+
+
+def test_small_only_skips_large_files():
+    jobs = [make_job(1, 1, 900 * MB), make_job(2, 1, 10 * MB)]
+    assert drain(jobs, small_only=True, count=1) == [(2, 1)]
+
+
+def test_high_priority_channel_gets_twice_the_turns(channels):
+    channels[1]['priority'] = 1
+    jobs = [make_job(chat_id, index, 100 * MB) for chat_id in (1, 2) for index in range(6)]
+    taken = drain(jobs, count=6)
+    assert sum(1 for chat_id, _ in taken if chat_id == 1) == 4
+
+
+def test_schedule_key_counts_resumed_bytes():
+    job = make_job(1, 1, 100 * MB)
+    job.journal = types.SimpleNamespace(completed_bytes=lambda: 60 * MB)
+    fresh = make_job(1, 2, 50 * MB)
+    assert tvd.schedule_key(job) < tvd.schedule_key(fresh)
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import os
+import random
+
+import pytest
+
+import telegram_video_downloader as tvd
+
+CHUNK = tvd.PART_SIZE
+
+
+class FakeObjectStore:
+    """内存中的对象存储，上传分片时让出事件循环"""
+
+    enabled = True
+
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+        self.max_active = 0
+        self._active = 0
+
+    async def create_upload(self, key):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {}
+        return upload_id
+
+    async def uploaded_parts(self, key, upload_id):
+        parts = self.uploads.get(upload_id)
+        return None if parts is None else {number: str(number) for number in parts}
+
+    async def upload_part(self, key, upload_id, number, data):
+        self._active += 1
+        self.max_active = max(self.max_active, self._active)
+        await asyncio.sleep(0.001)
+        self.uploads[upload_id][number] = bytes(data)
+        self._active -= 1
+        return str(number)
+
+    async def complete_upload(self, key, upload_id, etags):
+        parts = self.uploads.pop(upload_id)
+        self.objects[key] = b''.join(parts[number] for number in sorted(etags))
+
+    async def abort_upload(self, key, upload_id):
+        self.uploads.pop(upload_id, None)
+
+
+def make_journal(tmp_path, size):
+    data = {
+        'size': size, 'part_size': CHUNK, 'completed': [],
+        'file_path': os.path.join(tvd.VIDEO_PATH, 'channel', '1_video.mp4'),
+    }
+    return tvd.DownloadJournal(str(tmp_path / 'journal.json'), data)
+
+
+async def write_all(sink, data, indexes):
+    await sink.open()
+    for index in indexes:
+        await sink.write(index, index * CHUNK, data[index * CHUNK:(index + 1) * CHUNK])
+    return await sink.close()
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = FakeObjectStore()
+    monkeypatch.setattr(tvd, 'object_store', store)
+    monkeypatch.setattr(tvd, 'S3_PART_SIZE', 2 * CHUNK)
+    return store
+
+
+@pytest.mark.parametrize('max_buffers', [1, 2, 8])
+def test_sequential_write_with_small_buffer_limit(tmp_path, store, monkeypatch, max_buffers):
+    monkeypatch.setattr(tvd, 'S3_MAX_BUFFERS', max_buffers)
+    size = 40 * CHUNK + 123
+    data = random.randbytes(size)
+    journal = make_journal(tmp_path, size)
+    sink = tvd.S3Sink(journal, size)
+
+    digest = asyncio.run(asyncio.wait_for(write_all(sink, data, range(41)), 10))
+
+    assert store.objects[tvd.object_key(journal)] == data
+    assert digest == hashlib.sha256(data).hexdigest()
+    assert store.max_active <= max_buffers
+
+
+def test_out_of_order_writes_and_journal(tmp_path, store, monkeypatch):
+    monkeypatch.setattr(tvd, 'S3_MAX_BUFFERS', 2)
+    size = 9 * CHUNK
+    data = random.randbytes(size)
+    journal = make_journal(tmp_path, size)
+    sink = tvd.S3Sink(journal, size)
+    order = [1, 0, 3, 2, 5, 4, 7, 6, 8]
+
+    digest = asyncio.run(asyncio.wait_for(write_all(sink, data, order), 10))
+
+    assert store.objects[tvd.object_key(journal)] == data
+    assert digest == hashlib.sha256(data).hexdigest()
+    # 不保留本地副本时，分片上传完成后分段才记入续传记录
+    assert journal.completed_parts == set(range(9))
+
+
+def test_resume_skips_uploaded_parts(tmp_path, store, monkeypatch):
+    monkeypatch.setattr(tvd, 'S3_MAX_BUFFERS', 2)
+    size = 8 * CHUNK
+    data = random.randbytes(size)
+    journal = make_journal(tmp_path, size)
+
+    async def interrupted():
+        sink = tvd.S3Sink(journal, size)
+        await sink.open()
+        # 第一个分片完整，第二个分片只写了一半
+        for index in (0, 1, 2):
+            await sink.write(index, index * CHUNK, data[index * CHUNK:(index + 1) * CHUNK])
+        await sink.abort()
+
+    asyncio.run(interrupted())
+    assert journal.completed_parts == {0, 1}
+
+    resumed = tvd.DownloadJournal.load(journal.path)
+    sink = tvd.S3Sink(resumed, size)
+    missing = list(range(2, 8))
+    digest = asyncio.run(asyncio.wait_for(write_all(sink, data, missing), 10))
+
+    assert store.objects[tvd.object_key(resumed)] == data
+    # 续传的下载没有完整的 SHA-256
+    assert digest is None
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import random
+
+import pytest
+
+import telegram_video_downloader as tvd
+
+PART = 1024
+
+
+def chunks(data):
+    return [(offset, data[offset:offset + PART]) for offset in range(0, len(data), PART)]
+
+
+def test_in_order_without_file():
+    data = random.randbytes(10 * PART + 17)
+    hasher = tvd.StreamHasher(len(data), PART)
+    for offset, chunk in chunks(data):
+        hasher.update(offset, chunk)
+    assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+
+
+def test_out_of_order_is_reread_from_file(tmp_path):
+    data = random.randbytes(10 * PART + 17)
+    path = tmp_path / 'video.part'
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        hasher = tvd.StreamHasher(len(data), PART)
+        hasher.attach(fd)
+        pieces = chunks(data)
+        # 第一个分段最后才到，其余分段写入文件后不应留在内存中
+        for offset, chunk in pieces[1:] + pieces[:1]:
+            os.pwrite(fd, chunk, offset)
+            hasher.update(offset, chunk)
+            if offset:
+                assert not hasher._pending
+        assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+    finally:
+        os.close(fd)
+
+
+def test_resume_reads_parts_already_on_disk(tmp_path):
+    data = random.randbytes(6 * PART)
+    path = tmp_path / 'video.part'
+    path.write_bytes(data[:3 * PART] + bytes(3 * PART))
+    fd = os.open(path, os.O_RDWR)
+    try:
+        hasher = tvd.StreamHasher(len(data), PART, on_disk_parts={0, 1, 2})
+        hasher.attach(fd)
+        assert hasher.offset == 3 * PART
+        for offset, chunk in chunks(data)[3:]:
+            hasher.update(offset, chunk)
+        assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+    finally:
+        os.close(fd)
+
+
+def test_incomplete_hash_raises():
+    hasher = tvd.StreamHasher(2 * PART, PART)
+    hasher.update(PART, bytes(PART))
+    with pytest.raises(RuntimeError):
+        hasher.hexdigest()
@@ -0,0 +1,47 @@
+import pytest
+
+import telegram_video_downloader as tvd
+
+
+def make_bucket(rate, capacity, now=100.0):
+    bucket = tvd.TokenBucket(rate, capacity)
+    bucket.updated = now
+    return bucket
+
+
+def test_burst_up_to_capacity():
+    bucket = make_bucket(2, 3)
+    for _ in range(3):
+        assert bucket.wait_time(100.0) == 0
+        bucket.take(100.0)
+    assert bucket.wait_time(100.0) == pytest.approx(0.5)
+
+
+def test_refill_is_capped_at_capacity():
+    bucket = make_bucket(2, 3)
+    for _ in range(3):
+        bucket.take(100.0)
+    bucket._refill(1000.0)
+    assert bucket.tokens == 3
+
+
+def test_wait_time_after_partial_refill():
+    bucket = make_bucket(4, 1)
+    bucket.take(100.0)
+    assert bucket.wait_time(100.125) == pytest.approx(0.125)
+    assert bucket.wait_time(100.25) == 0
+
+
+def test_take_can_go_into_debt():
+    bucket = make_bucket(1, 1)
+    bucket.take(100.0, 3)
+    assert bucket.wait_time(100.0) == pytest.approx(3)
+    assert bucket.wait_time(101.0, amount=2) == pytest.approx(3)
+
+
+def test_set_rate_clamps_tokens():
+    bucket = make_bucket(10, 10)
+    bucket.set_rate(100.0, 1, 2)
+    assert bucket.tokens == 2
+    bucket.take(100.0, 2)
+    assert bucket.wait_time(100.0) == pytest.approx(1)